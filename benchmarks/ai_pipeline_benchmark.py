@@ -0,0 +1,148 @@
+# benchmarks/ai_pipeline_benchmark.py
+"""
+离线测量 AI 调用链路（准入队列 → key 调度 → 重试 / 对冲 → 熔断）在模拟后端上的表现：不需要网络，也不消耗配额。
+
+流程：以 AI_PROVIDER=fake 导入 ai_utils，同时发起若干个 call_ai 调用（可以混合流式调用），统计：
+- 端到端延迟（流式调用另外统计首个文本块的延迟）的 p50 / p90 / p99；
+- 成功率、被准入队列拒绝的比例和吞吐量；
+- 重试策略、对冲、key 调度和模拟后端注入错误的计数；
+- 可选地批量向量化一批文本，测量向量化吞吐量。
+
+用法（在仓库根目录）：
+    python -m benchmarks.ai_pipeline_benchmark
+    python -m benchmarks.ai_pipeline_benchmark --errors 429:0.1,500:0.05 --keys 6 --key-rpm 30
+    python -m benchmarks.ai_pipeline_benchmark --latency uniform:0.2,3 --hedge --calls 400 --concurrency 32
+    python -m benchmarks.ai_pipeline_benchmark --stream 0.5 --embed 5000
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="离线测量 AI 调用链路的延迟、成功率和吞吐量")
+    parser.add_argument("--calls", type=int, default=200, help="总调用次数")
+    parser.add_argument("--concurrency", type=int, default=16, help="同时发起的调用数")
+    parser.add_argument("--stream", type=float, default=0.0, help="流式调用所占的比例（0~1）")
+    parser.add_argument("--keys", type=int, default=4, help="模拟的 key 数量")
+    parser.add_argument("--latency", default="lognormal:0.8,0.5", help="首个 token 的延迟分布")
+    parser.add_argument("--tokens-per-second", type=float, default=60.0, help="模拟的生成速度")
+    parser.add_argument("--reply-tokens", type=int, default=60, help="回复的平均 token 数")
+    parser.add_argument("--errors", default="", help="注入的错误比例，例如 429:0.05,500:0.02,blocked:0.01")
+    parser.add_argument("--key-rpm", type=float, default=0, help="模拟后端每个 key 的 RPM 上限，0 表示不限")
+    parser.add_argument("--hedge", action="store_true", help="启用对冲请求（流式调用只对冲第一个文本块之前的等待）")
+    parser.add_argument("--embed", type=int, default=0, help="额外批量向量化的文本数")
+    parser.add_argument("--seed", default="42")
+    return parser.parse_args(argv)
+
+
+def configure_environment(args, workdir):
+    # ai_utils 和 data_manager 在导入时读取这些配置，必须先设置好环境变量
+    os.environ["AI_PROVIDER"] = "fake"
+    os.environ["GEMINI_API_KEYS"] = ""
+    os.environ["FAKE_GEMINI_KEYS"] = str(args.keys)
+    os.environ["FAKE_GEMINI_LATENCY"] = args.latency
+    os.environ["FAKE_GEMINI_TOKENS_PER_SECOND"] = str(args.tokens_per_second)
+    os.environ["FAKE_GEMINI_REPLY_TOKENS"] = str(args.reply_tokens)
+    os.environ["FAKE_GEMINI_ERROR_RATES"] = args.errors
+    os.environ["FAKE_GEMINI_KEY_RPM"] = str(args.key_rpm)
+    os.environ["FAKE_GEMINI_SEED"] = args.seed
+    os.environ["AI_HEDGE_ENABLED"] = "1" if args.hedge else "0"
+    # 让模拟后端的限流直接体现在 key 轮换上，而不是被调度器提前拦住
+    os.environ.setdefault("GEMINI_KEY_RPM", "0")
+    os.environ["DATA_BACKEND"] = "memory"
+    os.environ["DATA_LOCAL_DIR"] = os.path.join(workdir, "local")
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def describe(name, samples):
+    return (f"{name}: p50 {percentile(samples, 0.5) * 1000:.0f} ms | p90 {percentile(samples, 0.9) * 1000:.0f} ms | "
+            f"p99 {percentile(samples, 0.99) * 1000:.0f} ms（{len(samples)} 个样本）")
+
+
+async def run(args, ai_utils):
+    rng = random.Random(args.seed)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies, first_chunks = [], []
+    outcomes = {"ok": 0, "busy": 0, "error": 0}
+
+    async def one_call(index):
+        messages = [{"role": "user", "content": f"[基准测试 {index}]: 今天过得怎么样？"}]
+        async with semaphore:
+            started = time.perf_counter()
+            if rng.random() < args.stream:
+                reply = ""
+                async for chunk in await ai_utils.call_ai(messages, stream=True, priority=ai_utils.PRIORITY_CHAT):
+                    if chunk == ai_utils.AI_TRUNCATED_SIGNAL:
+                        # 中途中断的回复按失败计
+                        reply = chunk
+                        break
+                    if not reply:
+                        first_chunks.append(time.perf_counter() - started)
+                    reply += chunk
+            else:
+                reply = await ai_utils.call_ai(messages, priority=ai_utils.PRIORITY_CHAT)
+            elapsed = time.perf_counter() - started
+        if reply == ai_utils.AI_BUSY_SIGNAL:
+            outcomes["busy"] += 1
+        elif reply in (ai_utils.INTERNAL_AI_ERROR_SIGNAL, ai_utils.AI_TRUNCATED_SIGNAL):
+            outcomes["error"] += 1
+        else:
+            outcomes["ok"] += 1
+            latencies.append(elapsed)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one_call(index) for index in range(args.calls)))
+    wall = time.perf_counter() - started
+
+    print(f"模拟后端: {args.keys} 个 key | 延迟 {args.latency} | 错误 {args.errors or '无'} | 每 key RPM {args.key_rpm or '不限'}")
+    print(f"调用: {args.calls} 次（并发 {args.concurrency}，流式占比 {args.stream:.0%}）| 总耗时 {wall:.1f} s | 吞吐量 {args.calls / wall:.1f} 次/秒")
+    print(f"结果: 成功 {outcomes['ok']} | 失败 {outcomes['error']} | 排队被拒 {outcomes['busy']} | 成功率 {outcomes['ok'] / args.calls:.1%}")
+    print(describe("成功调用延迟", latencies))
+    if first_chunks:
+        print(describe("流式首块延迟", first_chunks))
+    retries = ai_utils.retry_policy.stats()
+    print(f"重试: 不可重试 {retries['fail_fast']} | 换 key {retries['rotate']} | 限流退避 {retries['throttled']} "
+          f"(服务端指定 {retries['server_hints']}) | 超过截止时间 {retries['deadline_exceeded']}")
+    if args.hedge:
+        for name, policy in (("对冲", ai_utils.hedge_policy), ("流式对冲", ai_utils.stream_hedge_policy)):
+            hedge = policy.stats()
+            if hedge["calls"]:
+                print(f"{name}: {hedge['hedged']}/{hedge['calls']} 次 | 对冲胜出 {hedge['hedge_wins']} / 原请求胜出 {hedge['primary_wins']} | 达到上限 {hedge['capped']}")
+    scheduler = ai_utils.key_scheduler.stats()
+    print(f"key 调度: 排队 {scheduler['queued']} 次 (平均 {scheduler['avg_queue_wait_s']}s) | 放弃 {scheduler['gave_up']} 次")
+    for key in scheduler["keys"]:
+        print(f"  {key['label']}: {key['requests']} 次 | 错误率 {key['error_rate']:.0%} | 限流 {key['rate_limited']} | {key['avg_latency_ms']}ms")
+    fake = ai_utils.client_pool.stats()
+    print(f"模拟后端注入: {fake['injected']} | 生成 {fake['calls']} 次")
+
+    if args.embed:
+        texts = [f"需要向量化的文本 {index % max(1, args.embed * 9 // 10)}" for index in range(args.embed)]
+        started = time.perf_counter()
+        vectors = await ai_utils.get_text_embeddings(texts)
+        elapsed = time.perf_counter() - started
+        done = sum(vector is not None for vector in vectors)
+        print(f"向量化: {done}/{len(texts)} 条 | {elapsed:.2f} s | {len(texts) / elapsed:,.0f} 条/秒 | 请求 {ai_utils.client_pool.stats()['embed_calls']} 次")
+
+
+def main(argv):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="milky_bench_") as workdir:
+        configure_environment(args, workdir)
+        from utils import data_manager, ai_utils
+        data_manager.load_data_from_hf()
+        asyncio.run(run(args, ai_utils))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
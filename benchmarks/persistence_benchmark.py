@@ -0,0 +1,101 @@
+# benchmarks/persistence_benchmark.py
+"""
+离线测量 data_manager 保存路径的吞吐量：不需要网络，也不需要 Hugging Face 令牌。
+
+流程：在临时目录中启动一个空的数据存储，模拟若干轮聊天（每轮修改一批用户数据和对话历史，
+并写入全局记忆），每轮结束后执行一次 flush，统计：
+- 修改吞吐量（每秒可以完成多少次 setter 调用，包含写本地预写日志）；
+- 每次 flush 的耗时（编码 + 本地快照 + 提交到后端）；
+- 每次提交写入后端的字节数（仅 memory 后端统计）。
+
+用法（在仓库根目录）：
+    python -m benchmarks.persistence_benchmark                    # memory 后端
+    python -m benchmarks.persistence_benchmark --backend local    # 本地目录后端（临时目录）
+    python -m benchmarks.persistence_benchmark --users 20000 --rounds 20 --changes 500
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="离线测量数据保存路径的吞吐量")
+    parser.add_argument("--backend", choices=["memory", "local"], default="memory")
+    parser.add_argument("--store", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--users", type=int, default=5000, help="预先填充的用户/对话数量")
+    parser.add_argument("--rounds", type=int, default=10, help="flush 轮数")
+    parser.add_argument("--changes", type=int, default=200, help="每轮修改的用户/对话数量")
+    return parser.parse_args(argv)
+
+
+def configure_environment(args, workdir):
+    # data_manager 在导入时读取这些配置，必须先设置好环境变量
+    os.environ["DATA_BACKEND"] = args.backend
+    os.environ["DATA_BACKEND_DIR"] = os.path.join(workdir, "remote")
+    os.environ["DATA_LOCAL_DIR"] = os.path.join(workdir, "local")
+    os.environ["DATA_STORE"] = args.store
+    # 由基准测试自己控制 flush 时机
+    os.environ["DATA_FLUSH_INTERVAL"] = "3600"
+    os.environ["DATA_FLUSH_DIRTY_THRESHOLD"] = str(10**9)
+    os.environ["DATA_SQLITE_BACKUP_INTERVAL"] = "3600"
+
+
+def history_for(rng, turns=10):
+    return [{"role": "user" if i % 2 == 0 else "model", "content": f"消息 {rng.random():.6f} " * 4} for i in range(turns)]
+
+
+async def run(args, data_manager):
+    rng = random.Random(42)
+    user_ids = [10**17 + i for i in range(args.users)]
+
+    async with data_manager.transaction():
+        for user_id in user_ids:
+            await data_manager.update_user_data(user_id, {"affection_points": 0, "last_checkin_date": None})
+            await data_manager.update_conversation_history(f"dm_{user_id}", history_for(rng))
+    seed_start = time.perf_counter()
+    await data_manager.flush(force=True)
+    print(f"初始数据: {args.users} 个用户/对话，首次完整保存耗时 {(time.perf_counter() - seed_start) * 1000:.1f} ms")
+
+    mutation_seconds, flush_times = 0.0, []
+    mutations = 0
+    for _ in range(args.rounds):
+        start = time.perf_counter()
+        for user_id in rng.sample(user_ids, args.changes):
+            await data_manager.update_user_data(user_id, {"affection_points": rng.randrange(500), "last_checkin_date": "2026-01-01"})
+            await data_manager.update_conversation_history(f"dm_{user_id}", history_for(rng))
+            await data_manager.add_to_global_memory(user_id, "bench", "你好", "你好呀")
+            mutations += 3
+        mutation_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        ok = await data_manager.flush()
+        flush_times.append(time.perf_counter() - start)
+        if not ok:
+            print("⚠️ flush 失败")
+
+    backend = data_manager._get_backend()
+    flush_times.sort()
+    print(f"后端: {backend.label} | 存储引擎: {args.store}")
+    print(f"修改吞吐量: {mutations / mutation_seconds:,.0f} 次/秒（共 {mutations} 次）")
+    print(f"flush 耗时: 平均 {sum(flush_times) / len(flush_times) * 1000:.1f} ms | "
+          f"中位数 {flush_times[len(flush_times) // 2] * 1000:.1f} ms | 最长 {flush_times[-1] * 1000:.1f} ms")
+    if hasattr(backend, "commits") and backend.commits:
+        print(f"提交次数: {backend.commits} | 平均每次写入 {backend.bytes_written / backend.commits / 1024:.1f} KiB")
+    await data_manager.stop_background_flusher()
+
+
+def main(argv):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="milky_bench_") as workdir:
+        configure_environment(args, workdir)
+        from utils import data_manager
+        data_manager.load_data_from_hf()
+        asyncio.run(run(args, data_manager))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
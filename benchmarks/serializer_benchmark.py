@@ -0,0 +1,134 @@
+# benchmarks/serializer_benchmark.py
+"""
+对比保存时的编码 CPU 耗时：每次从头编码所有脏分区 / 脏分片，与 IncrementalSerializer 只编码被修改过的条目。
+
+数据布局与 data_manager 相同（user_data 为整数 key 分区，会话历史按 key 哈希分为 16 个分片）。
+每轮随机修改固定数量的用户和对话，然后编码本轮所有的脏文件；修改量不变时，
+完整编码的耗时随数据总量线性增长，增量编码的耗时只随修改量变化。
+每轮结束后会解码增量编码的结果并与原数据比对。
+
+用法（在仓库根目录）：
+    python -m benchmarks.serializer_benchmark
+    python -m benchmarks.serializer_benchmark --sizes 10000 100000 --changes 100 --rounds 30
+"""
+import sys
+import time
+import zlib
+import random
+import argparse
+
+from utils import snapshot_format
+from utils.incremental_serializer import IncrementalSerializer
+from benchmarks.snapshot_benchmark import build_data, SAMPLE_TEXTS
+
+SHARDS = 16
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="对比完整编码与增量编码的保存耗时")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 50_000, 100_000], help="对话数量（用户数量为其 20%%）")
+    parser.add_argument("--changes", type=int, default=200, help="每轮修改的用户数量和对话数量")
+    parser.add_argument("--rounds", type=int, default=10)
+    return parser.parse_args(argv)
+
+
+def shard_of(key: str) -> int:
+    return zlib.crc32(key.encode('utf-8')) % SHARDS
+
+
+def group_shards(conversations, shards):
+    grouped = {shard: {} for shard in shards}
+    for key, value in conversations.items():
+        shard = shard_of(key)
+        if shard in grouped:
+            grouped[shard][key] = value
+    return grouped
+
+
+def full_save(data, dirty_shards):
+    """旧的保存路径：脏分区和脏分片全部从头编码"""
+    files = {"user_data": snapshot_format.encode(data["user_data"], int_keys=True)}
+    for shard, content in group_shards(data["conversation_history"], dirty_shards).items():
+        files[shard] = snapshot_format.encode(content)
+    return files
+
+
+def incremental_save(serializer, data, dirty_shards):
+    """与 data_manager._encode_shards 相同的流程"""
+    conversations = data["conversation_history"]
+    files = {"user_data": serializer.encode("user_data", data["user_data"], int_keys=True)}
+    missing = []
+    for shard in dirty_shards:
+        encoded = serializer.encode_changes(shard, conversations.__contains__, conversations.__getitem__)
+        if encoded is None:
+            missing.append(shard)
+        else:
+            files[shard] = encoded
+    for shard, content in group_shards(conversations, missing).items():
+        files[shard] = serializer.encode_full(shard, content)
+    return files
+
+
+def mutate(rng, data, changes, serializer):
+    user_ids = rng.sample(list(data["user_data"]), min(changes, len(data["user_data"])))
+    for user_id in user_ids:
+        data["user_data"][user_id] = {"affection_points": rng.randrange(0, 500), "last_checkin_date": "2026-02-01", "nickname": "changed"}
+        serializer.invalidate("user_data", user_id)
+    dirty_shards = set()
+    for key in rng.sample(list(data["conversation_history"]), changes):
+        data["conversation_history"][key] = data["conversation_history"][key][2:] + [
+            {"role": "user", "content": rng.choice(SAMPLE_TEXTS)},
+            {"role": "assistant", "content": rng.choice(SAMPLE_TEXTS)},
+        ]
+        shard = shard_of(key)
+        dirty_shards.add(shard)
+        serializer.invalidate(shard, key)
+    return dirty_shards
+
+
+def verify(files, data):
+    assert snapshot_format.decode(files["user_data"]) == data["user_data"]
+    for shard, raw in files.items():
+        if shard != "user_data":
+            decoded = snapshot_format.decode(raw)
+            assert all(data["conversation_history"][key] == value for key, value in decoded.items())
+
+
+def run(size, changes, rounds):
+    rng = random.Random(7)
+    data = build_data(size)
+    serializer = IncrementalSerializer()
+    # 首次保存：两种方式都需要完整编码
+    incremental_save(serializer, data, range(SHARDS))
+
+    full_seconds = incremental_seconds = 0.0
+    incremental_bytes = full_bytes = 0
+    for _ in range(rounds):
+        dirty_shards = mutate(rng, data, changes, serializer)
+        start = time.process_time()
+        files = full_save(data, dirty_shards)
+        full_seconds += time.process_time() - start
+        full_bytes += sum(len(raw) for raw in files.values())
+
+        start = time.process_time()
+        files = incremental_save(serializer, data, dirty_shards)
+        incremental_seconds += time.process_time() - start
+        incremental_bytes += sum(len(raw) for raw in files.values())
+        verify(files, data)
+    return full_seconds / rounds, incremental_seconds / rounds, full_bytes / rounds, incremental_bytes / rounds, serializer.stats()
+
+
+def main(argv):
+    args = parse_args(argv)
+    print(f"每轮修改 {args.changes} 个用户和 {args.changes} 个对话，共 {args.rounds} 轮（CPU 时间，取平均）")
+    print(f"{'conversations':>13} {'full (ms)':>10} {'incremental (ms)':>17} {'speedup':>8} {'full KiB':>9} {'incr KiB':>9} {'compactions':>12}")
+    for size in args.sizes:
+        full_s, incr_s, full_b, incr_b, stats = run(size, args.changes, args.rounds)
+        # 首次保存的 SHARDS + 1 次完整编码不算合并
+        compactions = stats["full_encodes"] - SHARDS - 1
+        print(f"{size:>13} {full_s * 1000:>10.1f} {incr_s * 1000:>17.1f} {full_s / incr_s if incr_s else float('inf'):>7.1f}x "
+              f"{full_b / 1024:>9.0f} {incr_b / 1024:>9.0f} {compactions:>12}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
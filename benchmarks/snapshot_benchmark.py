@@ -0,0 +1,98 @@
+# benchmarks/snapshot_benchmark.py
+"""
+对比旧版单文件 JSON（indent=2，整数 key 存为字符串）与 snapshot_format 快照编码的
+体积、序列化耗时和加载耗时。数据为合成数据，不需要网络或任何令牌。
+
+用法（在仓库根目录）：
+    python -m benchmarks.snapshot_benchmark
+    python -m benchmarks.snapshot_benchmark 1000 10000
+"""
+import sys
+import json
+import time
+import random
+
+from utils import snapshot_format
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000)
+TURNS_PER_CONVERSATION = 6
+USERS_PER_CONVERSATION_KEY = 0.2
+SAMPLE_TEXTS = [
+    "主人今天也辛苦啦～要不要喝杯热牛奶？",
+    "哼，才不是特意在等你呢！",
+    "刚才那个问题我想了一下，大概是这样的：先把数据分区，再按需加载。",
+    "Milky 收到啦！<\\n>马上就去办~",
+    "今天的天气很好，适合出去走走。",
+]
+
+
+def build_data(conversation_keys: int, seed: int = 42):
+    rng = random.Random(seed)
+    conversations = {}
+    for i in range(conversation_keys):
+        key = f"channel_{rng.randrange(10**17, 10**18)}" if i % 3 else f"dm_{rng.randrange(10**17, 10**18)}"
+        conversations[key] = [
+            {"role": "user" if t % 2 == 0 else "assistant", "content": rng.choice(SAMPLE_TEXTS)}
+            for t in range(TURNS_PER_CONVERSATION)
+        ]
+    user_data = {
+        rng.randrange(10**17, 10**18): {"affection_points": rng.randrange(0, 500), "last_checkin_date": "2026-01-01", "nickname": f"user{i}"}
+        for i in range(int(conversation_keys * USERS_PER_CONVERSATION_KEY))
+    }
+    return {"user_data": user_data, "conversation_history": conversations, "system_prompt": SAMPLE_TEXTS[2] * 20}
+
+
+def legacy_encode(data):
+    serializable = dict(data)
+    serializable["user_data"] = {str(k): v for k, v in data["user_data"].items()}
+    return json.dumps(serializable, ensure_ascii=False, indent=2).encode('utf-8')
+
+
+def legacy_decode(raw):
+    loaded = json.loads(raw.decode('utf-8'))
+    loaded["user_data"] = {int(k): v for k, v in loaded["user_data"].items()}
+    return loaded
+
+
+def snapshot_encode(data):
+    # 与 data_manager 一致：每个分区单独编码，整数 key 分区使用键值对列表
+    return {name: snapshot_format.encode(value, int_keys=(name == "user_data")) for name, value in data.items()}
+
+
+def snapshot_decode(files):
+    return {name: snapshot_format.decode(raw) for name, raw in files.items()}
+
+
+def timed(func, *args, repeat=3):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def run(size: int):
+    data = build_data(size)
+    legacy_time, legacy_raw = timed(legacy_encode, data)
+    legacy_load, legacy_loaded = timed(legacy_decode, legacy_raw)
+    snap_time, snap_files = timed(snapshot_encode, data)
+    snap_load, snap_loaded = timed(snapshot_decode, snap_files)
+    assert legacy_loaded == snap_loaded == data
+    snap_size = sum(len(raw) for raw in snap_files.values())
+    return [
+        (size, "legacy json", len(legacy_raw), legacy_time, legacy_load),
+        (size, "snapshot v1", snap_size, snap_time, snap_load),
+    ]
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv] or DEFAULT_SIZES
+    print(f"{'keys':>8}  {'format':<12} {'size (KiB)':>12} {'serialise (ms)':>15} {'load (ms)':>10}")
+    for size in sizes:
+        for keys, name, nbytes, encode_s, decode_s in run(size):
+            print(f"{keys:>8}  {name:<12} {nbytes / 1024:>12.1f} {encode_s * 1000:>15.1f} {decode_s * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
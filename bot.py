@@ -5,12 +5,14 @@ import os
 from dotenv import load_dotenv
 import asyncio
 import threading
+import time
 from flask import Flask, request, redirect, url_for
 
 # --- 加载配置 ---
 load_dotenv()
 
 from utils import data_manager, ai_utils, emoji_manager
+from utils.conversation_summarizer import summarizer, SUMMARY_DRAIN_TIMEOUT
 TOKEN = os.getenv('DISCORD_BOT_TOKEN')
 BOT_OWNER_ID_STR = os.getenv('BOT_OWNER_ID')
 if not TOKEN or not BOT_OWNER_ID_STR:
@@ -24,6 +26,31 @@ intents.members = True
 intents.guilds = True
 bot = commands.Bot(command_prefix=[], intents=intents, help_command=None)
 
+# --- 启动阶段计时 ---
+_startup_began = time.perf_counter()
+startup_phases = {}
+_gateway_started_at = None
+_emoji_load_task = None
+
+def _record_phase(name: str, started: float):
+    """记录一个启动阶段的耗时，并打印从进程启动到现在经过的时间"""
+    now = time.perf_counter()
+    startup_phases[name] = now - started
+    print(f"⏱️ 启动阶段 [{name}] 用时 {now - started:.2f} 秒（启动后 {now - _startup_began:.2f} 秒）")
+
+def _print_startup_summary():
+    if "Discord 网关就绪" not in startup_phases or "远端数据核对" not in startup_phases:
+        return
+    summary = " | ".join(f"{name} {seconds:.2f}s" for name, seconds in startup_phases.items())
+    print(f"⏱️ 启动完成，总用时 {time.perf_counter() - _startup_began:.2f} 秒：{summary}")
+
+async def _finish_data_loading(local_found: bool):
+    started = time.perf_counter()
+    await data_manager.finish_loading(local_found)
+    _record_phase("远端数据核对", started)
+    print("✔️ 数据已就绪，开始处理 AI 回复和数据修改指令。")
+    _print_startup_summary()
+
 # --- Flask 管理面板 ---
 FLASK_PORT = int(os.getenv("PORT", 7861))
 health_check_app = Flask(__name__)
@@ -41,10 +68,21 @@ def get_current_bot_config():
         "word_count_request": data_manager.get_word_count_request(),
     }
 
+def _breaker_summary():
+    """熔断器状态摘要，附加在健康检查的返回内容后面（AI 熔断不影响 Discord 连接本身，状态码保持 200）"""
+    status = ai_utils.get_breaker_status()
+    lines = [f"AI circuit: {status['ai']['state']}" + (f" (retry in {status['ai']['retry_in_s']}s)" if status['ai']['retry_in_s'] else "")]
+    for key in status["keys"]:
+        if key["state"] != "closed":
+            lines.append(f"{key['name']} circuit: {key['state']} (retry in {key['retry_in_s']}s)")
+    return "\n".join(lines)
+
 @health_check_app.route('/')
 def health_check():
     if bot.is_ready() and not bot.is_closed():
-        return "Milky is awake, connected, and guarding her master.", 200
+        if not data_manager.is_ready():
+            return f"Milky is connected and still loading her memories.\n{_breaker_summary()}", 200
+        return f"Milky is awake, connected, and guarding her master.\n{_breaker_summary()}", 200
     return "Milky is connecting or in an unknown state with Discord.", 503
 
 @health_check_app.route('/admin', methods=['GET', 'POST'])
@@ -181,14 +219,20 @@ def admin_panel():
 async def handle_admin_post(form_data):
     """在bot的事件循环中处理来自web面板的POST请求"""
     action = form_data.get('action')
+    # 数据还在加载时先等待，否则这里的修改会被随后加载的云端数据覆盖
+    if not await data_manager.wait_until_ready(timeout=60):
+        print("⚠️ 数据尚未加载完成，已忽略管理面板的修改请求。")
+        return
     
     if action == 'save_prompts':
-        await data_manager.set_bot_mode(form_data.get('bot_mode', 'chat'))
-        await data_manager.set_system_prompt(form_data.get('system_prompt', ''))
-        await data_manager.set_start_prompt(form_data.get('start_prompt', ''))
-        await data_manager.set_end_prompt(form_data.get('end_prompt', ''))
-        await data_manager.set_active_persona(form_data.get('active_persona', ''))
-        await data_manager.set_word_count_request(form_data.get('word_count_request', ''))
+        # 六项设置合并为一次保存，并在返回页面前提交到云端
+        async with data_manager.transaction(flush_on_exit=True):
+            await data_manager.set_bot_mode(form_data.get('bot_mode', 'chat'))
+            await data_manager.set_system_prompt(form_data.get('system_prompt', ''))
+            await data_manager.set_start_prompt(form_data.get('start_prompt', ''))
+            await data_manager.set_end_prompt(form_data.get('end_prompt', ''))
+            await data_manager.set_active_persona(form_data.get('active_persona', ''))
+            await data_manager.set_word_count_request(form_data.get('word_count_request', ''))
 
     elif action == 'save_persona':
         persona_name = form_data.get('persona_name')
@@ -211,18 +255,22 @@ async def _send_dm_to_owner(message: str):
 
 # --- 主启动逻辑 ---
 async def main():
+    global _emoji_load_task, _gateway_started_at
     print("正在初始化工具模块...")
     # 设置辅助函数的传递
     ai_utils.set_dm_sender(_send_dm_to_owner)
     data_manager.set_dm_sender(_send_dm_to_owner)
     emoji_manager.set_dm_sender(_send_dm_to_owner)
 
-    # 加载持久化数据
-    data_manager.load_data_from_hf()
-    # emoji_manager 已在导入时自动加载
-    
+    # 第一阶段：本地快照（不联网）；表情数据在线程中并行读取
+    started = time.perf_counter()
+    local_found = data_manager.load_local_snapshot()
+    _record_phase("本地快照", started)
+    _emoji_load_task = asyncio.create_task(_load_emojis())
+
     async with bot:
         print("\n--- 正在加载功能模块 (Cogs) ---")
+        started = time.perf_counter()
         # 动态加载所有 cogs
         cogs_dir = os.path.join(os.path.dirname(__file__), 'cogs')
         for filename in os.listdir(cogs_dir):
@@ -233,13 +281,34 @@ async def main():
                 except Exception as e:
                     print(f'  ❌ 加载 Cog {filename} 失败: {e.__class__.__name__} - {e}')
         print("--------------------------------\n")
+        _record_phase("加载 Cogs", started)
         
         # 启动 Flask
         print(f"Flask健康检查服务准备在后台线程启动，将监听端口: {FLASK_PORT}")
         threading.Thread(target=lambda: health_check_app.run(host='0.0.0.0', port=FLASK_PORT, debug=False, use_reloader=False), daemon=True).start()
         
+        # 第二阶段：与远端核对数据和连接 Discord 同时进行，核对完成前 AI 回复和数据修改指令会等待
+        loading_task = asyncio.create_task(_finish_data_loading(local_found))
         print("正在连接到 Discord...")
-        await bot.start(TOKEN)
+        _gateway_started_at = time.perf_counter()
+        try:
+            await bot.start(TOKEN)
+        finally:
+            if not loading_task.done():
+                # 取消任务不会中断核对线程：先让它放弃结果，stop_background_flusher() 会等线程结束后再关闭日志
+                data_manager.cancel_loading()
+                loading_task.cancel()
+            # 关机前把写回缓存中的修改全部提交
+            # 先让后台总结写回，它们的结果才会包含在最后一次提交中
+            if not await summarizer.drain(timeout=SUMMARY_DRAIN_TIMEOUT):
+                print("⚠️ 部分后台总结未能在关机前完成，已取消（原对话历史保留）。")
+            print("正在保存未提交的数据...")
+            await data_manager.stop_background_flusher()
+
+async def _load_emojis():
+    started = time.perf_counter()
+    await asyncio.to_thread(emoji_manager.load_emojis)
+    _record_phase("表情数据", started)
 
 @bot.event
 async def on_ready():
@@ -250,10 +319,15 @@ async def on_ready():
     except Exception as e:
         print(f'同步指令失败: {e}')
     
-    # 更新所有表情
+    # 更新所有表情（需要先等本地表情数据读取完成，否则已有的描述会被覆盖）
+    if _emoji_load_task is not None:
+        await _emoji_load_task
     await emoji_manager.update_all_emojis(bot)
     
-    print("米尔可准备就绪！")
+    if _gateway_started_at is not None and "Discord 网关就绪" not in startup_phases:
+        _record_phase("Discord 网关就绪", _gateway_started_at)
+        _print_startup_summary()
+    print("米尔可准备就绪！" if data_manager.is_ready() else "米尔可已连接，正在后台整理记忆...")
 
 @bot.event
 async def on_guild_emojis_update(guild, before, after):
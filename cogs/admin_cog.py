@@ -11,6 +11,9 @@ from utils import checks, data_manager, emoji_manager
 import aiofiles
 import tempfile
 from utils import ai_utils
+from utils.circuit_breaker import STATE_LABELS
+from utils import context_assembler
+from utils.conversation_summarizer import summarizer
 import pathlib
 import asyncio
 from collections import defaultdict
@@ -47,16 +50,29 @@ class AdminCog(commands.Cog, name="管理工具"):
         self.BOT_OWNER_ID: int = int(os.getenv('BOT_OWNER_ID', 0))
         self.AI_MODEL_NAME: str = os.getenv('AI_MODEL_NAME', '未配置')
         self.HF_DATA_REPO_ID: str = os.getenv('HF_DATA_REPO_ID', '未配置')
-        # 加载所有人格
+        # 加载所有人格（启动时先来自本地快照，数据就绪后在 cog_load 中重新读取）
+        self.personas = data_manager.get_personas()
+        self._persona_task = None
+
+    async def cog_load(self):
+        # 保留任务引用：事件循环只持有弱引用，而且卸载 Cog 时需要取消它
+        self._persona_task = asyncio.create_task(self._load_personas_when_ready())
+
+    async def cog_unload(self):
+        if self._persona_task and not self._persona_task.done():
+            self._persona_task.cancel()
+
+    async def _load_personas_when_ready(self):
+        # 云端数据可能替换掉本地快照，必须等数据就绪后再读取人格
+        await data_manager.wait_until_ready()
         self.personas = data_manager.get_personas()
         # 环境变量人格优先
         env_persona = os.getenv('BOT_PERSONA', '')
         if env_persona:
             self.personas['环境变量人格'] = env_persona
-        # 设置默认激活的人格
-        active_persona = data_manager.get_active_persona()
-        if not active_persona:
-            data_manager.set_active_persona('环境变量人格')
+            # 设置默认激活的人格
+            if not data_manager.get_active_persona():
+                await data_manager.set_active_persona('环境变量人格')
 
     @commands.hybrid_command(name="ping", description="测试AI延迟、与Discord的延迟和趣味信息。")
     async def ping(self, ctx: commands.Context):
@@ -81,11 +97,96 @@ class AdminCog(commands.Cog, name="管理工具"):
         emb.add_field(name="🤖 运行模式", value=mode, inline=True)
         emb.add_field(name="💬 当前人格", value=current_persona_full_instruction[:1000] + "..." if len(current_persona_full_instruction) > 1000 else current_persona_full_instruction, inline=False)
         emb.add_field(name="⏰ 运行状态", value="✅ 正常运行", inline=True)
+
+        persistence = data_manager.get_persistence_stats()
+        commit = persistence["tasks"].get("commit")
+        sync_lines = [f"待保存修改: {persistence['dirty_changes']} | 上传队列: {persistence['pending']}/{persistence['max_pending']}"]
+        if commit:
+            sync_lines.append(f"上传 {commit['succeeded']} 成功 / {commit['failed']} 失败 / {commit['retries']} 重试")
+            sync_lines.append(f"耗时 最近 {commit['last_ms']}ms | 平均 {commit['avg_ms']}ms | 最长 {commit['max_ms']}ms")
+        serializer = persistence["serializer"]
+        sync_lines.append(f"编码 完整 {serializer['full_encodes']} / 增量 {serializer['delta_encodes']} / 复用 {serializer['reused']}")
+        if persistence["failing"]:
+            sync_lines.append("⚠️ 最近一次上传失败，后台正在重试")
+        emb.add_field(name="💾 数据同步", value="\n".join(sync_lines), inline=False)
+
+        cache = data_manager.get_conversation_cache_stats()
+        if cache:
+            hit_rate = f"{cache['hit_rate']:.0%}" if cache['hit_rate'] is not None else "N/A"
+            emb.add_field(name="🧠 对话缓存", value=(
+                f"内存: {cache['hot_entries']}/{cache['max_entries']} 个对话 ({cache['hot_bytes'] / 1024 / 1024:.1f}/{cache['max_bytes'] / 1024 / 1024:.0f} MB) | 冷存储: {cache['cold_entries']} 个\n"
+                f"命中 {cache['hits']} / 未命中 {cache['misses']} (命中率 {hit_rate}) | 淘汰 {cache['evictions']}"
+            ), inline=False)
+
+        scheduler = ai_utils.key_scheduler.stats()
+        if scheduler["keys"]:
+            key_lines = []
+            for key in scheduler["keys"]:
+                budget = f"RPM余 {key['rpm_left']}" if key['rpm_left'] is not None else "RPM不限"
+                cooldown = f" | ❄️冷却 {key['cooldown_s']}s" if key['cooldown_s'] else ""
+                breaker = f" | {STATE_LABELS[key['breaker']]}" if key['breaker'] and key['breaker'] != "closed" else ""
+                key_lines.append(f"{key['label']}: {key['requests']} 次 | 错误率 {key['error_rate']:.0%} | 限流 {key['rate_limited']} | {key['avg_latency_ms']}ms | {budget}{cooldown}{breaker}")
+            key_lines.append(f"排队 {scheduler['queued']} 次 (平均 {scheduler['avg_queue_wait_s']}s) | 放弃 {scheduler['gave_up']} 次")
+            ai = ai_utils.ai_breaker.snapshot()
+            key_lines.append(f"整体熔断器: {STATE_LABELS[ai['state']]} | 熔断 {ai['times_opened']} 次 | 拒绝 {ai['rejected']} 次")
+            retries = ai_utils.retry_policy.stats()
+            key_lines.append(f"重试: 不可重试 {retries['fail_fast']} | 换 key {retries['rotate']} | 限流退避 {retries['throttled']} (服务端指定 {retries['server_hints']}) | 超时 {retries['deadline_exceeded']}")
+            for name, policy in (("对冲", ai_utils.hedge_policy), ("流式首块对冲", ai_utils.stream_hedge_policy)):
+                hedge = policy.stats()
+                if hedge["hedged"]:
+                    delay = f"{hedge['delay_ms']}ms" if hedge['delay_ms'] is not None else "样本不足"
+                    key_lines.append(f"{name} {hedge['hedged']}/{hedge['calls']} 次 ({hedge['hedge_rate']:.0%}) | 对冲胜出 {hedge['hedge_wins']} / 原请求胜出 {hedge['primary_wins']} | 达到上限 {hedge['capped']} | 阈值 {delay}")
+            if ai_utils.AI_PROVIDER == 'fake':
+                fake = ai_utils.client_pool.stats()
+                injected = " ".join(f"{name}:{count}" for name, count in fake["injected"].items() if count) or "无"
+                key_lines.insert(0, f"🧪 离线模拟后端 | 延迟 {fake['latency']} | 生成 {fake['calls']} 次 | 向量化 {fake['embed_calls']} 次 | 注入错误 {injected}")
+            emb.add_field(name="🔑 API Key", value="\n".join(key_lines)[:1024], inline=False)
+
+        admission = ai_utils.admission.stats()
+        queue_lines = [f"进行中 {admission['in_flight']}/{admission['max_concurrent']} | 排队 {admission['queued']}/{admission['max_queue']}"]
+        for label, cls in admission["classes"].items():
+            if cls["admitted"] or cls["shed"] or cls["timed_out"]:
+                queue_lines.append(f"{label}: 受理 {cls['admitted']} | 拒绝 {cls['shed']} | 超时 {cls['timed_out']} | 平均等待 {cls['avg_wait_ms']}ms (最长 {cls['max_wait_ms']}ms)")
+        emb.add_field(name="🚦 AI 请求队列", value="\n".join(queue_lines), inline=False)
+
+        if ai_utils.last_context_breakdown:
+            emb.add_field(name="🧮 最近一次上下文", value=context_assembler.format_breakdown(ai_utils.last_context_breakdown), inline=False)
+
+        summaries = summarizer.stats()
+        if summaries["scheduled"]:
+            emb.add_field(name="📝 后台总结", value=(
+                f"进行中 {summaries['running']} | 完成 {summaries['completed']} / 调度 {summaries['scheduled']} | "
+                f"失败 {summaries['failed']} | 作废 {summaries['discarded']} | 已并入 {summaries['folded_turns']} 条消息"
+            ), inline=False)
+
+        reply_cache = ai_utils.response_cache.stats()
+        if reply_cache["hits"] or reply_cache["misses"]:
+            hit_rate = f"{reply_cache['hit_rate']:.0%}" if reply_cache['hit_rate'] is not None else "N/A"
+            emb.add_field(name="💬 回复缓存", value=(
+                f"{reply_cache['entries']}/{reply_cache['max_entries']} 个提示词 ({reply_cache['variants']} 条回复) | "
+                f"命中 {reply_cache['hits']} / 未命中 {reply_cache['misses']} (命中率 {hit_rate}) | 过期 {reply_cache['expirations']} | 淘汰 {reply_cache['evictions']}"
+            ), inline=False)
         await ctx.send(embed=emb, ephemeral=True)
 
+    @commands.hybrid_command(name="保存数据", description="[主人] 立即将内存中未保存的数据同步到云端。")
+    @commands.check(checks.is_owner)
+    @checks.state_ready()
+    async def flush_data(self, ctx: commands.Context):
+        """立即提交写回缓存中的所有修改"""
+        await ctx.defer(ephemeral=True)
+        had_changes = data_manager.has_pending_changes()
+        ok = await data_manager.flush()
+        if not ok:
+            await ctx.send("❌ 数据同步失败，修改仍保留在内存中，后台会继续重试。请检查后台日志。", ephemeral=True)
+        elif had_changes:
+            await ctx.send("✅ 已将所有未保存的修改同步到云端。", ephemeral=True)
+        else:
+            await ctx.send("ℹ️ 当前没有未保存的修改。", ephemeral=True)
+
     @commands.hybrid_command(name="热恋模式", description="[主人] 切换米尔可特殊情感模式。")
     @app_commands.describe(state="开启或关闭")
     @commands.check(checks.is_owner)
+    @checks.state_ready()
     async def heatmode(self, ctx: commands.Context, state: Literal["开启", "关闭"]):
         """切换热恋模式"""
         await ctx.defer(ephemeral=True)
@@ -99,6 +200,7 @@ class AdminCog(commands.Cog, name="管理工具"):
     @commands.hybrid_command(name="短篇幅模式", description="[主人] 开启或关闭AI短篇幅连续回复模式")
     @app_commands.describe(state="开启或关闭")
     @commands.check(checks.is_owner)
+    @checks.state_ready()
     async def short_reply_mode(self, ctx: commands.Context, state: Literal["开启", "关闭"]):
         """开启或关闭短篇幅模式"""
         await ctx.defer(ephemeral=True)
@@ -112,6 +214,7 @@ class AdminCog(commands.Cog, name="管理工具"):
     @commands.hybrid_command(name="字数要求", description="[主人] 通过提示词引导AI的回复字数")
     @app_commands.describe(requirement="设置字数要求（如 '200字', '一段话'），输入 '无' 或 '清除' 来移除要求")
     @commands.check(checks.is_owner)
+    @checks.state_ready()
     async def word_count_request(self, ctx: commands.Context, requirement: Optional[str] = None):
         """设置或查看通过提示词引导的AI回复字数要求"""
         await ctx.defer(ephemeral=True)
@@ -152,6 +255,7 @@ class AdminCog(commands.Cog, name="管理工具"):
         app_commands.Choice(name="移除", value="移除")
     ])
     @commands.check(checks.is_owner)
+    @checks.state_ready()
     async def manage(self, ctx: commands.Context, func: str, user: Optional[discord.User] = None, action: Optional[str] = None, amount: Optional[int] = None, points: Optional[int] = None, consecutive_days: Optional[int] = None, last_checkin_date: Optional[str] = None):
         await ctx.defer(ephemeral=True)
         from utils import data_manager
@@ -159,50 +263,53 @@ class AdminCog(commands.Cog, name="管理工具"):
             if not (user and action and amount is not None):
                 await ctx.send("请提供目标用户、操作类型和数量。", ephemeral=True)
                 return
-            orig_pts = data_manager.get_user_data(user.id).get('points', 0) if data_manager.get_user_data(user.id) else 0
-            if action == "增加":
-                new_pts = orig_pts + amount
-            elif action == "设定":
-                new_pts = amount
-            elif action == "移除":
-                new_pts = max(0, orig_pts - amount)
-            else:
+            if action not in ("增加", "设定", "移除"):
                 await ctx.send("未知操作类型。", ephemeral=True)
                 return
-            p_data = data_manager.get_user_data(user.id) or {'points': 0, 'last_checkin_date': None, 'consecutive_days': 0}
-            p_data['points'] = new_pts
-            await data_manager.update_user_data(user.id, p_data)
-            await ctx.send(f"已将用户 {user.display_name} 的积分从 {orig_pts} 调整为 {new_pts}。", ephemeral=True)
+            result = {}
+            def adjust_points(p_data):
+                orig_pts = p_data.get('points', 0)
+                if action == "增加":
+                    new_pts = orig_pts + amount
+                elif action == "设定":
+                    new_pts = amount
+                else:
+                    new_pts = max(0, orig_pts - amount)
+                p_data['points'] = new_pts
+                result.update(orig=orig_pts, new=new_pts)
+            # 在该用户的锁内读取并修改，不会与签到等操作互相覆盖
+            await data_manager.modify_user_data(user.id, adjust_points, default={'points': 0, 'last_checkin_date': None, 'consecutive_days': 0})
+            await ctx.send(f"已将用户 {user.display_name} 的积分从 {result['orig']} 调整为 {result['new']}。", ephemeral=True)
         elif func == "checkin":
             if not user:
                 await ctx.send("请提供目标用户。", ephemeral=True)
                 return
-            p_data = data_manager.get_user_data(user.id) or {'points': 0, 'last_checkin_date': None, 'consecutive_days': 0}
-        changes = []
-        if points is not None:
-            if points < 0:
+            updates = {}
+            changes = []
+            if points is not None:
+                if points < 0:
                     await ctx.send("点数不能为负。", ephemeral=True); return
-            p_data['points'] = points
-            changes.append(f"总点数设为`{points}`")
-        if consecutive_days is not None:
-            if consecutive_days < 0:
+                updates['points'] = points
+                changes.append(f"总点数设为`{points}`")
+            if consecutive_days is not None:
+                if consecutive_days < 0:
                     await ctx.send("连续天数不能为负。", ephemeral=True); return
-            p_data['consecutive_days'] = consecutive_days
-            changes.append(f"连续天数设为`{consecutive_days}`")
-        if last_checkin_date is not None:
-            if last_checkin_date.lower() in ["reset", "none", "null", ""]:
-                p_data['last_checkin_date'] = None
-                changes.append("上次签到日已重置")
-            else:
-                try:
-                    datetime.strptime(last_checkin_date, '%Y-%m-%d')
-                    p_data['last_checkin_date'] = last_checkin_date
-                    changes.append(f"上次签到日设为`{last_checkin_date}`")
-                except ValueError:
+                updates['consecutive_days'] = consecutive_days
+                changes.append(f"连续天数设为`{consecutive_days}`")
+            if last_checkin_date is not None:
+                if last_checkin_date.lower() in ["reset", "none", "null", ""]:
+                    updates['last_checkin_date'] = None
+                    changes.append("上次签到日已重置")
+                else:
+                    try:
+                        datetime.strptime(last_checkin_date, '%Y-%m-%d')
+                        updates['last_checkin_date'] = last_checkin_date
+                        changes.append(f"上次签到日设为`{last_checkin_date}`")
+                    except ValueError:
                         await ctx.send("日期格式无效。请用YYYY-MM-DD或'reset'。", ephemeral=True); return
             if not changes:
                 await ctx.send("未指定任何修改项。", ephemeral=True); return
-            await data_manager.update_user_data(user.id, p_data)
+            await data_manager.modify_user_data(user.id, lambda p_data: p_data.update(updates), default={'points': 0, 'last_checkin_date': None, 'consecutive_days': 0})
             await ctx.send(f"用户 {user.display_name} 的签到数据已修改：{'，'.join(changes)}", ephemeral=True)
         else:
             await ctx.send("未知功能类型。", ephemeral=True)
@@ -210,6 +317,7 @@ class AdminCog(commands.Cog, name="管理工具"):
     @commands.hybrid_command(name="人格", description="[主人] 切换AI人格。支持默认人格和已上传人格。")
     @app_commands.describe(name="人格名称")
     @commands.check(checks.is_owner)
+    @checks.state_ready()
     async def personality(self, ctx: commands.Context, name: str):
         """切换人格功能"""
         await ctx.defer(ephemeral=True)
@@ -274,6 +382,7 @@ class AdminCog(commands.Cog, name="管理工具"):
     @commands.hybrid_command(name="风格", description="[主人] 切换AI风格。仅支持自定义上传/切换。")
     @app_commands.describe(style="风格内容")
     @commands.check(checks.is_owner)
+    @checks.state_ready()
     async def style(self, ctx: commands.Context, style: str):
         await data_manager.set_style(style) # 假设你会在data_manager中创建一个set_style的异步函数
         await ctx.send(f"🎨 已切换到新风格。", ephemeral=True)
@@ -290,6 +399,7 @@ class AdminCog(commands.Cog, name="管理工具"):
         app_commands.Choice(name="列表", value="list")
     ])
     @commands.check(checks.is_owner)
+    @checks.state_ready()
     async def filterword(self, ctx: commands.Context, action: str, word: Optional[str] = None):
         from utils import data_manager
         if action == "add":
@@ -324,8 +434,9 @@ class AdminCog(commands.Cog, name="管理工具"):
                 await ctx.send("⚠️ 没有词被移除。", ephemeral=True)
         elif action == "clear":
             words = list(data_manager.get_filtered_words())
-            for w in words:
-                await data_manager.remove_filtered_word(w)
+            async with data_manager.transaction():
+                for w in words:
+                    await data_manager.remove_filtered_word(w)
             await ctx.send("✅ 已清空所有屏蔽词。", ephemeral=True)
             await self.send_log(ctx.guild.id if ctx.guild else 0, "admin", f"清空所有屏蔽词 by {ctx.author} ({ctx.author.id})", ctx.author)
         elif action == "list":
@@ -367,6 +478,7 @@ class AdminCog(commands.Cog, name="管理工具"):
         app_commands.Choice(name="删除全局日志", value="global")
     ])
     @commands.check(checks.is_owner)
+    @checks.state_ready()
     async def log(self, ctx: commands.Context, type: str, guild: Optional[discord.abc.GuildChannel] = None, channel: Optional[discord.TextChannel] = None, log_type: Optional[str] = None, message: Optional[str] = None):
         await ctx.defer(ephemeral=True)
         from utils import data_manager
@@ -697,6 +809,7 @@ class AdminCog(commands.Cog, name="管理工具"):
     @commands.hybrid_command(name="上传人格", description="[主人] 上传自定义AI人格（名称+内容），支持覆写")
     @app_commands.describe(name="人格名称", content="人格内容")
     @commands.check(checks.is_owner)
+    @checks.state_ready()
     async def upload_persona(self, ctx: commands.Context, name: str, content: str):
         """上传自定义AI人格，支持覆写同名人格"""
         await ctx.defer(ephemeral=True)
@@ -718,29 +831,27 @@ class AdminCog(commands.Cog, name="管理工具"):
 
     @authorize.command(name="添加", description="[主人] 授权一个用户与机器人对话")
     @app_commands.describe(user="要授权的用户")
+    @checks.state_ready()
     async def authorize_add(self, ctx: commands.Context, user: discord.User):
         await ctx.defer(ephemeral=True)
         private_chat_users = data_manager.get_private_chat_users()
         if user.id in private_chat_users:
             await ctx.send(f"用户 {user.display_name} 已被授权。", ephemeral=True)
         else:
-            private_chat_users.append(user.id)
-            data_manager.data["private_chat_users"] = private_chat_users
-            await data_manager.save_data_to_hf()
+            await data_manager.add_private_chat_user(user.id)
             await ctx.send(f"✅ 已授权用户 {user.display_name} 与机器人对话。", ephemeral=True)
             await self.send_log(ctx.guild.id if ctx.guild else 0, "admin", f"授权用户: {user.display_name} ({user.id}) by {ctx.author} ({ctx.author.id})", ctx.author)
 
     @authorize.command(name="移除", description="[主人] 取消一个用户的对话授权")
     @app_commands.describe(user="要取消授权的用户")
+    @checks.state_ready()
     async def authorize_remove(self, ctx: commands.Context, user: discord.User):
         await ctx.defer(ephemeral=True)
         private_chat_users = data_manager.get_private_chat_users()
         if user.id not in private_chat_users:
             await ctx.send(f"用户 {user.display_name} 未被授权。", ephemeral=True)
         else:
-            private_chat_users.remove(user.id)
-            data_manager.data["private_chat_users"] = private_chat_users
-            await data_manager.save_data_to_hf()
+            await data_manager.remove_private_chat_user(user.id)
             await ctx.send(f"✅ 已取消用户 {user.display_name} 的对话授权。", ephemeral=True)
             await self.send_log(ctx.guild.id if ctx.guild else 0, "admin", f"取消授权用户: {user.display_name} ({user.id}) by {ctx.author} ({ctx.author.id})", ctx.author)
 
@@ -10,6 +10,9 @@ import io
 import time
 import os
 
+# 向量化格式下攒够这么多条消息后批量向量化一次
+EMBED_FLUSH_SIZE = 1000
+
 class CrawlCog(commands.Cog, name="爬取工具"):
     """专门用于爬取服务器消息的工具"""
 
@@ -26,6 +29,21 @@ class CrawlCog(commands.Cog, name="爬取工具"):
         owner_id = int(os.getenv('BOT_OWNER_ID', 0))
         owner = await self.bot.fetch_user(owner_id)
 
+        # 向量化格式下等待批量向量化的消息：(文本, 原始时间戳)
+        pending_embeddings = []
+
+        async def flush_embeddings():
+            if not pending_embeddings:
+                return
+            vectors = await ai_utils.get_text_embeddings([text for text, _ in pending_embeddings])
+            for (text, timestamp), embedding in zip(pending_embeddings, vectors):
+                # 如果成功获取，则保存精简后的数据
+                if embedding:
+                    messages.append({"vector": embedding, "original_timestamp": timestamp})
+                else:
+                    print(f"跳过一条消息，因为它无法被向量化: {text[:50]}...")
+            pending_embeddings.clear()
+
         try:
             messages = []
             total_channels = len(channels_to_crawl)
@@ -76,27 +94,17 @@ class CrawlCog(commands.Cog, name="爬取工具"):
                             # 准备用于向量化的文本
                             formatted_timestamp = msg.created_at.strftime("%Y-%m-%d %H:%M:%S")
                             text_to_embed = f"[{formatted_timestamp}] {msg.author.name}: {msg.content}"
-                            
-                            # 调用API获取向量
-                            embedding = await ai_utils.get_text_embedding(text_to_embed)
-                            
-                            # 如果成功获取，则保存精简后的数据
-                            if embedding:
-                                msg_data = {
-                                    "vector": embedding,
-                                    "original_timestamp": int(msg.created_at.timestamp())
-                                }
-                                messages.append(msg_data)
-                                # 短暂休眠以避免API速率限制
-                                await asyncio.sleep(0.05)
-                            else:
-                                print(f"跳过一条消息，因为它无法被向量化: {text_to_embed[:50]}...")
+                            pending_embeddings.append((text_to_embed, int(msg.created_at.timestamp())))
+                            # 攒够一批再调用API，速率由 key 调度器控制
+                            if len(pending_embeddings) >= EMBED_FLUSH_SIZE:
+                                await flush_embeddings()
 
                 except discord.Forbidden:
                     continue
                 except Exception as e:
                     print(f"爬取频道 {current_channel.name} 时出错: {e}")
                     continue
+            await flush_embeddings()
             
             # 任务完成，打包并发送文件
             if not messages:
@@ -163,7 +163,7 @@ class FunCog(commands.Cog, name="娱乐功能"):
             messages = [{"role": "user", "content": "主人温柔地抚摸了我的头，请用你的人格和风格来回应这个动作。要体现被抚摸时的感受和反应。"}]
             
             try:
-                ai_response = await ai_utils.call_ai(messages, temperature=0.8, max_tokens=200, context_for_error_dm="摸头互动")
+                ai_response = await ai_utils.call_ai(messages, temperature=0.8, max_tokens=200, context_for_error_dm="摸头互动", cache=True)
                 response = ai_response.strip() if ai_response != ai_utils.INTERNAL_AI_ERROR_SIGNAL else "喵~ 主人的手好温暖呢！(蹭蹭)"
             except Exception as e:
                 print(f"AI摸头调用失败: {e}")
@@ -175,7 +175,7 @@ class FunCog(commands.Cog, name="娱乐功能"):
             from utils import ai_utils
             messages = [{"role": "user", "content": "主人给了我一个温暖的拥抱，请用你的人格和风格来回应这个拥抱。要体现被拥抱时的感受、情感和反应。"}]
             try:
-                ai_response = await ai_utils.call_ai(messages, temperature=0.8, max_tokens=200, context_for_error_dm="抱抱互动")
+                ai_response = await ai_utils.call_ai(messages, temperature=0.8, max_tokens=200, context_for_error_dm="抱抱互动", cache=True)
                 response = ai_response.strip() if ai_response != ai_utils.INTERNAL_AI_ERROR_SIGNAL else "主人！我也要抱抱你！(紧紧抱住主人)"
             except Exception as e:
                 print(f"AI抱抱调用失败: {e}")
@@ -70,21 +70,20 @@ class GeneralCog(commands.Cog, name="通用指令"):
         discord_latency = round(self.bot.latency * 1000)
         start_time_ai = time.time()
         ai_test_messages = [{"role": "user", "content": "ping"}]
+        # 健康检查必须真实调用一次 AI，不使用回复缓存
         ai_response = await ai_utils.call_ai(ai_test_messages, temperature=0.1, max_tokens=10, context_for_error_dm="Ping指令测试")
         end_time_ai = time.time()
         ai_latency = round((end_time_ai - start_time_ai) * 1000)
         ai_status = "🟢 正常" if ai_response != ai_utils.INTERNAL_AI_ERROR_SIGNAL else "🔴 异常"
         
-        hf_status = "N/A"
+        hf_detail = ""
         if os.getenv('HF_TOKEN') and os.getenv('HF_DATA_REPO_ID'):
-            start_time_hf = time.time()
-            try:
-                data_manager.save_data_to_hf()
-                hf_status = "🟢 正常"
-            except Exception:
-                hf_status = "🔴 异常"
-            end_time_hf = time.time()
-            hf_latency = round((end_time_hf - start_time_hf) * 1000)
+            # 只读取后台刷新任务的统计，不在这里强制提交（提交由写回缓存合并进行）
+            persistence = data_manager.get_persistence_stats()
+            commit = persistence["tasks"].get("commit")
+            hf_status = "🔴 异常" if persistence["failing"] else "🟢 正常"
+            hf_latency = commit["last_ms"] if commit else "N/A"
+            hf_detail = f"\n待保存修改: {persistence['dirty_changes']} | 上传队列: {persistence['pending']}"
         else:
             hf_status = "⚪ 未配置"
             hf_latency = "N/A"
@@ -103,7 +102,7 @@ class GeneralCog(commands.Cog, name="通用指令"):
         )
         embed.add_field(name="🛰️ Discord 网关延迟", value=f"`{discord_latency} ms`", inline=True)
         embed.add_field(name="🧠 AI 核心响应", value=f"`{ai_latency} ms`\n状态: **{ai_status}**", inline=True)
-        embed.add_field(name="💾 数据持久化 (HF)", value=f"`{hf_latency} ms`\n状态: **{hf_status}**", inline=True)
+        embed.add_field(name="💾 数据持久化 (HF)", value=f"`{hf_latency} ms`\n状态: **{hf_status}**{hf_detail}", inline=True)
         
         embed.set_footer(text=f"诊断于: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         
@@ -4,6 +4,7 @@ from discord.ext import commands
 from discord import app_commands
 from datetime import datetime, timedelta, timezone
 from utils import data_manager, ai_utils, checks
+from utils.conversation_summarizer import summarizer, HISTORY_MAX_TURNS
 import os
 from typing import Optional
 import asyncio
@@ -11,6 +12,13 @@ import re
 import random
 import json
 
+# 启动时 AI 回复最多等待数据加载多少秒
+READY_WAIT_SECONDS = float(os.getenv('STARTUP_READY_WAIT', '60'))
+# 流式回复时编辑同一条消息的最短间隔（秒）；Discord 对同一频道的编辑大约限制为每 5 秒 5 次
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.2'))
+DISCORD_MESSAGE_LIMIT = 2000
+SHORT_REPLY_TAG = '<\\n>'
+
 class SystemsCog(commands.Cog, name="核心系统"):
     """负责处理核心的、非管理性的系统，如对话、签到、商店等。"""
     def __init__(self, bot: commands.Bot):
@@ -28,6 +36,82 @@ class SystemsCog(commands.Cog, name="核心系统"):
         else:  # 如果是私聊消息
             return f"dm_{message.author.id}"
 
+    async def _send_reply_segment(self, msg: discord.Message, text: str, first: bool):
+        try:
+            if first:
+                return await msg.reply(text, mention_author=False)
+            return await msg.channel.send(text)
+        except Exception as e:
+            print(f"[ERROR] 发送AI分段回复失败: {e}")
+            return None
+
+    async def _stream_short_reply(self, msg: discord.Message, chunks):
+        """短篇幅模式：每个 <\\n> 分段一生成完就发送，分段之间保留和以前一样的停顿；返回 (完整回复, 失败信号或 None)"""
+        reply, buffer = "", ""
+        sent_any, last_sent = False, 0.0
+        loop = asyncio.get_running_loop()
+
+        async def send(segment):
+            nonlocal sent_any, last_sent
+            segment = segment.strip()
+            if not segment:
+                return
+            if sent_any:
+                # 生成比停顿快时补足间隔，模拟真人打字
+                await asyncio.sleep(max(0.0, random.uniform(0.7, 1.3) - (loop.time() - last_sent)))
+            await self._send_reply_segment(msg, segment, first=not sent_any)
+            sent_any, last_sent = True, loop.time()
+
+        signal = None
+        async for chunk in chunks:
+            if chunk in (ai_utils.INTERNAL_AI_ERROR_SIGNAL, ai_utils.AI_BUSY_SIGNAL, ai_utils.AI_TRUNCATED_SIGNAL):
+                signal = chunk
+                break
+            reply += chunk
+            buffer += chunk
+            while SHORT_REPLY_TAG in buffer:
+                segment, buffer = buffer.split(SHORT_REPLY_TAG, 1)
+                await send(segment)
+        await send(buffer)
+        return reply.strip(), signal
+
+    async def _stream_full_reply(self, msg: discord.Message, chunks):
+        """普通模式：收到第一段文本就回复，之后按 STREAM_EDIT_INTERVAL 节流编辑同一条消息；超过 Discord 长度限制时续发新消息。返回值同上"""
+        reply = ""
+        current, current_start, shown = None, 0, ""
+        last_edit = 0.0
+        loop = asyncio.get_running_loop()
+
+        async def render(final=False):
+            nonlocal current, current_start, shown, last_edit
+            while True:
+                text = reply[current_start:current_start + DISCORD_MESSAGE_LIMIT].strip()
+                if text and text != shown:
+                    if current is None:
+                        current = await self._send_reply_segment(msg, text, first=current_start == 0)
+                    elif final or len(reply) - current_start > DISCORD_MESSAGE_LIMIT or loop.time() - last_edit >= STREAM_EDIT_INTERVAL:
+                        try:
+                            await current.edit(content=text)
+                        except Exception as e:
+                            print(f"[ERROR] 编辑AI流式回复失败: {e}")
+                    else:
+                        return
+                    shown, last_edit = text, loop.time()
+                if len(reply) - current_start <= DISCORD_MESSAGE_LIMIT:
+                    return
+                # 当前消息已写满，剩余内容发到新消息
+                current, current_start, shown = None, current_start + DISCORD_MESSAGE_LIMIT, ""
+
+        signal = None
+        async for chunk in chunks:
+            if chunk in (ai_utils.INTERNAL_AI_ERROR_SIGNAL, ai_utils.AI_BUSY_SIGNAL, ai_utils.AI_TRUNCATED_SIGNAL):
+                signal = chunk
+                break
+            reply += chunk
+            await render()
+        await render(final=True)
+        return reply.strip(), signal
+
     @commands.Cog.listener()
     async def on_message(self, msg: discord.Message):
         if msg.author.bot:
@@ -53,6 +137,10 @@ class SystemsCog(commands.Cog, name="核心系统"):
         is_mention_in_guild = not is_dm and self.bot.user and self.bot.user.mentioned_in(msg) and not msg.mention_everyone
         if not is_dm and not is_mention_in_guild:
             return
+        # 启动时数据在后台加载，授权列表和对话历史就绪之前不回复
+        if not data_manager.is_ready() and not await data_manager.wait_until_ready(timeout=READY_WAIT_SECONDS):
+            print(f"⚠️ 等待数据加载超时（{READY_WAIT_SECONDS:.0f} 秒），已忽略来自 {msg.author.id} 的消息。")
+            return
         is_owner = (msg.author.id == self.BOT_OWNER_ID)
         private_chat_users = data_manager.get_private_chat_users()
         is_authorized = is_owner or (msg.author.id in private_chat_users)
@@ -70,67 +158,59 @@ class SystemsCog(commands.Cog, name="核心系统"):
                 context = f"私聊(用户:{msg.author.id})"
             else:
                 context = f"提及(频道:{msg.channel.id}, 用户:{msg.author.id})"
-            history = data_manager.get_conversation_history(key)
-            # 自动总结：如果历史过长，调用AI总结
-            MAX_HISTORY_LEN = 30
-            if len(history) > MAX_HISTORY_LEN:
-                summary_input = history[:-10]
-                summary_text = '\n'.join([f"{m['role']}: {m['content']}" for m in summary_input])
-                summary_prompt = "请用简洁中文总结以下对话历史，保留关键信息，便于后续AI继续对话：\n" + summary_text
-                summary_result = await ai_utils.call_ai([
-                    {"role": "system", "content": "你是对话历史总结助手。"},
-                    {"role": "user", "content": summary_prompt}
-                ], context_for_error_dm="自动总结历史")
-                history = [{"role": "system", "content": f"历史总结：{summary_result}"}] + history[-10:]
-            messages = []
-            messages.extend(history)
-            # 将用户名添加到消息内容中
-            user_formatted_content = f"{msg.author.display_name}: {user_msg_content}"
-            messages.append({"role": "user", "content": user_formatted_content})
-            ai_reply = await ai_utils.call_ai(messages, context_for_error_dm=context)
-            print(f"[DEBUG] AI回复内容: {ai_reply}")
-            if ai_reply and ai_reply != ai_utils.INTERNAL_AI_ERROR_SIGNAL:
-                corrected_reply = ai_reply
-                # 记录历史时也包含用户名
+            # 同一对话的消息按顺序处理：持有该对话的锁直到回复写回历史，避免并发时互相覆盖
+            async with data_manager.conversation_lock(key):
+                history = data_manager.get_conversation_history(key)
+                # 较早的对话由后台任务折叠进总结（见 conversation_summarizer），这里只读取已有的总结，不等待总结
+                messages = []
+                summary = data_manager.get_conversation_summary(key)
+                if summary:
+                    # system 消息会被当作历史总结放进系统指令，不写入对话历史
+                    messages.append({"role": "system", "content": summary})
+                messages.extend(history)
+                # 将用户名添加到消息内容中
                 user_formatted_content = f"{msg.author.display_name}: {user_msg_content}"
-                new_history_entry = [
-                    {"role": "user", "content": user_formatted_content},
-                    {"role": "model", "content": corrected_reply}
-                ]
-                updated_history = history + new_history_entry
-                if len(updated_history) > 30:
-                    updated_history = updated_history[-30:]
-                await data_manager.update_conversation_history(key, updated_history)
-                # --- 新增：记录到全局记忆 ---
-                await data_manager.add_to_global_memory(
-                    user_id=msg.author.id,
-                    user_name=msg.author.display_name,
-                    message=user_msg_content,
-                    bot_reply=corrected_reply
-                )
-                # --------------------------
-                # 根据短篇幅模式决定如何发送消息
+                messages.append({"role": "user", "content": user_formatted_content})
+                # 流式生成，边生成边发送：用户等待的是第一段文本，而不是整段回复
+                priority = ai_utils.PRIORITY_OWNER if is_owner else ai_utils.PRIORITY_CHAT
+                chunks = await ai_utils.call_ai(messages, context_for_error_dm=context, stream=True, priority=priority)
                 if data_manager.get_short_reply_mode():
-                    # 使用 <\n> 标签进行分段发送
-                    segments = corrected_reply.split('<\\n>')
-                    for idx, seg in enumerate(segments):
-                        seg = seg.strip()
-                        if not seg:
-                            continue
-                        try:
-                            if idx == 0:
-                                await msg.reply(seg, mention_author=False)
-                            else:
-                                await msg.channel.send(seg)
-                        except Exception as e:
-                            print(f"[ERROR] 发送AI分段回复失败: {e}")
-                        await asyncio.sleep(random.uniform(0.7, 1.3))
+                    ai_reply, signal = await self._stream_short_reply(msg, chunks)
                 else:
-                    # 正常发送完整回复
-                    try:
-                        await msg.reply(corrected_reply, mention_author=False)
-                    except Exception as e:
-                        print(f"[ERROR] 发送AI回复失败: {e}")
+                    ai_reply, signal = await self._stream_full_reply(msg, chunks)
+                if signal == ai_utils.AI_BUSY_SIGNAL:
+                    # 繁忙时被拒绝：告诉用户稍后再试，而不是一直没有回应
+                    await self._send_reply_segment(msg, ai_utils.AI_BUSY_MESSAGE, first=True)
+                elif signal == ai_utils.AI_TRUNCATED_SIGNAL:
+                    # 已经发出的半截回复保留在频道里，但不写入对话历史，避免下一次提示词里出现不完整的回复
+                    await self._send_reply_segment(msg, ai_utils.AI_TRUNCATED_MESSAGE, first=not ai_reply)
+                print(f"[DEBUG] AI回复内容: {ai_reply}")
+                corrected_reply = None
+                if ai_reply and signal is None:
+                    corrected_reply = ai_reply
+                    # 记录历史时也包含用户名
+                    user_formatted_content = f"{msg.author.display_name}: {user_msg_content}"
+                    new_history_entry = [
+                        {"role": "user", "content": user_formatted_content},
+                        {"role": "model", "content": corrected_reply}
+                    ]
+                    updated_history = history + new_history_entry
+                    # 后台总结一直失败时的保护：超出硬上限的最早消息直接丢弃
+                    if len(updated_history) > HISTORY_MAX_TURNS:
+                        updated_history = updated_history[-HISTORY_MAX_TURNS:]
+                    # 对话历史与全局记忆作为一次修改保存
+                    async with data_manager.transaction():
+                        await data_manager.update_conversation_history(key, updated_history)
+                        # --- 新增：记录到全局记忆 ---
+                        await data_manager.add_to_global_memory(
+                            user_id=msg.author.id,
+                            user_name=msg.author.display_name,
+                            message=user_msg_content,
+                            bot_reply=corrected_reply
+                        )
+            if corrected_reply:
+                # 回复已经在生成过程中发送完毕，历史过长时在后台总结
+                summarizer.schedule(key)
                 # 日志：AI对话
                 try:
                     from cogs.admin_cog import AdminCog
@@ -140,6 +220,8 @@ class SystemsCog(commands.Cog, name="核心系统"):
                             break
                 except Exception as e:
                     print(f"AI对话日志记录失败: {e}")
+            elif signal == ai_utils.AI_TRUNCATED_SIGNAL:
+                print("[ERROR] AI回复中途中断，截断的回复没有写入对话历史。")
             else:
                 print("[ERROR] AI调用失败，未能获取有效回复。")
 
@@ -173,6 +255,7 @@ class SystemsCog(commands.Cog, name="核心系统"):
             await ctx.send("未知功能类型。", ephemeral=True)
 
     @commands.hybrid_command(name="清除记忆", description="清除当前上下文的记忆，开始一段全新的对话。")
+    @checks.state_ready()
     async def clear_memory(self, ctx: commands.Context):
         """清除当前上下文的对话历史，开始新对话。"""
         await ctx.defer(ephemeral=True)
@@ -180,64 +263,70 @@ class SystemsCog(commands.Cog, name="核心系统"):
         # 使用与 on_message 一致的逻辑来获取记忆key
         key = self.get_memory_key(ctx.message)
         
-        # 清空该key的对话历史
-        history = data_manager.get_conversation_history(key)
+        # 清空该key的对话历史（等待正在进行的回复写完，避免清空后又被写回）
+        async with data_manager.conversation_lock(key):
+            history = data_manager.get_conversation_history(key) or data_manager.get_conversation_summary(key)
+            if history:
+                async with data_manager.transaction():
+                    await data_manager.update_conversation_history(key, [])
+                    await data_manager.clear_conversation_summary(key)
         if not history:
             await ctx.send("你我之间尚未开启对话，无需重置。", ephemeral=True)
             return
-
-        await data_manager.update_conversation_history(key, [])
         
         await ctx.send("好的，我们重新开始吧。你想聊些什么？", ephemeral=True)
 
     @commands.hybrid_command(name="签到", description="每日签到以获取通用积分。")
+    @checks.state_ready()
     async def checkin(self, ctx: commands.Context):
         """每日签到功能"""
         await ctx.defer(ephemeral=True)
         
         user_id = ctx.author.id
-        user_data = data_manager.get_user_data(user_id)
+        # 读取、计算、写回在该用户的锁内完成，同一用户的并发签到不会重复计分
+        async with data_manager.user_lock(user_id):
+            user_data = data_manager.get_user_data(user_id)
         
-        if not user_data:
-            user_data = {'points': 0, 'last_checkin_date': None, 'consecutive_days': 0}
+            if not user_data:
+                user_data = {'points': 0, 'last_checkin_date': None, 'consecutive_days': 0}
         
-        today = datetime.now().strftime('%Y-%m-%d')
-        last_checkin = user_data.get('last_checkin_date')
+            today = datetime.now().strftime('%Y-%m-%d')
+            last_checkin = user_data.get('last_checkin_date')
         
-        if last_checkin == today:
-            await ctx.send("你今天已经签到过了，明天再来吧！", ephemeral=True)
-            return
+            if last_checkin == today:
+                await ctx.send("你今天已经签到过了，明天再来吧！", ephemeral=True)
+                return
 
-        # 计算连续签到天数
-        consecutive_days = user_data.get('consecutive_days', 0)
-        if last_checkin:
-            try:
-                last_date = datetime.strptime(last_checkin, '%Y-%m-%d')
-                today_date = datetime.strptime(today, '%Y-%m-%d')
-                days_diff = (today_date - last_date).days
+            # 计算连续签到天数
+            consecutive_days = user_data.get('consecutive_days', 0)
+            if last_checkin:
+                try:
+                    last_date = datetime.strptime(last_checkin, '%Y-%m-%d')
+                    today_date = datetime.strptime(today, '%Y-%m-%d')
+                    days_diff = (today_date - last_date).days
                 
-                if days_diff == 1:
-                    consecutive_days += 1
-                elif days_diff > 1:
+                    if days_diff == 1:
+                        consecutive_days += 1
+                    elif days_diff > 1:
+                        consecutive_days = 1
+                    else:
+                        consecutive_days = 1
+                except:
                     consecutive_days = 1
-                else:
-                    consecutive_days = 1
-            except:
+            else:
                 consecutive_days = 1
-        else:
-            consecutive_days = 1
         
-        # 计算积分奖励
-        base_points = 10
-        consecutive_bonus = min(consecutive_days * 2, 20)  # 连续签到奖励，最多20分
-        total_points = base_points + consecutive_bonus
+            # 计算积分奖励
+            base_points = 10
+            consecutive_bonus = min(consecutive_days * 2, 20)  # 连续签到奖励，最多20分
+            total_points = base_points + consecutive_bonus
         
-        # 更新用户数据
-        user_data['points'] = user_data.get('points', 0) + total_points
-        user_data['last_checkin_date'] = today
-        user_data['consecutive_days'] = consecutive_days
+            # 更新用户数据
+            user_data['points'] = user_data.get('points', 0) + total_points
+            user_data['last_checkin_date'] = today
+            user_data['consecutive_days'] = consecutive_days
         
-        await data_manager.update_user_data(user_id, user_data)
+            await data_manager.update_user_data(user_id, user_data)
         
         # 创建签到成功消息
         emb = discord.Embed(title="✅ 签到成功", color=discord.Color.green())
@@ -264,6 +353,7 @@ class SystemsCog(commands.Cog, name="核心系统"):
         purpose="对话的目的或想让AI说的话题"
     )
     @commands.check(checks.is_owner)
+    @checks.state_ready()
     async def sayto(self, ctx: commands.Context, user: discord.User, purpose: str):
         """让机器人发起对话"""
         await ctx.defer(ephemeral=True)
@@ -272,7 +362,9 @@ class SystemsCog(commands.Cog, name="核心系统"):
         prompt = f"请主动以如下目的和 {user.display_name} 发起一段自然的开场白：{purpose}"
         ai_reply = await ai_utils.call_ai(
             [{"role": "user", "content": prompt}],
-            context_for_error_dm="发起对话"
+            context_for_error_dm="发起对话",
+            cache=True,
+            priority=ai_utils.PRIORITY_OWNER
         )
         
         if ai_reply and ai_reply != ai_utils.INTERNAL_AI_ERROR_SIGNAL:
@@ -289,12 +381,12 @@ class SystemsCog(commands.Cog, name="核心系统"):
 
     @commands.hybrid_command(name="清除所有记忆", description="[主人] 清除机器人存储的所有对话历史。")
     @commands.check(checks.is_owner)
+    @checks.state_ready()
     async def clear_all_memory(self, ctx: commands.Context):
         """清除所有用户的对话历史记录"""
         await ctx.defer(ephemeral=True)
         from utils import data_manager
-        data_manager.data["conversation_history"] = {}
-        await data_manager.save_data_to_hf()
+        await data_manager.clear_all_conversation_history()
         await ctx.send("✅ 已清除所有用户的对话历史记录。", ephemeral=True)
 
 async def setup(bot: commands.Bot):
@@ -0,0 +1,60 @@
+# tests/conftest.py
+"""
+测试使用离线模拟的 AI 后端和本地目录作为远端存储，不访问网络。
+data_manager 在导入时读取环境变量，fresh_data_manager 每次按临时目录重新加载模块，
+同一个测试中用相同的目录再次加载即可模拟重启。
+"""
+import os
+import sys
+import asyncio
+import importlib
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ["AI_PROVIDER"] = "fake"
+os.environ["GEMINI_API_KEYS"] = ""
+os.environ["FAKE_GEMINI_LATENCY"] = "fixed:0.001"
+os.environ["FAKE_GEMINI_TOKENS_PER_SECOND"] = "100000"
+os.environ["DATA_BACKEND"] = "local"
+os.environ["DATA_FLUSH_INTERVAL"] = "3600"
+os.environ.pop("HF_TOKEN", None)
+
+
+@pytest.fixture
+def fresh_data_manager(tmp_path, monkeypatch):
+    """返回 load(**env)：设置数据目录后重新加载 data_manager 并返回模块"""
+    loaded = []
+
+    def load(**env):
+        monkeypatch.setenv("DATA_LOCAL_DIR", str(tmp_path / "local"))
+        monkeypatch.setenv("DATA_BACKEND_DIR", str(tmp_path / "remote"))
+        monkeypatch.setenv("DATA_STORE", "json")
+        for name, value in env.items():
+            monkeypatch.setenv(name, str(value))
+        from utils import data_manager
+        module = importlib.reload(data_manager)
+        loaded.append(module)
+        return module
+
+    yield load
+    # 关闭最后一次加载留下的日志和数据库连接
+    module = loaded[-1] if loaded else None
+    if module is not None:
+        if module._journal is not None:
+            module._journal.close()
+        if module._sqlite is not None:
+            module._sqlite.close()
+
+
+@pytest.fixture
+def fresh_ai_utils(fresh_data_manager):
+    """加载空白数据后重新加载 ai_utils：熔断器、key 调度、对冲和准入统计都从头开始"""
+    fresh_data_manager().load_data_from_hf()
+    from utils import ai_utils
+    return importlib.reload(ai_utils)
+
+
+def run(coro):
+    return asyncio.run(coro)
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from utils.admission_queue import (
+    AdmissionQueue, AdmissionRejected,
+    PRIORITY_OWNER, PRIORITY_CHAT, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND,
+)
+from conftest import run
+
+
+def test_waiters_are_admitted_by_priority():
+    async def scenario():
+        queue = AdmissionQueue(max_concurrent=1, max_queue=10, max_wait_seconds=5)
+        await queue.acquire(PRIORITY_CHAT)
+        order = []
+
+        async def waiter(priority, name):
+            async with queue.slot(priority):
+                order.append(name)
+
+        tasks = [
+            asyncio.create_task(waiter(PRIORITY_BACKGROUND, "background")),
+            asyncio.create_task(waiter(PRIORITY_INTERACTIVE, "interactive")),
+            asyncio.create_task(waiter(PRIORITY_OWNER, "owner")),
+            asyncio.create_task(waiter(PRIORITY_CHAT, "chat")),
+        ]
+        await asyncio.sleep(0)
+        queue.release()
+        await asyncio.gather(*tasks)
+        assert queue.in_flight == 0
+        return order
+
+    assert run(scenario()) == ["owner", "chat", "interactive", "background"]
+
+
+def test_full_queue_sheds_lower_priority():
+    async def scenario():
+        queue = AdmissionQueue(max_concurrent=1, max_queue=1, max_wait_seconds=5)
+        await queue.acquire(PRIORITY_CHAT)
+        background = asyncio.create_task(queue.acquire(PRIORITY_BACKGROUND))
+        await asyncio.sleep(0)
+        owner = asyncio.create_task(queue.acquire(PRIORITY_OWNER))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected):
+            await background
+        # 同等或更低优先级的请求不能挤掉队列中的请求
+        with pytest.raises(AdmissionRejected):
+            await queue.acquire(PRIORITY_BACKGROUND)
+        queue.release()
+        await owner
+        queue.release()
+        assert queue.stats()["classes"]["后台"]["shed"] == 2
+
+    run(scenario())
+
+
+def test_wait_times_out():
+    async def scenario():
+        queue = AdmissionQueue(max_concurrent=1, max_queue=4, max_wait_seconds=0.01)
+        await queue.acquire()
+        with pytest.raises(AdmissionRejected):
+            await queue.acquire(PRIORITY_INTERACTIVE)
+        queue.release()
+        assert queue.in_flight == 0
+        assert queue.stats()["queued"] == 0
+
+    run(scenario())
+
+
+def test_cancelled_waiter_passes_the_slot_on():
+    async def scenario():
+        queue = AdmissionQueue(max_concurrent=1, max_queue=4, max_wait_seconds=5)
+        await queue.acquire()
+        cancelled = asyncio.create_task(queue.acquire(PRIORITY_OWNER))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        queue.release()
+        await asyncio.wait_for(queue.acquire(PRIORITY_BACKGROUND), 1)
+        queue.release()
+        assert queue.in_flight == 0
+
+    run(scenario())
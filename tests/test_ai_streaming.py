@@ -0,0 +1,57 @@
+import pytest
+from google.api_core import exceptions as api_exceptions
+
+from conftest import run
+
+
+@pytest.fixture
+def ai_utils(fresh_ai_utils):
+    return fresh_ai_utils
+
+
+class BreaksAfterFirstChunk:
+    """包装流式响应：产出第一个块之后连接中断"""
+
+    def __init__(self, response):
+        self.response = response
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        async for chunk in self.response:
+            yield chunk
+            raise api_exceptions.ServiceUnavailable("连接中断")
+
+
+def collect(ai_utils, messages):
+    async def scenario():
+        return [chunk async for chunk in await ai_utils.call_ai(messages, stream=True)]
+    return run(scenario())
+
+
+def test_complete_stream_has_no_signal(ai_utils):
+    chunks = collect(ai_utils, [{"role": "user", "content": "你好"}])
+    assert chunks
+    assert not set(chunks) & {ai_utils.AI_TRUNCATED_SIGNAL, ai_utils.INTERNAL_AI_ERROR_SIGNAL, ai_utils.AI_BUSY_SIGNAL}
+
+
+def test_broken_stream_ends_with_truncated_signal(ai_utils, monkeypatch):
+    pool = ai_utils.client_pool
+    build_model = pool.model
+
+    def breaking_model(*args, **kwargs):
+        model = build_model(*args, **kwargs)
+        generate = model.generate_content_async
+
+        async def generate_content_async(*args, **kwargs):
+            return BreaksAfterFirstChunk(await generate(*args, **kwargs))
+        model.generate_content_async = generate_content_async
+        return model
+
+    monkeypatch.setattr(pool, "model", breaking_model)
+    chunks = collect(ai_utils, [{"role": "user", "content": "你好"}])
+    assert len(chunks) == 2
+    assert chunks[0] not in (ai_utils.AI_TRUNCATED_SIGNAL, ai_utils.INTERNAL_AI_ERROR_SIGNAL)
+    assert chunks[-1] == ai_utils.AI_TRUNCATED_SIGNAL
+    assert ai_utils.admission.in_flight == 0
@@ -0,0 +1,44 @@
+import pytest
+from google.api_core import exceptions as api_exceptions
+
+from conftest import run
+
+
+@pytest.fixture
+def vision(fresh_ai_utils, monkeypatch):
+    ai_utils = fresh_ai_utils
+    dms = []
+
+    async def send_dm(text):
+        dms.append(text)
+
+    def rejecting_model(*args, **kwargs):
+        model = build_model(*args, **kwargs)
+
+        async def generate_content_async(*args, **kwargs):
+            # 请求不合法：立即放弃，不计入熔断
+            raise api_exceptions.InvalidArgument("bad request")
+        model.generate_content_async = generate_content_async
+        return model
+
+    build_model = ai_utils.client_pool.model
+    monkeypatch.setattr(ai_utils.client_pool, "model", rejecting_model)
+    monkeypatch.setattr(ai_utils, "_send_dm_to_owner_func", send_dm)
+    return ai_utils, dms
+
+
+def describe(ai_utils, **kwargs):
+    return run(ai_utils.call_vision(["描述这张图片", {"mime_type": "image/png", "data": b"png"}], **kwargs))
+
+
+def test_final_failure_notifies_the_owner(vision):
+    ai_utils, dms = vision
+    assert describe(ai_utils) == ai_utils.INTERNAL_AI_ERROR_SIGNAL
+    assert len(dms) == 1
+    assert "AI故障" in dms[0]
+
+
+def test_batch_callers_can_suppress_the_owner_dm(vision):
+    ai_utils, dms = vision
+    assert describe(ai_utils, notify_owner=False) == ai_utils.INTERNAL_AI_ERROR_SIGNAL
+    assert dms == []
@@ -0,0 +1,88 @@
+import pytest
+
+from utils import circuit_breaker
+from utils.circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", lambda: now[0])
+    return now
+
+
+def make_breaker(transitions=None, **kwargs):
+    def on_transition(breaker, old, new):
+        if transitions is not None:
+            transitions.append((old, new))
+    return CircuitBreaker("test", on_transition=on_transition, **kwargs)
+
+
+def test_opens_after_consecutive_failures(clock):
+    transitions = []
+    breaker = make_breaker(transitions, failure_threshold=3, cooldown_seconds=10)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.rejected == 1
+    assert transitions == [(CLOSED, OPEN)]
+
+
+def test_success_resets_failure_count(clock):
+    breaker = make_breaker(failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+
+
+def test_half_open_limits_probes_and_closes_on_success(clock):
+    transitions = []
+    breaker = make_breaker(transitions, failure_threshold=1, cooldown_seconds=10, half_open_max_calls=1)
+    breaker.record_failure()
+    clock[0] += 10
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # 探测名额已被占用
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert transitions == [(CLOSED, OPEN), (OPEN, HALF_OPEN), (HALF_OPEN, CLOSED)]
+
+
+def test_half_open_failure_reopens(clock):
+    breaker = make_breaker(failure_threshold=1, cooldown_seconds=10)
+    breaker.record_failure()
+    clock[0] += 10
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert breaker.times_opened == 2
+    assert breaker.retry_in() == pytest.approx(10)
+
+
+def test_neutral_releases_the_probe_slot(clock):
+    breaker = make_breaker(failure_threshold=1, cooldown_seconds=10)
+    breaker.record_failure()
+    clock[0] += 10
+    assert breaker.allow()
+    breaker.record_neutral()
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()
+
+
+def test_status_reads_do_not_transition(clock):
+    transitions = []
+    breaker = make_breaker(transitions, failure_threshold=1, cooldown_seconds=10)
+    breaker.record_failure()
+    clock[0] += 11
+    assert breaker.peek_state() == HALF_OPEN
+    assert breaker.snapshot()["state"] == HALF_OPEN
+    assert breaker.retry_in() == 0.0
+    assert breaker._state == OPEN
+    assert transitions == [(CLOSED, OPEN)]
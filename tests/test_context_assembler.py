@@ -0,0 +1,65 @@
+from utils.context_assembler import assemble, estimate_text_tokens, estimate_parts_tokens, format_breakdown, IMAGE_TOKENS
+
+
+def turn(role, text):
+    return {"role": role, "parts": [text]}
+
+
+def conversation(count, text="x" * 38):
+    # 每条消息 20 个 token
+    return [turn("user" if i % 2 == 0 else "model", f"{text}{i}") for i in range(count)]
+
+
+def test_token_estimates():
+    assert estimate_text_tokens("") == 0
+    assert estimate_text_tokens("一二三四") == 3
+    assert estimate_parts_tokens(["一二三四", {"mime_type": "image/png", "data": b""}]) == 3 + IMAGE_TOKENS
+
+
+def test_recent_turns_fill_the_budget_from_the_newest():
+    turns = conversation(10)
+    result = assemble(100, core="", turns=turns)
+    # 80 个 token 放得下最近 4 条，且上下文以用户消息开头
+    assert result["turns"] == turns[-4:]
+    assert result["dropped"]["turns"] == 6
+    assert result["breakdown"]["turns"] == 80
+
+    result = assemble(90, core="", turns=turns)
+    assert result["turns"] == turns[-4:]
+    # 只剩 3 条时第一条是模型回复，也要丢掉
+    result = assemble(70, core="", turns=turns)
+    assert result["turns"] == turns[-2:]
+
+
+def test_newest_turn_is_kept_even_over_budget():
+    turns = conversation(3, text="x" * 400)
+    result = assemble(50, core="核心" * 100, turns=turns)
+    assert result["turns"] == turns[-1:]
+    assert result["breakdown"]["total"] > result["breakdown"]["budget"]
+
+
+def test_lower_priority_sections_get_what_is_left():
+    turns = conversation(2)
+    result = assemble(
+        100, core="x" * 18, persona="y" * 18, turns=turns,
+        summary="总结" * 50, summary_header="总结：",
+        emoji_header="表情：", emoji_lines=["a" * 8, "b" * 8],
+        memory_header="记忆：", memory_lines=["旧" * 8, "新" * 8],
+    )
+    breakdown = result["breakdown"]
+    assert (breakdown["core"], breakdown["persona"], breakdown["turns"]) == (10, 10, 40)
+    # 总结按剩下的 40 个 token 截断，表情和记忆就都放不下了
+    assert result["summary"] == ("总结" * 50)[:74]
+    assert result["dropped"]["summary_chars"] == 100 - 74
+    assert (result["emoji_lines"], result["memory_lines"]) == ([], [])
+    assert breakdown["total"] <= 100
+
+    result = assemble(
+        64, core="", turns=turns, emoji_header="表情：", emoji_lines=["a" * 8, "b" * 8],
+        memory_header="记忆：", memory_lines=["旧" * 8, "新" * 8],
+    )
+    assert result["emoji_lines"] == ["a" * 8, "b" * 8]
+    # 全局记忆放不下全部时保留最新的
+    assert result["memory_lines"] == ["新" * 8]
+    assert result["dropped"] == {"turns": 0, "emojis": 0, "memory": 1, "summary_chars": 0}
+    assert format_breakdown(result["breakdown"]).startswith(f"{result['breakdown']['total']}/64 tokens")
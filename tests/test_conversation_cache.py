@@ -0,0 +1,106 @@
+from utils.conversation_cache import ConversationCache, ColdStore
+from conftest import run
+
+
+def make_caches(tmp_path, max_entries=2):
+    leader = ConversationCache(ColdStore(str(tmp_path / "history")), max_entries=max_entries, max_bytes=1 << 20)
+    follower = ConversationCache(ColdStore(str(tmp_path / "summaries")), max_entries=max_entries, max_bytes=1 << 20, leader=leader)
+    return leader, follower
+
+
+def test_least_recently_used_conversation_is_spilled(tmp_path):
+    cache = ConversationCache(ColdStore(str(tmp_path / "cold")), max_entries=2, max_bytes=1 << 20)
+    cache["a"] = ["a"]
+    cache["b"] = ["b"]
+    assert cache["a"] == ["a"]
+    cache["c"] = ["c"]
+    # b 最久没有被访问
+    assert list(cache._hot) == ["a", "c"]
+    assert cache.stats()["cold_entries"] == 1
+    assert cache["b"] == ["b"]
+    assert "b" in cache._hot
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (1, 1, 2)
+    assert sorted(cache) == ["a", "b", "c"]
+    assert len(cache) == 3
+
+
+def test_byte_budget_limits_resident_conversations(tmp_path):
+    cache = ConversationCache(ColdStore(str(tmp_path / "cold")), max_entries=100, max_bytes=250)
+    for key in "abcde":
+        cache[key] = ["x" * 100]
+    stats = cache.stats()
+    assert stats["hot_bytes"] <= 250
+    assert stats["hot_entries"] + stats["cold_entries"] == 5
+    # 单个对话超过预算时仍然保留在内存中
+    cache["big"] = ["x" * 1000]
+    assert list(cache._hot) == ["big"]
+    assert all(cache.peek(key) == ["x" * 100] for key in "abcde")
+
+
+def test_deleting_a_cold_conversation_removes_its_file(tmp_path):
+    store = ColdStore(str(tmp_path / "cold"))
+    cache = ConversationCache(store, max_entries=1, max_bytes=1 << 20)
+    cache["a"] = ["a"]
+    cache["b"] = ["b"]
+    del cache["a"]
+    assert "a" not in cache
+    assert store.read("a") is None
+    assert cache.get("a") is None
+
+
+def test_cold_conversations_survive_a_restart(fresh_data_manager):
+    dm = fresh_data_manager(DATA_CONVERSATION_CACHE_ENTRIES=2)
+    dm.load_data_from_hf()
+    histories = {f"c{i}": [{"role": "user", "content": str(i)}] for i in range(6)}
+
+    async def scenario():
+        for key, history in histories.items():
+            await dm.update_conversation_history(key, history)
+        assert await dm.flush(force=True)
+        await dm.stop_background_flusher()
+    run(scenario())
+    stats = dm.get_conversation_cache_stats()
+    assert (stats["hot_entries"], stats["cold_entries"], stats["evictions"]) == (2, 4, 4)
+
+    dm = fresh_data_manager(DATA_CONVERSATION_CACHE_ENTRIES=2)
+    dm.load_data_from_hf()
+    assert {key: dm.get_conversation_history(key) for key in histories} == histories
+    assert dm.get_conversation_cache_stats()["hot_entries"] == 2
+
+
+def test_follower_is_evicted_with_its_conversation(tmp_path):
+    leader, follower = make_caches(tmp_path)
+    for key in ("a", "b"):
+        leader[key] = [key]
+        follower[key] = f"总结 {key}"
+    leader["c"] = ["c"]
+    # a 的对话历史被淘汰，总结一起写入冷存储
+    assert "a" not in leader._hot
+    assert "a" not in follower._hot
+    assert follower.stats()["cold_entries"] == 1
+    assert follower["a"] == "总结 a"
+    # 对话历史不在内存中时，读取总结不会把它放回内存
+    assert "a" not in follower._hot
+    assert follower.peek("b") == "总结 b"
+
+
+def test_follower_write_for_cold_conversation_goes_to_disk(tmp_path):
+    leader, follower = make_caches(tmp_path, max_entries=1)
+    leader["a"] = ["a"]
+    leader["b"] = ["b"]
+    follower["a"] = "总结 a"
+    assert "a" not in follower._hot
+    assert follower["a"] == "总结 a"
+    # 对话历史读回内存之后，总结在下次访问时常驻
+    assert leader["a"] == ["a"]
+    assert follower["a"] == "总结 a"
+    assert "a" in follower._hot
+
+
+def test_follower_load_keeps_only_resident_conversations(tmp_path):
+    leader, follower = make_caches(tmp_path)
+    leader.load({key: [key] for key in "abcd"})
+    follower.load({key: f"总结 {key}" for key in "abcd"})
+    assert set(follower._hot) == set(leader._hot)
+    assert dict((key, follower.peek(key)) for key in follower) == {key: f"总结 {key}" for key in "abcd"}
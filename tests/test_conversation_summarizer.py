@@ -0,0 +1,141 @@
+import asyncio
+
+import pytest
+
+from conftest import run
+
+
+@pytest.fixture
+def env(fresh_ai_utils):
+    from utils import data_manager, conversation_summarizer
+    return data_manager, fresh_ai_utils, conversation_summarizer
+
+
+def turns(count):
+    return [{"role": "user" if i % 2 == 0 else "model", "content": f"第 {i} 条"} for i in range(count)]
+
+
+def test_old_turns_are_folded_into_the_summary(env):
+    dm, ai_utils, conversation_summarizer = env
+    summarizer = conversation_summarizer.RollingSummarizer(trigger_turns=10, keep_turns=4)
+
+    async def scenario():
+        await dm.update_conversation_history("dm_1", turns(12))
+        assert summarizer.schedule("dm_1") is not None
+        # 同一个对话同时只有一个总结任务
+        assert summarizer.schedule("dm_1") is None
+        assert await summarizer.drain(timeout=5)
+        await dm.stop_background_flusher()
+    run(scenario())
+
+    history = dm.get_conversation_history("dm_1")
+    assert history == turns(12)[8:]
+    assert history[0]["role"] == "user"
+    assert dm.get_conversation_summary("dm_1")
+    assert dm.data["conversation_summaries"]["dm_1"]["folded_turns"] == 8
+    assert summarizer.stats()["completed"] == 1
+
+
+def test_summary_is_discarded_when_history_changed(env, monkeypatch):
+    dm, ai_utils, conversation_summarizer = env
+    summarizer = conversation_summarizer.RollingSummarizer(trigger_turns=10, keep_turns=4)
+
+    async def call_ai_while_cleared(messages, **kwargs):
+        # 总结进行期间用户清除了记忆
+        await dm.update_conversation_history("dm_1", [])
+        return "过时的总结"
+
+    monkeypatch.setattr(ai_utils, "call_ai", call_ai_while_cleared)
+
+    async def scenario():
+        await dm.update_conversation_history("dm_1", turns(12))
+        summarizer.schedule("dm_1")
+        await summarizer.drain(timeout=5)
+        await dm.stop_background_flusher()
+    run(scenario())
+
+    assert dm.get_conversation_history("dm_1") == []
+    assert dm.get_conversation_summary("dm_1") == ""
+    assert summarizer.stats()["discarded"] == 1
+
+
+def test_failed_call_keeps_history(env, monkeypatch):
+    dm, ai_utils, conversation_summarizer = env
+    summarizer = conversation_summarizer.RollingSummarizer(trigger_turns=10, keep_turns=4)
+
+    async def failing_call_ai(messages, **kwargs):
+        return ai_utils.INTERNAL_AI_ERROR_SIGNAL
+
+    monkeypatch.setattr(ai_utils, "call_ai", failing_call_ai)
+
+    async def scenario():
+        await dm.update_conversation_history("dm_1", turns(12))
+        summarizer.schedule("dm_1")
+        await summarizer.drain(timeout=5)
+        await dm.stop_background_flusher()
+    run(scenario())
+
+    assert dm.get_conversation_history("dm_1") == turns(12)
+    assert summarizer.stats()["failed"] == 1
+
+
+def test_drain_cancels_after_timeout(env, monkeypatch):
+    dm, ai_utils, conversation_summarizer = env
+    summarizer = conversation_summarizer.RollingSummarizer(trigger_turns=10, keep_turns=4)
+
+    async def hanging_call_ai(messages, **kwargs):
+        await asyncio.sleep(60)
+
+    monkeypatch.setattr(ai_utils, "call_ai", hanging_call_ai)
+
+    async def scenario():
+        await dm.update_conversation_history("dm_1", turns(12))
+        summarizer.schedule("dm_1")
+        assert not await summarizer.drain(timeout=0.05)
+        await dm.stop_background_flusher()
+    run(scenario())
+
+    assert dm.get_conversation_history("dm_1") == turns(12)
+    assert summarizer.stats()["running"] == 0
+
+
+def test_summaries_follow_the_conversation_cache(fresh_data_manager, tmp_path):
+    dm = fresh_data_manager(DATA_CONVERSATION_CACHE_ENTRIES=2)
+    dm.load_data_from_hf()
+
+    async def scenario():
+        for i in range(5):
+            await dm.update_conversation_history(f"c{i}", [{"role": "user", "content": str(i)}])
+            await dm.set_conversation_summary(f"c{i}", f"总结 {i}", 2)
+        assert await dm.flush(force=True)
+        await dm.stop_background_flusher()
+    run(scenario())
+
+    for section in ("conversation_summaries", "conversation_last_active"):
+        assert dm.data[section].stats()["hot_entries"] <= 2
+    assert [dm.get_conversation_summary(f"c{i}") for i in range(5)] == [f"总结 {i}" for i in range(5)]
+
+    # 冷存储中的总结同样写进了快照
+    dm = fresh_data_manager(DATA_CONVERSATION_CACHE_ENTRIES=2)
+    dm.load_data_from_hf()
+    assert [dm.get_conversation_summary(f"c{i}") for i in range(5)] == [f"总结 {i}" for i in range(5)]
+
+
+def test_idle_conversations_expire_from_cold_storage(fresh_data_manager, monkeypatch):
+    dm = fresh_data_manager(DATA_CONVERSATION_CACHE_ENTRIES=1, DATA_CONVERSATION_TTL_DAYS=30)
+    dm.load_data_from_hf()
+    today = dm._today()
+
+    async def scenario():
+        monkeypatch.setattr(dm, "_today", lambda: today - 40)
+        await dm.update_conversation_history("old", [{"role": "user", "content": "很久以前"}])
+        await dm.set_conversation_summary("old", "旧总结", 2)
+        monkeypatch.setattr(dm, "_today", lambda: today)
+        await dm.update_conversation_history("new", [{"role": "user", "content": "今天"}])
+        assert "old" not in dm.data["conversation_last_active"]._hot
+        assert await dm.expire_idle_conversations() == 1
+        await dm.stop_background_flusher()
+    run(scenario())
+    assert "old" not in dm.data["conversation_history"]
+    assert dm.get_conversation_summary("old") == ""
+    assert list(dm.data["conversation_last_active"]) == ["new"]
@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+from google.api_core import exceptions as api_exceptions
+
+from utils.fake_gemini import fake_embedding
+from conftest import run
+
+
+@pytest.fixture
+def embedding(fresh_ai_utils, monkeypatch):
+    """返回 (ai_utils, 每次请求的批次列表)；包含 "限流" 的批次总是被限流"""
+    ai_utils = fresh_ai_utils
+    monkeypatch.setattr(ai_utils, "EMBEDDING_BATCH_SIZE", 2)
+    monkeypatch.setattr(ai_utils, "EMBEDDING_CONCURRENCY", 2)
+    pool = ai_utils.client_pool
+    embed_content = pool.embed_content
+    batches = []
+    running = [0, 0]
+
+    async def recording_embed_content(api_key, content=None, **kwargs):
+        batches.append(list(content))
+        running[0] += 1
+        running[1] = max(running[1], running[0])
+        try:
+            await asyncio.sleep(0.01)
+            if "限流" in content:
+                raise api_exceptions.ResourceExhausted("quota")
+            return await embed_content(api_key, content=content, **kwargs)
+        finally:
+            running[0] -= 1
+
+    monkeypatch.setattr(pool, "embed_content", recording_embed_content)
+    return ai_utils, batches, running
+
+
+def test_embeddings_are_deduplicated_batched_and_aligned(embedding):
+    ai_utils, batches, running = embedding
+    texts = ["a", "b", "a", "", "c", "d", "e", "b", None]
+    vectors = run(ai_utils.get_text_embeddings(texts))
+    assert vectors == [fake_embedding(text) if text else None for text in texts]
+    # 去重后 5 条文本，每批 2 条
+    assert sorted(batches) == [["a", "b"], ["c", "d"], ["e"]]
+    assert running[1] == 2
+
+
+def test_failed_batch_is_retried_and_left_empty(embedding, monkeypatch):
+    ai_utils, batches, _ = embedding
+    dms = []
+
+    async def send_dm(message):
+        dms.append(message)
+    monkeypatch.setattr(ai_utils, "_send_dm_to_owner_func", send_dm)
+    vectors = run(ai_utils.get_text_embeddings(["a", "b", "限流", "c"]))
+    assert vectors[:2] == [fake_embedding("a"), fake_embedding("b")]
+    assert vectors[2:] == [None, None]
+    # 被限流的批次每次都换一个 key 重试
+    assert batches.count(["限流", "c"]) == ai_utils.EMBEDDING_MAX_RETRIES
+    assert len(dms) == 1
+
+
+def test_single_text_helper(embedding):
+    ai_utils, batches, _ = embedding
+    assert run(ai_utils.get_text_embedding("你好")) == fake_embedding("你好")
+    assert batches == [["你好"]]
@@ -0,0 +1,85 @@
+import math
+import random
+
+import pytest
+from google.api_core import exceptions as api_exceptions
+
+from utils.fake_gemini import FakeGeminiPool, parse_latency, parse_error_rates, fake_embedding, fake_keys
+from conftest import run
+
+
+def make_pool(**kwargs):
+    kwargs.setdefault("latency", "fixed:0")
+    kwargs.setdefault("tokens_per_second", 1e6)
+    kwargs.setdefault("seed", 1)
+    return FakeGeminiPool(**kwargs)
+
+
+def test_latency_specs():
+    rng = random.Random(0)
+    assert parse_latency("fixed:0.5")(rng) == 0.5
+    assert all(1 <= parse_latency("uniform:1,2")(rng) <= 2 for _ in range(20))
+    assert parse_latency("exponential:1")(rng) > 0
+    assert parse_latency("lognormal:0.8,0.5")(rng) > 0
+    for spec in ("fixed", "uniform:1", "normal:1,2"):
+        with pytest.raises(ValueError):
+            parse_latency(spec)
+
+
+def test_error_rate_specs():
+    assert parse_error_rates("429:0.05, 500:0.02,blocked:0.01") == {"429": 0.05, "500": 0.02, "blocked": 0.01}
+    assert parse_error_rates("") == {}
+    with pytest.raises(ValueError):
+        parse_error_rates("404:0.1")
+    with pytest.raises(ValueError):
+        parse_error_rates("429:0.6,500:0.6")
+
+
+def test_embeddings_are_deterministic_and_normalised():
+    vector = fake_embedding("你好", dim=16)
+    assert vector == fake_embedding("你好", dim=16)
+    assert vector != fake_embedding("再见", dim=16)
+    assert math.isclose(sum(value * value for value in vector), 1.0)
+    pool = make_pool(embedding_dim=16)
+    assert run(pool.embed_content("k", content=["你好", "再见"]))["embedding"] == [vector, fake_embedding("再见", dim=16)]
+    assert run(pool.embed_content("k", content="你好"))["embedding"] == vector
+
+
+def test_injected_errors():
+    pool = make_pool(error_rates="429:1", retry_after=7)
+    model = pool.model("k", "fake-model")
+    with pytest.raises(api_exceptions.ResourceExhausted, match="retry in 7s"):
+        run(model.generate_content_async("你好"))
+    with pytest.raises(api_exceptions.InternalServerError):
+        run(make_pool(error_rates="500:1").model("k", "m").generate_content_async("你好"))
+    blocked = run(make_pool(error_rates="blocked:1").model("k", "m").generate_content_async("你好"))
+    assert blocked.prompt_feedback.block_reason.name == "SAFETY"
+    assert blocked.candidates == []
+    assert pool.stats()["injected"]["429"] == 1
+
+
+def test_per_key_rpm_limit():
+    pool = make_pool(key_rpm=2)
+    a, b = fake_keys(2)
+    for _ in range(2):
+        run(pool.model(a, "m").generate_content_async("你好"))
+    with pytest.raises(api_exceptions.ResourceExhausted):
+        run(pool.model(a, "m").generate_content_async("你好"))
+    # 其他 key 不受影响
+    run(pool.model(b, "m").generate_content_async("你好"))
+    assert pool.stats()["injected"]["quota"] == 1
+
+
+def test_streaming_matches_the_full_reply():
+    pool = make_pool(stream_chunk_chars=4, reply_tokens=20)
+
+    async def scenario():
+        response = await pool.model("k", "m").generate_content_async("你好", stream=True)
+        chunks = [chunk.text async for chunk in response]
+        return chunks, response.usage_metadata
+
+    chunks, usage = run(scenario())
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 4 for chunk in chunks)
+    assert usage is not None
+    assert pool.stats()["output_tokens"] == usage.candidates_token_count
@@ -0,0 +1,142 @@
+import asyncio
+
+import pytest
+from google.api_core import exceptions as api_exceptions
+
+from utils.circuit_breaker import CircuitBreaker
+from utils.hedging import HedgePolicy, run_hedged
+from conftest import run
+
+
+def warmed_policy(delay=0.01, **kwargs):
+    policy = HedgePolicy(min_samples=1, **kwargs)
+    policy.latency.record(delay)
+    return policy
+
+
+def test_no_hedge_without_samples():
+    async def attempt():
+        return "ok"
+
+    policy = HedgePolicy(min_samples=5)
+    assert run(run_hedged(policy, attempt)) == "ok"
+    assert policy.hedged == 0
+
+
+def test_slow_primary_is_hedged_and_cancelled():
+    calls = []
+    cancelled = []
+
+    async def attempt():
+        index = len(calls)
+        calls.append(index)
+        try:
+            await asyncio.sleep(1 if index == 0 else 0.001)
+        except asyncio.CancelledError:
+            cancelled.append(index)
+            raise
+        return index
+
+    policy = warmed_policy(max_ratio=1)
+    assert run(run_hedged(policy, attempt)) == 1
+    assert cancelled == [0]
+    assert (policy.hedged, policy.hedge_wins) == (1, 1)
+
+
+def test_both_failing_raises_primary_error():
+    calls = []
+
+    async def attempt():
+        calls.append(None)
+        await asyncio.sleep(0.05 if len(calls) == 1 else 0)
+        raise RuntimeError(f"attempt {len(calls)}")
+
+    policy = warmed_policy(max_ratio=1)
+    with pytest.raises(RuntimeError, match="attempt"):
+        run(run_hedged(policy, attempt))
+
+
+def test_hedge_flags_belong_to_the_call_that_hedged():
+    async def scenario():
+        policy = warmed_policy(max_ratio=0.5)
+
+        async def slow():
+            await asyncio.sleep(0.05)
+            return "slow"
+
+        async def fast():
+            return "fast"
+
+        results = await asyncio.gather(run_hedged(policy, slow), run_hedged(policy, fast))
+        return policy, results
+
+    policy, results = run(scenario())
+    assert results == ["slow", "fast"]
+    # 快的调用先结束且没有对冲，慢的调用后结束且对冲过
+    assert list(policy._recent) == [False, True]
+    assert policy._hedging == 0
+
+
+def test_ratio_cap_counts_in_flight_hedges():
+    policy = warmed_policy(max_ratio=0.5)
+    policy.finish_call(False)
+    policy.finish_call(False)
+    assert policy.try_hedge()
+    # 第一次对冲还没有结束，也计入比例
+    assert not policy.try_hedge()
+    assert policy.capped == 1
+
+
+def test_unused_success_is_discarded():
+    discarded = []
+
+    async def scenario():
+        policy = warmed_policy(max_ratio=1)
+        gate = asyncio.Event()
+        names = iter(["primary", "hedge"])
+
+        async def attempt():
+            name = next(names)
+            # 两份请求在同一轮事件循环中完成
+            await gate.wait()
+            return name
+
+        async def open_gate():
+            await asyncio.sleep(0.05)
+            gate.set()
+
+        opener = asyncio.create_task(open_gate())
+        winner = await run_hedged(policy, attempt, discard=discarded.append)
+        await opener
+        return winner
+
+    winner = run(scenario())
+    assert discarded == [{"primary": "hedge", "hedge": "primary"}[winner]]
+
+
+def test_hedged_call_records_one_breaker_outcome_per_attempt(fresh_ai_utils, monkeypatch):
+    ai_utils = fresh_ai_utils
+    breaker = CircuitBreaker("test", failure_threshold=100)
+    allowed = []
+    allow = breaker.allow
+    monkeypatch.setattr(breaker, "allow", lambda: allowed.append(None) or allow())
+    monkeypatch.setattr(ai_utils, "ai_breaker", breaker)
+    policy = warmed_policy(delay=0.001, max_ratio=1)
+    monkeypatch.setattr(ai_utils, "hedge_policy", policy)
+    build_model = ai_utils.client_pool.model
+
+    def failing_model(*args, **kwargs):
+        model = build_model(*args, **kwargs)
+
+        async def generate_content_async(*args, **kwargs):
+            await asyncio.sleep(0.01)
+            raise api_exceptions.ServiceUnavailable("503")
+        model.generate_content_async = generate_content_async
+        return model
+
+    monkeypatch.setattr(ai_utils.client_pool, "model", failing_model)
+    reply = run(ai_utils.call_ai([{"role": "user", "content": "你好"}], hedge=True))
+    assert reply == ai_utils.INTERNAL_AI_ERROR_SIGNAL
+    assert policy.hedged >= 1
+    # 两份请求都失败，但每次 allow() 只记录一次失败
+    assert breaker._consecutive_failures == len(allowed)
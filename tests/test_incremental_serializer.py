@@ -0,0 +1,41 @@
+from utils import snapshot_format
+from utils.incremental_serializer import IncrementalSerializer
+
+
+def test_incremental_serializer_matches_full_encoding():
+    serializer = IncrementalSerializer(compact_ratio=10)
+    value = {f"k{i}": {"n": i, "text": "x" * 50} for i in range(100)}
+    serializer.encode("f", value)
+    assert serializer.encode("f", value) is not None
+    assert serializer.stats()["reused"] == 1
+
+    value["k1"] = {"n": -1}
+    value["new"] = [1, 2, 3]
+    del value["k2"]
+    for key in ("k1", "new", "k2"):
+        serializer.invalidate("f", key)
+    raw = serializer.encode("f", value)
+    assert snapshot_format.decode(raw) == value
+    stats = serializer.stats()
+    assert stats["delta_encodes"] == 1
+    assert stats["fragments_encoded"] == 2
+
+
+def test_incremental_serializer_compacts_large_deltas():
+    serializer = IncrementalSerializer(compact_ratio=0.01)
+    value = {str(i): i for i in range(50)}
+    serializer.encode("f", value)
+    for i in range(25):
+        value[str(i)] = -i
+        serializer.invalidate("f", str(i))
+    assert snapshot_format.decode(serializer.encode("f", value)) == value
+    assert serializer.stats()["full_encodes"] == 2
+
+
+def test_untracked_changes_fall_back_to_full_encoding():
+    serializer = IncrementalSerializer()
+    value = {"a": 1}
+    serializer.encode("f", value)
+    value["b"] = 2
+    # 没有调用 invalidate()：key 数量变化后不再信任缓存
+    assert snapshot_format.decode(serializer.encode("f", value)) == value
@@ -0,0 +1,65 @@
+import asyncio
+
+from conftest import run
+
+
+def start(dm):
+    async def scenario():
+        await dm.finish_loading(dm.load_local_snapshot())
+    run(scenario())
+
+
+def test_concurrent_read_modify_write_is_not_lost(fresh_data_manager):
+    dm = fresh_data_manager()
+    start(dm)
+
+    async def reply(key, text):
+        # 模拟 on_message：读取历史，等待 AI，再写回
+        async with dm.conversation_lock(key):
+            history = dm.get_conversation_history(key)
+            await asyncio.sleep(0.01)
+            await dm.update_conversation_history(key, history + [{"role": "user", "content": text}])
+
+    async def scenario():
+        await asyncio.gather(*(reply("dm_1", str(i)) for i in range(5)))
+        await dm.stop_background_flusher()
+    run(scenario())
+    assert [entry["content"] for entry in dm.get_conversation_history("dm_1")] == [str(i) for i in range(5)]
+    assert dm._key_locks == {}
+
+
+def test_modify_user_data_serializes_per_user(fresh_data_manager):
+    dm = fresh_data_manager()
+    start(dm)
+
+    def add_point(user_data):
+        user_data["points"] = user_data.get("points", 0) + 1
+
+    async def scenario():
+        await asyncio.gather(*(dm.modify_user_data(user_id, add_point) for user_id in (1, 2) for _ in range(10)))
+        # mutator 返回 False 时放弃修改
+        result = await dm.modify_user_data(1, lambda user_data: False)
+        assert result == {"points": 10}
+        assert await dm.modify_user_data(3, lambda user_data: False, default={"points": 0}) == {"points": 0}
+        await dm.stop_background_flusher()
+    run(scenario())
+    assert dm.get_user_data(1) == {"points": 10}
+    assert dm.get_user_data(2) == {"points": 10}
+    assert dm.get_user_data(3) is None
+
+
+def test_different_keys_do_not_block_each_other(fresh_data_manager):
+    dm = fresh_data_manager()
+    start(dm)
+
+    async def scenario():
+        async with dm.user_lock(1):
+            # 持有用户 1 的锁时，用户 2 的修改可以立即完成
+            await asyncio.wait_for(dm.modify_user_data(2, lambda user_data: user_data.update(points=1)), timeout=1)
+            other = asyncio.create_task(dm.modify_user_data(1, lambda user_data: user_data.update(points=1)))
+            await asyncio.sleep(0.01)
+            assert not other.done()
+        await other
+        await dm.stop_background_flusher()
+    run(scenario())
+    assert dm.get_user_data(1) == {"points": 1}
@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from utils import key_scheduler
+from utils.key_scheduler import KeyScheduler
+from conftest import run
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """假时钟：排队时的 sleep 直接把时钟往前拨"""
+    now = [1000.0]
+    real_sleep = asyncio.sleep
+
+    async def sleep(seconds):
+        now[0] += seconds
+        await real_sleep(0)
+
+    monkeypatch.setattr(key_scheduler.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(key_scheduler.asyncio, "sleep", sleep)
+    return now
+
+
+def acquire(scheduler, **kwargs):
+    return run(scheduler.acquire(**kwargs))
+
+
+def test_failing_key_is_avoided(clock):
+    scheduler = KeyScheduler(["key-aaaa", "key-bbbb"])
+    lease = acquire(scheduler)
+    assert lease.key == "key-aaaa"
+    lease.failed()
+    assert acquire(scheduler).key == "key-bbbb"
+    stats = scheduler.stats()["keys"]
+    assert (stats[0]["errors"], stats[0]["error_rate"], stats[1]["in_flight"]) == (1, 1.0, 1)
+
+
+def test_rate_limited_key_cools_down_with_backoff(clock):
+    scheduler = KeyScheduler(["key-aaaa", "key-bbbb"], cooldown_seconds=60)
+    lease = acquire(scheduler)
+    lease.failed(rate_limited=True)
+    assert lease.rate_limit_streak == 1
+    assert acquire(scheduler, exclude=()).key == "key-bbbb"
+    assert scheduler.stats()["keys"][0]["cooldown_s"] == 60
+
+    clock[0] += 61
+    lease = acquire(scheduler, exclude=("key-bbbb",))
+    assert lease.key == "key-aaaa"
+    lease.failed(rate_limited=True)
+    # 连续限流时冷却时间翻倍
+    assert scheduler.stats()["keys"][0]["cooldown_s"] == 120
+
+    clock[0] += 121
+    lease = acquire(scheduler, exclude=("key-bbbb",))
+    lease.failed(rate_limited=True, retry_after=5)
+    # 服务端给出的重试时间优先
+    assert scheduler.stats()["keys"][0]["cooldown_s"] == 5
+
+
+def test_requests_per_minute_budget(clock):
+    scheduler = KeyScheduler(["key-aaaa"], rpm=2)
+    for _ in range(2):
+        acquire(scheduler).succeeded()
+    assert acquire(scheduler, max_wait=0) is None
+    assert scheduler.stats()["gave_up"] == 1
+    clock[0] += 30
+    assert acquire(scheduler, max_wait=0).key == "key-aaaa"
+
+
+def test_tokens_per_minute_budget_uses_actual_usage(clock):
+    scheduler = KeyScheduler(["key-aaaa"], tpm=1000)
+    lease = acquire(scheduler, estimated_tokens=800)
+    assert acquire(scheduler, estimated_tokens=800, max_wait=0) is None
+    # 实际只用了 200 个 token，多扣的额度退回
+    lease.succeeded(tokens_used=200)
+    assert acquire(scheduler, estimated_tokens=800, max_wait=0) is not None
+
+
+def test_callers_queue_until_a_key_recovers(clock):
+    scheduler = KeyScheduler(["key-aaaa", "key-bbbb"], cooldown_seconds=10, max_wait_seconds=30)
+    for _ in range(2):
+        acquire(scheduler).failed(rate_limited=True)
+    started = clock[0]
+    lease = acquire(scheduler)
+    assert lease is not None
+    assert clock[0] - started == pytest.approx(10)
+    stats = scheduler.stats()
+    assert (stats["queued"], stats["gave_up"], stats["avg_queue_wait_s"]) == (1, 0, 10.0)
+
+    for _ in range(2):
+        acquire(scheduler, exclude=(lease.key,)).failed(rate_limited=True)
+    lease.failed(rate_limited=True)
+    # 最早恢复的 key 也要等得比 max_wait 更久：放弃
+    assert acquire(scheduler, max_wait=5) is None
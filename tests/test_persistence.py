@@ -0,0 +1,181 @@
+import json
+import shutil
+import asyncio
+import zlib
+
+from utils import snapshot_format
+from conftest import run
+
+
+def start(dm):
+    """模拟 bot.py 的两阶段启动"""
+    async def scenario():
+        await dm.finish_loading(dm.load_local_snapshot())
+    run(scenario())
+
+
+def write_user(dm, user_id, points, flush=True):
+    async def scenario():
+        await dm.update_user_data(user_id, {"points": points})
+        if flush:
+            assert await dm.flush(force=True)
+        await dm.stop_background_flusher()
+    run(scenario())
+
+
+def remote_file(dm, path):
+    return dm._get_backend().read(path)
+
+
+def test_round_trip_through_remote(fresh_data_manager, tmp_path):
+    dm = fresh_data_manager()
+    start(dm)
+
+    async def scenario():
+        await dm.update_user_data(7, {"points": 3, "name": "米尔可"})
+        await dm.update_conversation_history("dm_7", [{"role": "user", "content": "你好"}, {"role": "model", "content": "你好呀"}])
+        await dm.add_filtered_word("坏词")
+        assert await dm.flush(force=True)
+        await dm.stop_background_flusher()
+    run(scenario())
+
+    # 本地快照丢失后从远端完整加载
+    shutil.rmtree(tmp_path / "local")
+    dm = fresh_data_manager()
+    start(dm)
+    assert dm.get_user_data(7) == {"points": 3, "name": "米尔可"}
+    assert dm.get_conversation_history("dm_7")[1]["content"] == "你好呀"
+    assert "坏词" in dm.get_filtered_words()
+
+
+def test_journal_replay_after_crash(fresh_data_manager):
+    dm = fresh_data_manager()
+    start(dm)
+
+    async def scenario():
+        await dm.update_user_data(1, {"points": 1})
+        await dm.update_user_data(1, {"points": 2})
+        await dm.update_conversation_history("c", [{"role": "user", "content": "还没上传"}])
+    run(scenario())
+    # 没有刷新就退出：修改只在本地日志中
+    dm._journal.close()
+    assert remote_file(dm, dm.MANIFEST_FILENAME) is None
+
+    dm = fresh_data_manager()
+    assert dm.load_local_snapshot()
+    assert dm.get_user_data(1) == {"points": 2}
+    assert dm.get_conversation_history("c") == [{"role": "user", "content": "还没上传"}]
+
+
+def test_newer_remote_is_swapped_in_on_the_loop(fresh_data_manager, tmp_path):
+    dm = fresh_data_manager()
+    start(dm)
+    write_user(dm, 1, 1)
+    shutil.copytree(tmp_path / "local", tmp_path / "old_local")
+
+    dm = fresh_data_manager()
+    start(dm)
+    write_user(dm, 1, 2)
+    shutil.rmtree(tmp_path / "local")
+    shutil.copytree(tmp_path / "old_local", tmp_path / "local")
+
+    dm = fresh_data_manager()
+    live = dm.data
+    assert dm.load_local_snapshot()
+    assert dm.get_user_data(1) == {"points": 1}
+
+    async def scenario():
+        loading = asyncio.create_task(dm.finish_loading(True))
+        # 核对线程运行期间，其他协程看到的始终是完整的旧数据
+        while not loading.done():
+            assert dm.data["user_data"].get(1) == {"points": 1}
+            await asyncio.sleep(0)
+        await loading
+    run(scenario())
+    assert dm.data is live
+    assert dm.is_ready()
+    assert dm.get_user_data(1) == {"points": 2}
+    local_manifest = json.loads((tmp_path / "local" / dm.MANIFEST_FILENAME).read_text(encoding="utf-8"))
+    assert local_manifest["generation"] == dm._generation
+
+
+def test_cancelled_load_keeps_local_state(fresh_data_manager, tmp_path):
+    dm = fresh_data_manager()
+    start(dm)
+    write_user(dm, 1, 1)
+    shutil.copytree(tmp_path / "local", tmp_path / "old_local")
+    dm = fresh_data_manager()
+    start(dm)
+    write_user(dm, 1, 2)
+    shutil.rmtree(tmp_path / "local")
+    shutil.copytree(tmp_path / "old_local", tmp_path / "local")
+    old_manifest = (tmp_path / "local" / dm.MANIFEST_FILENAME).read_bytes()
+
+    dm = fresh_data_manager()
+    found = dm.load_local_snapshot()
+
+    async def scenario():
+        dm.cancel_loading()
+        await dm.finish_loading(found)
+        await dm.stop_background_flusher()
+    run(scenario())
+    assert not dm.is_ready()
+    assert dm.get_user_data(1) == {"points": 1}
+    assert (tmp_path / "local" / dm.MANIFEST_FILENAME).read_bytes() == old_manifest
+
+
+def test_conversations_are_sharded_by_crc32(fresh_data_manager):
+    dm = fresh_data_manager(DATA_CONVERSATION_SHARDS=4)
+    start(dm)
+    keys = [f"channel_{i}" for i in range(20)]
+
+    async def scenario():
+        for key in keys:
+            await dm.update_conversation_history(key, [{"role": "user", "content": key}])
+        assert await dm.flush(force=True)
+        await dm.stop_background_flusher()
+    run(scenario())
+
+    manifest = json.loads(remote_file(dm, dm.MANIFEST_FILENAME))
+    assert manifest["conversation_shards"] == 4
+    seen = set()
+    for shard in range(4):
+        raw = remote_file(dm, dm._shard_path(shard))
+        content = snapshot_format.decode(raw) if raw else {}
+        for key in content:
+            assert zlib.crc32(key.encode("utf-8")) % 4 == shard
+        seen.update(content)
+    assert seen == set(keys)
+
+
+def test_no_upload_before_remote_sync(fresh_data_manager):
+    dm = fresh_data_manager()
+    assert not dm.load_local_snapshot()
+
+    async def scenario():
+        # 启动加载完成之前的修改只写本地日志，不能覆盖云端
+        await dm.update_user_data(1, {"points": 1})
+        assert not await dm.flush(force=True)
+        await dm.stop_background_flusher()
+    run(scenario())
+    assert remote_file(dm, dm.MANIFEST_FILENAME) is None
+    assert dm._generation == 0
+
+
+def test_stop_while_flush_event_fires(fresh_data_manager):
+    dm = fresh_data_manager()
+    start(dm)
+
+    async def scenario():
+        dm.start_background_flusher()
+        await asyncio.sleep(0)
+        # 事件唤醒等待之后、刷新任务继续运行之前取消它：取消不能被吞掉
+        dm._flush_event.set()
+        await asyncio.sleep(0)
+        task = dm._flusher_task
+        stopping = asyncio.create_task(dm.stop_background_flusher())
+        await asyncio.wait([stopping], timeout=2)
+        assert task.cancelled()
+        assert stopping.done()
+        await stopping
+    run(scenario())
@@ -0,0 +1,92 @@
+import pytest
+
+from utils import response_cache
+from utils.response_cache import ResponseCache, make_key
+from conftest import run
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(response_cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+MESSAGES = [{"role": "user", "content": "摸摸头"}]
+
+
+def test_key_normalises_whitespace_and_tracks_settings():
+    key = make_key(MESSAGES, 1, 0.5)
+    assert make_key([{"role": "user", "content": "  摸摸头\n"}], 1, 0.5) == key
+    assert make_key(MESSAGES, 2, 0.5) != key
+    assert make_key(MESSAGES, 1, 0.9) != key
+    assert make_key(MESSAGES, 1, 0.5, max_tokens=100) != key
+
+
+def test_low_temperature_reply_is_reused_until_it_expires(clock):
+    cache = ResponseCache(ttl_seconds=60)
+    key = make_key(MESSAGES, 1, 0.5)
+    assert cache.get(key) is None
+    cache.put(key, 0.5, "蹭蹭")
+    assert cache.get(key) == "蹭蹭"
+    # 调用点可以缩短缓存时间
+    clock[0] += 30
+    assert cache.get(key, ttl_seconds=10) is None
+    assert cache.get(key) is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["expirations"]) == (1, 3, 1)
+
+
+def test_high_temperature_rotates_through_a_variant_pool(clock):
+    cache = ResponseCache(max_variants=3, variant_temperature=0.7)
+    key = make_key(MESSAGES, 1, 0.9)
+    for reply in ("一", "二"):
+        cache.put(key, 0.9, reply)
+        # 池子装满之前继续调用 AI
+        assert cache.get(key) is None
+    cache.put(key, 0.9, "三")
+    assert [cache.get(key) for _ in range(4)] == ["一", "二", "三", "一"]
+
+
+def test_least_recently_used_key_is_evicted(clock):
+    cache = ResponseCache(max_entries=2)
+    for name in "abc":
+        cache.put(name, 0.5, name)
+        if name == "b":
+            cache.get("a")
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == ("a", "c")
+    assert cache.stats()["evictions"] == 1
+
+
+def test_call_ai_uses_the_cache_only_when_asked(fresh_ai_utils, monkeypatch):
+    ai_utils = fresh_ai_utils
+    pool = ai_utils.client_pool
+    build_model = pool.model
+    calls = []
+
+    def counting_model(*args, **kwargs):
+        model = build_model(*args, **kwargs)
+        generate = model.generate_content_async
+
+        async def generate_content_async(*args, **kwargs):
+            calls.append(args)
+            return await generate(*args, **kwargs)
+        model.generate_content_async = generate_content_async
+        return model
+
+    monkeypatch.setattr(pool, "model", counting_model)
+
+    async def scenario():
+        first = await ai_utils.call_ai(MESSAGES, temperature=0.5, cache=True)
+        assert await ai_utils.call_ai(MESSAGES, temperature=0.5, cache=True) == first
+        assert len(calls) == 1
+        await ai_utils.call_ai(MESSAGES, temperature=0.5)
+        assert len(calls) == 2
+        # 系统指令变化之后旧的回复不再使用
+        from utils import data_manager
+        await data_manager.set_system_prompt("新的人设")
+        await ai_utils.call_ai(MESSAGES, temperature=0.5, cache=True)
+        assert len(calls) == 3
+        await data_manager.stop_background_flusher()
+    run(scenario())
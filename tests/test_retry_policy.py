@@ -0,0 +1,41 @@
+import pytest
+from google.api_core import exceptions as api_exceptions
+
+from utils.retry_policy import RetryPolicy, retry_after_hint, FAIL_FAST, ROTATE, THROTTLED
+
+
+@pytest.mark.parametrize("error, kind", [
+    (api_exceptions.ResourceExhausted("quota"), THROTTLED),
+    (api_exceptions.InvalidArgument("bad request"), FAIL_FAST),
+    (api_exceptions.InvalidArgument("API key not valid"), ROTATE),
+    (ValueError("AI返回了空字符串。"), FAIL_FAST),
+    (api_exceptions.InternalServerError("500"), ROTATE),
+    (api_exceptions.ServiceUnavailable("503"), ROTATE),
+    (ConnectionError("reset"), ROTATE),
+])
+def test_classify(error, kind):
+    policy = RetryPolicy()
+    assert policy.classify(error) == kind
+    assert policy.counts[kind] == 1
+
+
+@pytest.mark.parametrize("message, seconds", [
+    ("429 Resource has been exhausted. Please retry in 17.5s.", 17.5),
+    ("retry_delay { seconds: 12 }", 12.0),
+    ("quota exceeded", None),
+])
+def test_retry_after_hint(message, seconds):
+    assert retry_after_hint(Exception(message)) == seconds
+
+
+def test_backoff_prefers_server_hint():
+    policy = RetryPolicy(backoff_base=2, backoff_max=60)
+    assert policy.backoff(3, Exception("Please retry in 7s")) == 7
+    assert policy.server_hints == 1
+
+
+def test_backoff_is_exponential_with_jitter_and_capped():
+    policy = RetryPolicy(backoff_base=2, backoff_max=10)
+    for attempt, ceiling in [(1, 2), (2, 4), (3, 8), (4, 10), (10, 10)]:
+        for _ in range(20):
+            assert ceiling / 2 <= policy.backoff(attempt) <= ceiling
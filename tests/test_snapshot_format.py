@@ -0,0 +1,34 @@
+import json
+
+import pytest
+
+from utils import snapshot_format
+
+
+def test_round_trip():
+    value = {"a": [1, 2, {"b": "米尔可"}], "c": None}
+    raw = snapshot_format.encode(value)
+    assert snapshot_format.is_snapshot(raw)
+    assert snapshot_format.decode(raw) == value
+
+
+def test_int_keys_survive():
+    value = {1: {"points": 3}, 42: {"points": 5}}
+    assert snapshot_format.decode(snapshot_format.encode(value, int_keys=True)) == value
+
+
+def test_legacy_json_is_parsed_as_is():
+    assert snapshot_format.decode(json.dumps({"x": 1}).encode("utf-8")) == {"x": 1}
+
+
+def test_newer_version_is_rejected():
+    raw = snapshot_format.HEADER.pack(snapshot_format.MAGIC, snapshot_format.SCHEMA_VERSION + 1, 0) + b"{}"
+    with pytest.raises(snapshot_format.SnapshotFormatError):
+        snapshot_format.decode(raw)
+
+
+def test_delta_splice_applies_updates_and_deletes():
+    base = snapshot_format.encode({1: "a", 2: "b", 3: "c"}, int_keys=True)
+    payload = snapshot_format.encode_delta_payload([snapshot_format.dumps([2, "B"]), snapshot_format.dumps([4, "d"])], [3])
+    raw = snapshot_format.splice(base, snapshot_format.wrap_payload(payload))
+    assert snapshot_format.decode(raw) == {1: "a", 2: "B", 4: "d"}
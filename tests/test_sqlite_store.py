@@ -0,0 +1,104 @@
+import shutil
+import asyncio
+
+from conftest import run
+
+
+def start(dm):
+    async def scenario():
+        await dm.finish_loading(dm.load_local_snapshot())
+    run(scenario())
+
+
+def test_sqlite_resident_entries_are_bounded(fresh_data_manager):
+    dm = fresh_data_manager(DATA_STORE="sqlite", DATA_SQLITE_RESIDENT_MAX_ENTRIES=5)
+    start(dm)
+
+    async def scenario():
+        for user_id in range(50):
+            await dm.update_user_data(user_id, {"points": user_id})
+        await dm._sqlite.drain()
+        # 写入提交之后，下一次访问会把多余的条目淘汰掉
+        dm.get_user_data(0)
+        assert len(dm.data["user_data"]._resident) <= 5
+        assert [dm.get_user_data(user_id) for user_id in range(50)] == [{"points": user_id} for user_id in range(50)]
+        await dm.stop_background_flusher()
+    run(scenario())
+
+
+def export_to_remote(fresh_data_manager, tmp_path):
+    """先在 JSON 模式下写入一个用户并上传，再删掉本地目录，模拟换到 SQLite 后的首次启动"""
+    dm = fresh_data_manager()
+    start(dm)
+
+    async def scenario():
+        await dm.update_user_data(1, {"points": 1})
+        assert await dm.flush(force=True)
+        await dm.stop_background_flusher()
+    run(scenario())
+    shutil.rmtree(tmp_path / "local")
+
+
+def test_sqlite_import_is_installed_on_the_loop(fresh_data_manager, tmp_path):
+    export_to_remote(fresh_data_manager, tmp_path)
+    dm = fresh_data_manager(DATA_STORE="sqlite")
+    assert not dm.load_local_snapshot()
+
+    async def scenario():
+        loading = asyncio.create_task(dm.finish_loading(False))
+        # 导入线程运行期间，当前数据保持空白，数据库也还没有安装
+        while not loading.done():
+            assert dm._sqlite is None
+            assert dm.data["user_data"] == {}
+            await asyncio.sleep(0)
+        await loading
+        assert dm.is_ready()
+        assert dm.get_user_data(1) == {"points": 1}
+        await dm.stop_background_flusher()
+    run(scenario())
+
+
+def test_cancelled_sqlite_import_is_dropped(fresh_data_manager, tmp_path):
+    export_to_remote(fresh_data_manager, tmp_path)
+    dm = fresh_data_manager(DATA_STORE="sqlite")
+
+    async def scenario():
+        dm.cancel_loading()
+        await dm.finish_loading(dm.load_local_snapshot())
+        await dm.stop_background_flusher()
+    run(scenario())
+    assert not dm.is_ready()
+    assert dm._sqlite is None
+    assert dm.data["user_data"] == {}
+
+    # 没有导入的数据库在下次启动时重新导入
+    dm = fresh_data_manager(DATA_STORE="sqlite")
+    start(dm)
+    assert dm._sqlite.read("user_data", 1) == {"points": 1}
+
+
+def test_sqlite_conversation_metadata_is_read_on_demand(fresh_data_manager, monkeypatch):
+    dm = fresh_data_manager(DATA_STORE="sqlite", DATA_SQLITE_RESIDENT_MAX_ENTRIES=5, DATA_CONVERSATION_TTL_DAYS=30)
+    start(dm)
+    today = dm._today()
+
+    async def scenario():
+        monkeypatch.setattr(dm, "_today", lambda: today - 40)
+        for i in range(20):
+            await dm.update_conversation_history(f"c{i}", [{"role": "user", "content": str(i)}])
+            await dm.set_conversation_summary(f"c{i}", f"总结 {i}", 2)
+        monkeypatch.setattr(dm, "_today", lambda: today)
+        await dm.update_conversation_history("new", [{"role": "user", "content": "今天"}])
+        await dm._sqlite.drain()
+        # 写入提交之后，下一次读取已有的条目时淘汰多余的条目
+        dm.get_conversation_summary("c19")
+        dm.data["conversation_last_active"]["new"]
+        for section in ("conversation_summaries", "conversation_last_active"):
+            assert len(dm.data[section]._resident) <= 5
+        assert dm.get_conversation_summary("c0") == "总结 0"
+        assert await dm.expire_idle_conversations() == 20
+        await dm._sqlite.drain()
+        assert dm._sqlite.keys("conversation_last_active") == ["new"]
+        assert dm._sqlite.keys("conversation_summaries") == []
+        await dm.stop_background_flusher()
+    run(scenario())
@@ -0,0 +1,103 @@
+import json
+import asyncio
+
+import pytest
+
+from conftest import run
+
+
+def start(dm):
+    async def scenario():
+        await dm.finish_loading(dm.load_local_snapshot())
+    run(scenario())
+
+
+def journal_records(dm):
+    journal = dm._get_journal()
+    journal.sync()
+    records = []
+    for _, path in journal.segments():
+        with open(path, encoding="utf-8") as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def test_transaction_persists_once(fresh_data_manager):
+    dm = fresh_data_manager()
+    start(dm)
+
+    async def scenario():
+        async with dm.transaction():
+            await dm.set_bot_mode("chat")
+            await dm.set_system_prompt("第一版")
+            await dm.set_system_prompt("第二版")
+            # 事务内的修改立即作用于内存
+            assert dm.get_system_prompt() == "第二版"
+            assert journal_records(dm) == []
+        records = journal_records(dm)
+        assert len(records) == 1
+        assert dm._dirty_count == 1
+        # 同一条目被多次修改只记录最终值
+        assert [record["s"] for record in records[0]["t"]] == ["bot_mode", "system_prompt"]
+        assert records[0]["t"][1]["v"] == "第二版"
+        await dm.stop_background_flusher()
+    run(scenario())
+
+    dm = fresh_data_manager()
+    start(dm)
+    assert dm.get_system_prompt() == "第二版"
+
+
+def test_nested_transaction_joins_the_outer_one(fresh_data_manager):
+    dm = fresh_data_manager()
+    start(dm)
+
+    async def scenario():
+        async with dm.transaction():
+            await dm.add_filtered_word("a")
+            async with dm.transaction():
+                await dm.add_filtered_word("b")
+            assert journal_records(dm) == []
+        assert len(journal_records(dm)) == 1
+        await dm.stop_background_flusher()
+    run(scenario())
+
+
+def test_transaction_persists_changes_made_before_an_error(fresh_data_manager):
+    dm = fresh_data_manager()
+    start(dm)
+
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            async with dm.transaction():
+                await dm.set_system_prompt("出错之前")
+                raise RuntimeError("boom")
+        assert len(journal_records(dm)) == 1
+        await dm.stop_background_flusher()
+    run(scenario())
+
+
+def test_transactions_do_not_leak_between_tasks(fresh_data_manager):
+    dm = fresh_data_manager()
+    start(dm)
+
+    async def scenario():
+        inside = asyncio.Event()
+        release = asyncio.Event()
+
+        async def in_transaction():
+            async with dm.transaction():
+                await dm.set_system_prompt("事务中")
+                inside.set()
+                await release.wait()
+
+        task = asyncio.create_task(in_transaction())
+        await inside.wait()
+        # 其他任务的修改不会并入这个事务，而是立即单独写入
+        await dm.add_filtered_word("独立")
+        assert len(journal_records(dm)) == 1
+        release.set()
+        await task
+        assert len(journal_records(dm)) == 2
+        await dm.stop_background_flusher()
+    run(scenario())
@@ -0,0 +1,152 @@
+# utils/admission_queue.py
+"""
+AI 调用的优先级准入队列：限制同时进行的 AI 调用数，超出时按优先级排队。
+
+- 优先级从高到低：主人 > 已授权的对话 > 交互指令 > 后台任务，同一优先级先来先服务；
+- 队列有长度上限，队列已满时新请求若比队尾（优先级最低、来得最晚）的请求更重要，就挤掉队尾的请求，否则新请求直接被拒绝；
+- 排队超过最长等待时间的请求同样被拒绝，调用方收到拒绝后应立即降级（例如回复一句"有点忙"），而不是继续等待。
+"""
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+
+PRIORITY_OWNER = 0
+PRIORITY_CHAT = 1
+PRIORITY_INTERACTIVE = 2
+PRIORITY_BACKGROUND = 3
+PRIORITY_LABELS = {
+    PRIORITY_OWNER: "主人",
+    PRIORITY_CHAT: "对话",
+    PRIORITY_INTERACTIVE: "指令",
+    PRIORITY_BACKGROUND: "后台",
+}
+
+
+class AdmissionRejected(Exception):
+    """请求没有被准入（队列已满、被更高优先级的请求挤掉或等待超时）"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class _ClassStats:
+    __slots__ = ("admitted", "shed", "timed_out", "total_wait", "max_wait")
+
+    def __init__(self):
+        self.admitted = 0
+        self.shed = 0
+        self.timed_out = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+
+class AdmissionQueue:
+    def __init__(self, max_concurrent: int = 8, max_queue: int = 32, max_wait_seconds: float = 20.0):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.max_wait_seconds = max_wait_seconds
+        self.in_flight = 0
+        # 堆中的元素：[优先级, 序号, future]；被移出队列的元素 future 已经完成
+        self._waiters = []
+        self._queued = 0
+        self._sequence = itertools.count()
+        self._stats = {priority: _ClassStats() for priority in PRIORITY_LABELS}
+
+    def _pop_waiter(self):
+        while self._waiters:
+            entry = heapq.heappop(self._waiters)
+            if not entry[2].done():
+                self._queued -= 1
+                return entry
+        return None
+
+    def _shed_lowest(self, priority: int) -> bool:
+        """挤掉比 priority 更不重要的请求中最晚到达的一个"""
+        live = [entry for entry in self._waiters if not entry[2].done()]
+        if not live:
+            return False
+        victim = max(live, key=lambda entry: (entry[0], entry[1]))
+        if victim[0] <= priority:
+            return False
+        victim[2].set_exception(AdmissionRejected("被更高优先级的请求挤出队列"))
+        self._queued -= 1
+        self._stats[victim[0]].shed += 1
+        return True
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE, max_wait: float = None):
+        """占用一个调用名额；没有被准入时抛出 AdmissionRejected"""
+        stats = self._stats[priority]
+        if self.in_flight < self.max_concurrent and not self._queued:
+            self.in_flight += 1
+            stats.admitted += 1
+            return
+        if self._queued >= self.max_queue and not self._shed_lowest(priority):
+            stats.shed += 1
+            raise AdmissionRejected("AI 请求队列已满")
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._sequence), future]
+        heapq.heappush(self._waiters, entry)
+        self._queued += 1
+        started = time.monotonic()
+        timeout = self.max_wait_seconds if max_wait is None else max_wait
+        try:
+            # shield：超时只取消等待，不取消 future，以便判断名额是否已经交给了这个请求
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            if not future.done():
+                future.cancel()
+                self._queued -= 1
+                stats.timed_out += 1
+                raise AdmissionRejected(f"排队超过 {timeout:g} 秒")
+            # 超时的同时恰好拿到了名额或被挤出队列
+            future.result()
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # 名额已经转交给这个请求，归还给下一个
+                self.release()
+            elif not future.done():
+                future.cancel()
+                self._queued -= 1
+            raise
+        waited = time.monotonic() - started
+        stats.admitted += 1
+        stats.total_wait += waited
+        stats.max_wait = max(stats.max_wait, waited)
+
+    def release(self):
+        waiter = self._pop_waiter()
+        if waiter is not None:
+            # 名额直接转交给优先级最高的等待者，in_flight 不变
+            waiter[2].set_result(None)
+        else:
+            self.in_flight -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_INTERACTIVE, max_wait: float = None):
+        await self.acquire(priority, max_wait)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        classes = {}
+        for priority, stats in self._stats.items():
+            waited = stats.admitted
+            classes[PRIORITY_LABELS[priority]] = {
+                "admitted": stats.admitted,
+                "shed": stats.shed,
+                "timed_out": stats.timed_out,
+                "avg_wait_ms": round(stats.total_wait / waited * 1000) if waited else 0,
+                "max_wait_ms": round(stats.max_wait * 1000),
+            }
+        return {
+            "in_flight": self.in_flight,
+            "max_concurrent": self.max_concurrent,
+            "queued": self._queued,
+            "max_queue": self.max_queue,
+            "classes": classes,
+        }
@@ -1,22 +1,50 @@
 # utils/ai_utils.py
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
-from google.api_core.exceptions import DeadlineExceeded, Aborted, InternalServerError, ResourceExhausted, ServiceUnavailable, GoogleAPIError
+from google.api_core.exceptions import ResourceExhausted, GoogleAPIError
 import os
+import time
 import random
 import asyncio
 from . import data_manager
+from .gemini_pool import GeminiClientPool
+from . import fake_gemini
+from .key_scheduler import KeyScheduler
+from .circuit_breaker import CircuitBreaker, STATE_LABELS
+from . import response_cache as response_cache_module
+from . import context_assembler
+from . import hedging
+from .retry_policy import RetryPolicy, FAIL_FAST, ROTATE, THROTTLED
+from .admission_queue import AdmissionQueue, AdmissionRejected, PRIORITY_OWNER, PRIORITY_CHAT, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
 
 # --- 配置 ---
 GEMINI_API_KEYS_STR = os.getenv('GEMINI_API_KEYS', '')
 AI_MODEL_NAME = os.getenv('AI_MODEL_NAME', 'gemini-1.5-flash-latest')
+# 识图（例如给表情生成描述）使用的模型，需要支持图片输入
+AI_VISION_MODEL_NAME = os.getenv('AI_VISION_MODEL_NAME', 'gemini-1.5-pro-latest')
 
 GEMINI_API_KEYS = [key.strip() for key in GEMINI_API_KEYS_STR.split(',') if key.strip()]
-current_gemini_key_index = 0
-ai_consecutive_failures = 0
-AI_FAILURE_THRESHOLD = 5
+# AI 后端：gemini（默认）或 fake（离线模拟，用于压测，见 fake_gemini）
+AI_PROVIDER = os.getenv('AI_PROVIDER', 'gemini').lower()
+if AI_PROVIDER not in ('gemini', 'fake'):
+    raise ValueError(f"未知的 AI_PROVIDER: {AI_PROVIDER!r}（可选 gemini / fake）")
+if AI_PROVIDER == 'fake' and not GEMINI_API_KEYS:
+    # 模拟后端不需要真实的 key，按 FAKE_GEMINI_KEYS 生成若干个假 key 参与调度
+    GEMINI_API_KEYS = fake_gemini.fake_keys(int(os.getenv('FAKE_GEMINI_KEYS', '4')))
+# 熔断：所有 key 合计连续失败 AI_FAILURE_THRESHOLD 次时整体熔断，单个 key 连续失败 AI_KEY_BREAKER_THRESHOLD 次时只熔断该 key；
+# 熔断 AI_BREAKER_COOLDOWN 秒后放行 AI_BREAKER_HALF_OPEN_CALLS 个探测请求，成功即恢复
+AI_FAILURE_THRESHOLD = int(os.getenv('AI_FAILURE_THRESHOLD', '5'))
+AI_KEY_BREAKER_THRESHOLD = int(os.getenv('AI_KEY_BREAKER_THRESHOLD', '3'))
+AI_BREAKER_COOLDOWN = float(os.getenv('AI_BREAKER_COOLDOWN', '60'))
+AI_BREAKER_HALF_OPEN_CALLS = int(os.getenv('AI_BREAKER_HALF_OPEN_CALLS', '1'))
 
 INTERNAL_AI_ERROR_SIGNAL = "INTERNAL_AI_ERROR_SIGNAL_FROM_CALL_AI"
+# 流式调用因排队已满或等待超时被拒绝时产出的信号；非流式调用被拒绝时仍返回 INTERNAL_AI_ERROR_SIGNAL
+AI_BUSY_SIGNAL = "AI_BUSY_SIGNAL_FROM_CALL_AI"
+AI_BUSY_MESSAGE = "米尔可现在有点忙不过来，请稍后再找我聊天吧~"
+# 流式回复已经产出部分文本后中途出错时最后产出的信号：之前收到的文本是不完整的
+AI_TRUNCATED_SIGNAL = "AI_TRUNCATED_SIGNAL_FROM_CALL_AI"
+AI_TRUNCATED_MESSAGE = "（米尔可的回复被打断了，这条回复不会记进对话记忆，可以再问我一次~）"
 # 放宽安全设置以避免不必要的阻断，但请注意内容风险
 DEFAULT_SAFETY_SETTINGS = {
     HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
@@ -25,82 +53,223 @@ DEFAULT_SAFETY_SETTINGS = {
     HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
 }
 
+# 每个 key 一个客户端（连接复用），模型对象每次调用时绑定对应 key 的客户端
+if AI_PROVIDER == 'fake':
+    client_pool = fake_gemini.FakeGeminiPool(
+        latency=os.getenv('FAKE_GEMINI_LATENCY', fake_gemini.DEFAULT_LATENCY),
+        tokens_per_second=float(os.getenv('FAKE_GEMINI_TOKENS_PER_SECOND', '60')),
+        prefill_tokens_per_second=float(os.getenv('FAKE_GEMINI_PREFILL_TOKENS_PER_SECOND', '20000')),
+        reply_tokens=int(os.getenv('FAKE_GEMINI_REPLY_TOKENS', '60')),
+        error_rates=os.getenv('FAKE_GEMINI_ERROR_RATES', ''),
+        key_rpm=float(os.getenv('FAKE_GEMINI_KEY_RPM', '0')),
+        retry_after=float(os.getenv('FAKE_GEMINI_RETRY_AFTER', '5')),
+        seed=os.getenv('FAKE_GEMINI_SEED') or None,
+    )
+    print(f"🧪 AI 后端: 离线模拟（{len(GEMINI_API_KEYS)} 个 key，延迟 {client_pool.latency_spec}）")
+else:
+    client_pool = GeminiClientPool()
+
+# --- Key 调度 ---
+# 每个 key 的每分钟请求数 / token 数上限（0 表示不限制），被限流后的冷却时间，以及所有 key 都没有额度时最多排队等待多久
+GEMINI_KEY_RPM = float(os.getenv('GEMINI_KEY_RPM', '15'))
+GEMINI_KEY_TPM = float(os.getenv('GEMINI_KEY_TPM', '1000000'))
+GEMINI_KEY_COOLDOWN = float(os.getenv('GEMINI_KEY_COOLDOWN', '60'))
+GEMINI_KEY_MAX_WAIT = float(os.getenv('GEMINI_KEY_MAX_WAIT', '30'))
+
+def _on_breaker_transition(breaker, old_state, new_state):
+    """熔断器状态变化时打印日志并私信主人（在事件循环外变化时只打印）"""
+    message = f"熔断器 [{breaker.name}] {STATE_LABELS[old_state]} → {STATE_LABELS[new_state]}"
+    if new_state == "open":
+        message += f"，{breaker.cooldown_seconds:.0f} 秒后试探恢复"
+    print(f"⚡ {message}")
+    if not _send_dm_to_owner_func:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    loop.create_task(_send_dm_to_owner_func(f"【⚡ AI熔断状态变化】\n{message}"))
+
+def _make_breaker(name, threshold):
+    return CircuitBreaker(name, failure_threshold=threshold, cooldown_seconds=AI_BREAKER_COOLDOWN,
+                          half_open_max_calls=AI_BREAKER_HALF_OPEN_CALLS, on_transition=_on_breaker_transition)
+
+# 整体熔断器：熔断期间 call_ai 直接返回错误信号，不再排队重试
+ai_breaker = _make_breaker("AI 后端", AI_FAILURE_THRESHOLD)
+key_scheduler = KeyScheduler(GEMINI_API_KEYS, rpm=GEMINI_KEY_RPM, tpm=GEMINI_KEY_TPM, cooldown_seconds=GEMINI_KEY_COOLDOWN, max_wait_seconds=GEMINI_KEY_MAX_WAIT,
+                             breaker_factory=lambda label: _make_breaker(f"key {label}", AI_KEY_BREAKER_THRESHOLD))
+
+def get_breaker_status() -> dict:
+    """整体和每个 key 的熔断状态，供健康检查和 /status 使用"""
+    return {
+        "ai": ai_breaker.snapshot(),
+        "keys": [state.breaker.snapshot() for state in key_scheduler._states if state.breaker],
+    }
+
+# --- 重试策略 ---
+# 每次调用最多尝试 AI_MAX_ATTEMPTS 次，总耗时不超过 AI_CALL_DEADLINE 秒；被限流的 key 从 AI_RETRY_BACKOFF_BASE 秒开始指数退避
+retry_policy = RetryPolicy(
+    max_attempts=int(os.getenv('AI_MAX_ATTEMPTS', '5')),
+    deadline_seconds=float(os.getenv('AI_CALL_DEADLINE', '45')),
+    backoff_base=float(os.getenv('AI_RETRY_BACKOFF_BASE', '5')),
+    backoff_max=float(os.getenv('AI_RETRY_BACKOFF_MAX', '600')),
+)
+
+# --- 准入队列 ---
+# 同时进行的 AI 调用数上限；超出时按优先级（主人 > 对话 > 指令 > 后台）排队，队列长度和等待时间有上限
+admission = AdmissionQueue(
+    max_concurrent=int(os.getenv('AI_MAX_CONCURRENT', '8')),
+    max_queue=int(os.getenv('AI_QUEUE_SIZE', '32')),
+    max_wait_seconds=float(os.getenv('AI_QUEUE_MAX_WAIT', '20')),
+)
+
+# --- 对冲请求 ---
+# 第一次尝试超过最近成功请求延迟的 AI_HEDGE_PERCENTILE 分位数仍未返回时，换一个 key 再发一份；
+# 最近的调用中被对冲的比例不超过 AI_HEDGE_MAX_RATIO。AI_HEDGE_ENABLED 为 1 时默认对所有调用启用：
+# 非流式调用对冲整个请求，流式调用只对冲等待第一个文本块的阶段（两者的延迟分布不同，分别统计）
+AI_HEDGE_ENABLED = os.getenv('AI_HEDGE_ENABLED', '0') == '1'
+
+def _make_hedge_policy():
+    return hedging.HedgePolicy(
+        percentile=float(os.getenv('AI_HEDGE_PERCENTILE', '0.9')),
+        max_ratio=float(os.getenv('AI_HEDGE_MAX_RATIO', '0.1')),
+        min_samples=int(os.getenv('AI_HEDGE_MIN_SAMPLES', '20')),
+    )
+
+hedge_policy = _make_hedge_policy()
+stream_hedge_policy = _make_hedge_policy()
+
+# --- 回复缓存 ---
+# 只对显式传入 cache=True 的调用生效；温度不低于 AI_CACHE_VARIANT_TEMPERATURE 时每个 key 轮换 AI_CACHE_VARIANTS 条不同的回复
+response_cache = response_cache_module.ResponseCache(
+    ttl_seconds=float(os.getenv('AI_CACHE_TTL', '600')),
+    max_entries=int(os.getenv('AI_CACHE_MAX_ENTRIES', '256')),
+    max_variants=int(os.getenv('AI_CACHE_VARIANTS', '3')),
+    variant_temperature=float(os.getenv('AI_CACHE_VARIANT_TEMPERATURE', '0.7')),
+)
+
+def _response_tokens(response):
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "total_token_count", None) or None
+
 _send_dm_to_owner_func = None
 def set_dm_sender(func):
     global _send_dm_to_owner_func
     _send_dm_to_owner_func = func
 
-def build_system_instruction():
-    """根据当前配置构建完整的系统指令"""
+# --- 系统指令缓存 ---
+# 除历史总结和全局记忆外，系统指令只取决于配置和表情数据，两者版本号不变时直接复用上次构建的各个部分
+MAX_EMOJIS_IN_PROMPT = 200
+_instruction_cache = {"versions": None, "parts": None}
+
+# --- 上下文预算 ---
+# 每次调用的上下文（系统指令 + 对话）按这个 token 预算组装，优先级见 context_assembler
+AI_CONTEXT_TOKEN_BUDGET = int(os.getenv('AI_CONTEXT_TOKEN_BUDGET', '12000'))
+# 最近一次调用的上下文 token 分布，供 /status 查看
+last_context_breakdown = None
+
+SUMMARY_HEADER = "\n\n[历史对话总结]：以下是本次对话更早部分的总结，请作为背景参考：\n"
+EMOJI_HEADER = "\n\n[自定义表情使用指南]：你可以使用服务器的自定义表情来让对话更生动。请根据每个表情的AI分析描述，在最恰当的上下文中使用它们。直接使用尖括号格式，例如 `<bocchi_jet:12345>`。\n[可用表情列表]"
+EMOJI_FALLBACK = "\n\n[表情符号规则]：请优先使用Discord的官方emoji代码（例如 :smile:, :joy:, :anger:）来表达情绪。目前没有可用的自定义表情。"
+MEMORY_HEADER = "\n\n[全局记忆摘要]：这是你最近与其他用户的一些互动记录，请将这些互动中体现出的情绪、态度和信息，作为你当前回应的背景参考，以塑造一个连贯且有深度的个性。请注意，这些只是摘要，不要直接引用或重复其中的内容。"
+
+def _build_static_instruction():
+    """构建系统指令中不随每次请求变化的部分：核心规则（人格前后两段）、人格、全部表情行"""
     from . import emoji_manager # 局部导入，解决循环依赖
     # 1. 基础系统提示词
-    instruction = data_manager.get_system_prompt()
+    core_head = data_manager.get_system_prompt()
 
     # 2. 开发者模式
     if data_manager.get_bot_mode() == 'dev':
-        instruction += "\n\n[开发者模式]：你现在是一个专业的软件工程师。请在你的回答中提供详细的技术解释、代码示例和最佳实践。优先使用Markdown格式化你的代码块。"
+        core_head += "\n\n[开发者模式]：你现在是一个专业的软件工程师。请在你的回答中提供详细的技术解释、代码示例和最佳实践。优先使用Markdown格式化你的代码块。"
 
     # 3. 激活的人格
+    persona = ""
     active_persona_name = data_manager.get_active_persona()
     if active_persona_name:
         personas = data_manager.get_personas()
         persona_content = personas.get(active_persona_name)
         if persona_content:
-            instruction += f"\n\n[当前人格：{active_persona_name}]\n{persona_content}"
+            persona = f"\n\n[当前人格：{active_persona_name}]\n{persona_content}"
 
+    core_tail = ""
     # 4. 短篇幅模式
     if data_manager.get_short_reply_mode():
-        instruction += "\n\n[回复风格]：请以模拟真人聊天软件的风格进行简短的、口语化的回复。在需要换行或分段的地方，请插入一个特殊的 `<\\n>` 标签。例如：'你好呀！<\\n>今天天气真不错呢~'"
+        core_tail += "\n\n[回复风格]：请以模拟真人聊天软件的风格进行简短的、口语化的回复。在需要换行或分段的地方，请插入一个特殊的 `<\\n>` 标签。例如：'你好呀！<\\n>今天天气真不错呢~'"
 
     # 5. 热恋模式
     if data_manager.get_heat_mode():
-        instruction += "\n\n[特殊模式：热恋模式]：你现在处于热恋模式，会无意识地在对话中加入轻微的、自然的性暗示。你对这类话题的接受度非常高，并且会以更加亲密和深情的口吻回应。"
+        core_tail += "\n\n[特殊模式：热恋模式]：你现在处于热恋模式，会无意识地在对话中加入轻微的、自然的性暗示。你对这类话题的接受度非常高，并且会以更加亲密和深情的口吻回应。"
 
     # 6. 禁止重复
-    instruction += "\n\n[重要规则]：\n1. 绝对禁止重复或转述用户历史消息中的任何内容。\n2. 不要重复用户在最新消息中用<>标签包裹的内容。\n3. 你的回复必须是全新的、有价值的，并严格遵循最新的用户指令。"
+    core_tail += "\n\n[重要规则]：\n1. 绝对禁止重复或转述用户历史消息中的任何内容。\n2. 不要重复用户在最新消息中用<>标签包裹的内容。\n3. 你的回复必须是全新的、有价值的，并严格遵循最新的用户指令。"
 
     # 7. 表情符号使用规则 (全新版本)
     all_emojis = emoji_manager.get_all_emojis()
-    described_emojis = {eid: edata for eid, edata in all_emojis.items() if edata.get('description')}
-    
-    if described_emojis:
-        instruction += "\n\n[自定义表情使用指南]：你可以使用服务器的自定义表情来让对话更生动。请根据每个表情的AI分析描述，在最恰当的上下文中使用它们。直接使用尖括号格式，例如 `<bocchi_jet:12345>`。"
-        
-        # 为了防止提示词过长，随机选取一部分表情注入
-        max_emojis_in_prompt = 200 
-        if len(described_emojis) > max_emojis_in_prompt:
-            emoji_keys_to_use = random.sample(list(described_emojis.keys()), max_emojis_in_prompt)
-            final_emojis_to_show = {key: described_emojis[key] for key in emoji_keys_to_use}
-            instruction += f"\n注意：表情库很大，本次对话随机加载了 {max_emojis_in_prompt} 个可用表情。"
-        else:
-            final_emojis_to_show = described_emojis
-        
-        emoji_list_str = "\n".join([
-            f"- `{edata['name']}`: `<{edata['name']}:{edata['id']}>` (AI描述: {edata['description']})"
-            for eid, edata in final_emojis_to_show.items()
-        ])
-        instruction += "\n[可用表情列表]\n" + emoji_list_str
-    else:
+    emoji_lines = [
+        f"- `{edata['name']}`: `<{edata['name']}:{edata['id']}>` (AI描述: {edata['description']})"
+        for edata in all_emojis.values() if edata.get('description')
+    ]
+    if not emoji_lines:
         # 如果没有任何表情有描述，则回退到旧规则
-        instruction += "\n\n[表情符号规则]：请优先使用Discord的官方emoji代码（例如 :smile:, :joy:, :anger:）来表达情绪。目前没有可用的自定义表情。"
-
-    # 8. 全局记忆日志
-    memory_log = data_manager.get_global_memory_log()
-    if memory_log:
-        instruction += "\n\n[全局记忆摘要]：这是你最近与其他用户的一些互动记录，请将这些互动中体现出的情绪、态度和信息，作为你当前回应的背景参考，以塑造一个连贯且有深度的个性。请注意，这些只是摘要，不要直接引用或重复其中的内容。\n"
-        # 为了节省token，只选取最新的10条记忆
-        recent_memories = memory_log[-10:]
-        for entry in recent_memories:
-            # 格式化记忆条目
-            instruction += f"- 用户 {entry['user_name']} 曾说: '{entry['message']}'，你当时回应: '{entry['bot_reply']}'\n"
-            
-    return instruction.strip()
+        core_tail += EMOJI_FALLBACK
+    return {"core_head": core_head, "persona": persona, "core_tail": core_tail, "emoji_lines": emoji_lines}
+
+def instruction_version():
+    """系统指令固定部分的版本：配置或表情数据变化时改变"""
+    from . import emoji_manager # 局部导入，解决循环依赖
+    return (data_manager.get_config_version(), emoji_manager.get_version())
+
+def _static_instruction_parts():
+    versions = instruction_version()
+    if _instruction_cache["versions"] != versions:
+        _instruction_cache.update(versions=versions, parts=_build_static_instruction())
+    return _instruction_cache["parts"]
+
+def assemble_context(turns: list, summary: str = "", budget: int = None):
+    """
+    按 token 预算组装系统指令和对话：turns 为 Gemini 格式的消息。
+    返回 (保留的对话, 系统指令, token 分布)。
+    """
+    parts = _static_instruction_parts()
+    # 表情多于上限时每次随机抽取一部分，预算不够时再从后面丢弃
+    emoji_lines = parts["emoji_lines"]
+    if len(emoji_lines) > MAX_EMOJIS_IN_PROMPT:
+        emoji_lines = random.sample(emoji_lines, MAX_EMOJIS_IN_PROMPT)
+    # 8. 全局记忆日志：最多最新的10条
+    memory_lines = [
+        f"- 用户 {entry['user_name']} 曾说: '{entry['message']}'，你当时回应: '{entry['bot_reply']}'"
+        for entry in data_manager.get_global_memory_log()[-10:]
+    ]
+    result = context_assembler.assemble(
+        AI_CONTEXT_TOKEN_BUDGET if budget is None else budget,
+        core=parts["core_head"] + parts["core_tail"], persona=parts["persona"], turns=turns,
+        summary=summary, summary_header=SUMMARY_HEADER,
+        emoji_header=EMOJI_HEADER, emoji_lines=emoji_lines,
+        memory_header=MEMORY_HEADER, memory_lines=memory_lines,
+    )
+
+    instruction = parts["core_head"] + parts["persona"] + parts["core_tail"]
+    if result["emoji_lines"]:
+        instruction += EMOJI_HEADER + "\n" + "\n".join(result["emoji_lines"])
+    if result["summary"]:
+        instruction += SUMMARY_HEADER + result["summary"]
+    if result["memory_lines"]:
+        instruction += MEMORY_HEADER + "\n" + "\n".join(result["memory_lines"])
+    return result["turns"], instruction.strip(), result["breakdown"]
+
+def build_system_instruction():
+    """根据当前配置构建完整的系统指令（不含对话）"""
+    return assemble_context([])[1]
 
 def convert_to_gemini_format(messages: list):
+    """
+    转换为 Gemini 格式并按 token 预算组装上下文，返回 (对话, 系统指令, token 分布)。
+    messages 中 role 为 system 的消息（例如后台滚动总结产生的对话总结）放进系统指令的总结部分。
+    """
+    global last_context_breakdown
     gemini_history = []
-    
-    # 动态构建系统指令
-    system_instruction = build_system_instruction()
+    summaries = []
 
     # 创建消息列表的深拷贝，以防污染原始历史记录
     import copy
@@ -118,6 +287,9 @@ def convert_to_gemini_format(messages: list):
         role = msg.get("role")
         content = msg.get("content")
 
+        if role == "system" and isinstance(content, str):
+            summaries.append(content)
+            continue
         if role not in ["user", "model"]:
             continue
 
@@ -136,93 +308,401 @@ def convert_to_gemini_format(messages: list):
         if parts:
             gemini_history.append({"role": role, "parts": parts})
 
-    return gemini_history, system_instruction
+    gemini_history, system_instruction, breakdown = assemble_context(gemini_history, summary="\n".join(summaries))
+    last_context_breakdown = breakdown
+    return gemini_history, system_instruction, breakdown
+
+
+def _chunk_text(response) -> str:
+    """取出一个（流式）响应块中的文本；没有文本部分时返回空字符串"""
+    for candidate in response.candidates or []:
+        if candidate.content and candidate.content.parts:
+            return ''.join(part.text for part in candidate.content.parts if hasattr(part, 'text'))
+    return ""
+
+def _release_failed_attempt(e, lease, attempt):
+    """
+    按重试策略对错误分类并相应地释放 key，返回 (错误描述, 错误类别)。
+    全局熔断器不在这里更新：对冲时一次 allow() 可能对应两份请求，由调用方用 _record_breaker_outcome() 只记录一次。
+    """
+    kind = retry_policy.classify(e)
+    detail = f"(尝试{attempt+1}, key {lease.label}): {e.__class__.__name__} - {e}"
+    if kind == FAIL_FAST:
+        lease.failed(key_fault=False)
+        return f"Gemini核心逻辑错误{detail}", kind
+    if kind == THROTTLED:
+        # 被限流的 key 按退避时间冷却，下一次尝试会换到其他 key 或排队等待
+        cooldown = retry_policy.backoff(lease.rate_limit_streak + 1, e)
+        lease.failed(rate_limited=True, retry_after=cooldown)
+        return f"Gemini API配额错误{detail}（该 key 冷却 {cooldown:.1f} 秒）", kind
+    lease.failed()
+    if isinstance(e, GoogleAPIError):
+        return f"Gemini API网络错误{detail}", kind
+    return f"未知AI调用错误{detail}", kind
+
+def _record_breaker_outcome(kind):
+    """
+    按最终采用的那份请求的错误类别记录一次熔断结果。只有需要换 key 重试的错误（网络、服务端）说明后端不健康；
+    内容被拦截、为空或请求不合法（FAIL_FAST）、被限流（THROTTLED）以及没有可用的 key（None）都不计入熔断。
+    """
+    if kind == ROTATE:
+        ai_breaker.record_failure()
+    else:
+        ai_breaker.record_neutral()
+
+def _generation_config(temperature, max_tokens):
+    # max_output_tokens 默认不设置（保持一个较高的默认值），主要通过prompt引导
+    if max_tokens:
+        return genai.types.GenerationConfig(temperature=temperature, max_output_tokens=max_tokens)
+    return genai.types.GenerationConfig(temperature=temperature)
+
+async def call_ai(messages: list, temperature=0.8, context_for_error_dm="通用AI调用", stream=False, max_tokens=None, cache=False, cache_ttl=None,
+                  priority=PRIORITY_INTERACTIVE, hedge=None):
+    """
+    调用 AI 生成回复，返回完整文本；失败时返回 INTERNAL_AI_ERROR_SIGNAL。
+    stream=True 时返回一个异步迭代器，边生成边产出文本块（见 _stream_ai）。
+    cache=True 时先查回复缓存（适合提示词固定的调用），cache_ttl 可以覆盖默认的缓存时间。
+    priority 为准入队列中的优先级（PRIORITY_OWNER / CHAT / INTERACTIVE / BACKGROUND）。
+    hedge 为 True 时对慢请求发出对冲请求（流式调用只对冲第一个文本块之前的等待），None 表示使用 AI_HEDGE_ENABLED。
+    """
+    hedge = AI_HEDGE_ENABLED if hedge is None else hedge
+    if stream:
+        return _stream_ai(messages, temperature, context_for_error_dm, max_tokens, priority, hedge)
+    cache_key = None
+    if cache:
+        cache_key = response_cache_module.make_key(messages, instruction_version(), temperature, max_tokens)
+        reply = response_cache.get(cache_key, ttl_seconds=cache_ttl)
+        if reply is not None:
+            return reply
+    try:
+        async with admission.slot(priority):
+            reply = await _generate(messages, temperature, context_for_error_dm, max_tokens, hedge)
+    except AdmissionRejected as e:
+        print(f"⚠️ AI请求未被受理 ({context_for_error_dm}): {e.reason}")
+        return INTERNAL_AI_ERROR_SIGNAL
+    if cache_key and reply != INTERNAL_AI_ERROR_SIGNAL:
+        response_cache.put(cache_key, temperature, reply)
+    return reply
+
+async def call_vision(parts: list, context_for_error_dm="识图", priority=PRIORITY_BACKGROUND, notify_owner=True):
+    """
+    不带人设和对话上下文的单次多模态调用（parts 为文本和 {"mime_type", "data"} 图片），使用 AI_VISION_MODEL_NAME。
+    与 call_ai 一样经过准入队列、熔断器、重试策略和 key 调度；失败时返回 INTERNAL_AI_ERROR_SIGNAL。
+    批量调用的调用方自己汇总失败时传入 notify_owner=False，最终失败不再逐次私信主人。
+    """
+    prepared = ([{"role": "user", "parts": list(parts)}], None, {"total": context_assembler.estimate_parts_tokens(parts)})
+    try:
+        async with admission.slot(priority):
+            return await _generate(None, None, context_for_error_dm, None, prepared=prepared, model_name=AI_VISION_MODEL_NAME,
+                                   notify_owner=notify_owner)
+    except AdmissionRejected as e:
+        print(f"⚠️ AI请求未被受理 ({context_for_error_dm}): {e.reason}")
+        return INTERNAL_AI_ERROR_SIGNAL
 
+class _AttemptFailed(Exception):
+    """一次请求失败；key 和熔断器已经按错误类型处理过。kind 为重试策略的错误类别，为 None 表示没有可用的 key"""
 
-async def call_ai(messages: list, temperature=0.8, context_for_error_dm="通用AI调用"):
-    global ai_consecutive_failures, current_gemini_key_index
+    def __init__(self, message: str, kind=None):
+        super().__init__(message)
+        self.message = message
+        self.kind = kind
 
+async def _attempt_generate(attempt, used_keys, gemini_messages, system_instruction, generation_config, estimated_tokens, max_wait, model_name=AI_MODEL_NAME):
+    """占用一个 key 发出一次请求并返回回复文本；本次调用用过的 key（used_keys）在还有其他 key 时不会被选中"""
+    # 所有 key 都在冷却或没有额度时在这里排队，而不是消耗重试次数
+    lease = await key_scheduler.acquire(estimated_tokens, exclude=used_keys, max_wait=max_wait)
+    if lease is None:
+        raise _AttemptFailed(f"所有 API key 都已达到速率限制，排队 {max_wait:.0f} 秒后仍无可用额度。")
+    used_keys.add(lease.key)
+    started = time.monotonic()
+    try:
+        model = client_pool.model(lease.key, model_name, system_instruction, DEFAULT_SAFETY_SETTINGS)
+        response = await model.generate_content_async(contents=gemini_messages, generation_config=generation_config)
+        content = _chunk_text(response)
+        if not content:
+            reason = "Unknown"
+            if response.candidates:
+                reason = response.candidates[0].finish_reason.name
+            elif response.prompt_feedback:
+                reason = f"Prompt Feedback: {response.prompt_feedback.block_reason.name}"
+            raise ValueError(f"响应中不含有效内容部分。完成原因: {reason}")
+        if not content.strip():
+            raise ValueError("AI返回了空字符串。")
+    except asyncio.CancelledError:
+        # 对冲请求中落后的一方或到达截止时间被取消：释放 key，不计入熔断
+        lease.failed(key_fault=False)
+        raise
+    except Exception as e:
+        message, kind = _release_failed_attempt(e, lease, attempt)
+        raise _AttemptFailed(message, kind) from e
+    lease.succeeded(_response_tokens(response))
+    hedge_policy.latency.record(time.monotonic() - started)
+    return content.strip()
+
+async def _generate(messages: list, temperature, context_for_error_dm, max_tokens, hedge=False, prepared=None, model_name=AI_MODEL_NAME,
+                    notify_owner=True):
+    """
+    prepared 为已经组装好的 (对话, 系统指令, token 分布)，传入时跳过 convert_to_gemini_format。
+    notify_owner=False 时最终失败只打印日志，不私信主人。
+    """
     if not GEMINI_API_KEYS:
         print("AI调用失败：没有配置GEMINI_API_KEYS。")
         return INTERNAL_AI_ERROR_SIGNAL
     # 恢复聊天记忆力，允许传递历史上下文
-    gemini_messages, system_instruction = convert_to_gemini_format(messages)
-    
-    max_retries = 5
+    gemini_messages, system_instruction, breakdown = prepared or convert_to_gemini_format(messages)
+    generation_config = _generation_config(temperature, max_tokens)
+    # 只有一个 key 时对冲没有意义
+    hedge = hedge and len(GEMINI_API_KEYS) > 1
+    deadline = retry_policy.deadline()
+    used_keys = set()
     err_to_owner_on_final_failure = ""
 
-    for attempt in range(max_retries):
-        if ai_consecutive_failures >= AI_FAILURE_THRESHOLD:
+    for attempt in range(retry_policy.max_attempts):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            retry_policy.deadline_exceeded += 1
+            err_to_owner_on_final_failure = f"超过单次调用的截止时间（{retry_policy.deadline_seconds:.0f} 秒）。最后一次错误: {err_to_owner_on_final_failure}"
+            break
+        # 熔断期间立即返回；状态变化已经私信过主人，这里不再重复通知
+        if not ai_breaker.allow():
             return INTERNAL_AI_ERROR_SIGNAL
 
-        api_key_to_use = GEMINI_API_KEYS[current_gemini_key_index]
+        start_attempt = lambda: _attempt_generate(attempt, used_keys, gemini_messages, system_instruction, generation_config,
+                                                  breakdown["total"], min(GEMINI_KEY_MAX_WAIT, remaining), model_name)
         try:
-            genai.configure(api_key=api_key_to_use)
-            model = genai.GenerativeModel(
-                model_name=AI_MODEL_NAME,
-                safety_settings=DEFAULT_SAFETY_SETTINGS,
-                system_instruction=system_instruction
-            )
-            response = await model.generate_content_async(
-                contents=gemini_messages,
-                generation_config=genai.types.GenerationConfig(
-                    # max_output_tokens 保持一个较高的默认值，主要通过prompt引导
-                    temperature=temperature
-                )
-            )
-            # 每次请求后切换key
-            current_gemini_key_index = (current_gemini_key_index + 1) % len(GEMINI_API_KEYS)
-            if response.candidates and response.candidates.content and response.candidates.content.parts:
-                content = ''.join(part.text for part in response.candidates.content.parts if hasattr(part, 'text'))
-            else:
-                reason = "Unknown"
-                if response.candidates:
-                    reason = response.candidates.finish_reason.name
-                elif response.prompt_feedback:
-                    reason = f"Prompt Feedback: {response.prompt_feedback.block_reason.name}"
-                raise ValueError(f"响应中不含有效内容部分。完成原因: {reason}")
-            if content.strip():
-                ai_consecutive_failures = 0
-                return content.strip()
+            if hedge:
+                content = await asyncio.wait_for(hedging.run_hedged(hedge_policy, start_attempt), remaining)
             else:
-                raise ValueError("AI返回了空字符串。")
-        except (ValueError, genai.types.BlockedPromptException, genai.types.StopCandidateException) as e:
-            err_to_owner_on_final_failure = f"Gemini核心逻辑错误(尝试{attempt+1}): {e.__class__.__name__} - {e}"
-        except (DeadlineExceeded, Aborted, InternalServerError, ResourceExhausted, ServiceUnavailable, GoogleAPIError) as e:
-            err_to_owner_on_final_failure = f"Gemini API网络/配额错误(尝试{attempt+1}): {e.__class__.__name__} - {e}"
-        except Exception as e:
-            err_to_owner_on_final_failure = f"未知AI调用错误(尝试{attempt+1}): {e.__class__.__name__} - {e}"
-        print(f"警告: {err_to_owner_on_final_failure}")
-        await asyncio.sleep(random.uniform(1.5, 3.0))
-    if _send_dm_to_owner_func:
-        await _send_dm_to_owner_func(f"【🚨 AI故障 ({context_for_error_dm} - 多次重试失败)】\n{err_to_owner_on_final_failure}")
+                content = await asyncio.wait_for(start_attempt(), remaining)
+            ai_breaker.record_success()
+            return content
+        except asyncio.TimeoutError:
+            ai_breaker.record_neutral()
+            retry_policy.deadline_exceeded += 1
+            err_to_owner_on_final_failure = f"超过单次调用的截止时间（{retry_policy.deadline_seconds:.0f} 秒），请求已取消。"
+            print(f"警告: {err_to_owner_on_final_failure}")
+            break
+        except asyncio.CancelledError:
+            # 调用方取消：归还 allow() 占用的探测名额，否则熔断器会一直停在试探恢复状态
+            ai_breaker.record_neutral()
+            raise
+        except _AttemptFailed as e:
+            # 对冲时落后或失败的另一份请求不计入熔断，这里按最终的错误只记录一次
+            _record_breaker_outcome(e.kind)
+            err_to_owner_on_final_failure = e.message
+            print(f"警告: {err_to_owner_on_final_failure}")
+            if e.kind is None or e.kind == FAIL_FAST:
+                break
+            # 换 key 重试和限流都立即进行下一次尝试：限流的 key 已经在冷却，调度器会选其他 key 或排队等待
+    if notify_owner and _send_dm_to_owner_func:
+        await _send_dm_to_owner_func(f"【🚨 AI故障 ({context_for_error_dm} - 调用失败)】\n{err_to_owner_on_final_failure}")
     return INTERNAL_AI_ERROR_SIGNAL
 
-async def get_text_embedding(text: str):
-    """获取文本的向量嵌入"""
-    global current_gemini_key_index
+async def _stream_ai(messages: list, temperature, context_for_error_dm, max_tokens=None, priority=PRIORITY_INTERACTIVE, hedge=False):
+    """
+    流式版本的 call_ai：按生成顺序产出文本块，整个生成过程占用一个准入名额。
+    没有被准入时只产出一个 AI_BUSY_SIGNAL。
+    在产出第一个文本块之前失败会像 call_ai 一样换 key 重试；全部失败时只产出一个 INTERNAL_AI_ERROR_SIGNAL。
+    已经产出部分文本之后出错无法重试，最后产出一个 AI_TRUNCATED_SIGNAL，表示之前的文本是截断的回复。
+    """
+    try:
+        await admission.acquire(priority)
+    except AdmissionRejected as e:
+        print(f"⚠️ AI请求未被受理 ({context_for_error_dm}): {e.reason}")
+        yield AI_BUSY_SIGNAL
+        return
+    chunks = _stream_generate(messages, temperature, context_for_error_dm, max_tokens, hedge)
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await chunks.aclose()
+        admission.release()
+
+class _OpenedStream:
+    """已经收到第一个文本块的流式请求"""
+
+    def __init__(self, lease, response, chunks, first_text):
+        self.lease = lease
+        self.response = response
+        self.chunks = chunks
+        self.first_text = first_text
+
+def _discard_stream(opened: _OpenedStream):
+    """对冲中没有被采用的流式请求：释放 key，剩余的块不再读取"""
+    opened.lease.failed(key_fault=False)
+
+async def _open_stream(attempt, used_keys, gemini_messages, system_instruction, generation_config, estimated_tokens, max_wait):
+    """占用一个 key 发出一次流式请求，等到第一个非空文本块后返回 _OpenedStream"""
+    lease = await key_scheduler.acquire(estimated_tokens, exclude=used_keys, max_wait=max_wait)
+    if lease is None:
+        raise _AttemptFailed(f"所有 API key 都已达到速率限制，排队 {max_wait:.0f} 秒后仍无可用额度。")
+    used_keys.add(lease.key)
+    started = time.monotonic()
+    try:
+        model = client_pool.model(lease.key, AI_MODEL_NAME, system_instruction, DEFAULT_SAFETY_SETTINGS)
+        response = await model.generate_content_async(contents=gemini_messages, generation_config=generation_config, stream=True)
+        chunks = response.__aiter__()
+        first_text = ""
+        while not first_text:
+            try:
+                first_text = _chunk_text(await chunks.__anext__())
+            except StopAsyncIteration:
+                raise ValueError("AI返回了空字符串。") from None
+    except asyncio.CancelledError:
+        # 对冲请求中落后的一方或到达截止时间被取消：释放 key，不计入熔断
+        lease.failed(key_fault=False)
+        raise
+    except Exception as e:
+        message, kind = _release_failed_attempt(e, lease, attempt)
+        raise _AttemptFailed(message, kind) from e
+    stream_hedge_policy.latency.record(time.monotonic() - started)
+    return _OpenedStream(lease, response, chunks, first_text)
+
+async def _stream_generate(messages: list, temperature, context_for_error_dm, max_tokens, hedge=False):
     if not GEMINI_API_KEYS:
-        print("向量化失败：没有配置GEMINI_API_KEYS。")
-        return None
+        print("AI调用失败：没有配置GEMINI_API_KEYS。")
+        yield INTERNAL_AI_ERROR_SIGNAL
+        return
+    gemini_messages, system_instruction, breakdown = convert_to_gemini_format(messages)
+    generation_config = _generation_config(temperature, max_tokens)
+    hedge = hedge and len(GEMINI_API_KEYS) > 1
+    deadline = retry_policy.deadline()
+    used_keys = set()
+    err_to_owner_on_final_failure = ""
+
+    for attempt in range(retry_policy.max_attempts):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            retry_policy.deadline_exceeded += 1
+            err_to_owner_on_final_failure = f"超过单次调用的截止时间（{retry_policy.deadline_seconds:.0f} 秒）。最后一次错误: {err_to_owner_on_final_failure}"
+            break
+        if not ai_breaker.allow():
+            yield INTERNAL_AI_ERROR_SIGNAL
+            return
 
-    max_retries = len(GEMINI_API_KEYS)
-    for attempt in range(max_retries):
-        api_key_to_use = GEMINI_API_KEYS[current_gemini_key_index]
+        start_attempt = lambda: _open_stream(attempt, used_keys, gemini_messages, system_instruction, generation_config,
+                                             breakdown["total"], min(GEMINI_KEY_MAX_WAIT, remaining))
+        # 截止时间只约束第一个文本块：收到第一个块之后不再限时
         try:
-            genai.configure(api_key=api_key_to_use)
-            result = await genai.embed_content_async(
-                model="models/embedding-001", # 使用指定的嵌入模型
-                content=text,
-                task_type="retrieval_document"
-            )
-            # 每次请求后切换key
-            current_gemini_key_index = (current_gemini_key_index + 1) % len(GEMINI_API_KEYS)
-            return result['embedding']
+            if hedge:
+                opened = await asyncio.wait_for(hedging.run_hedged(stream_hedge_policy, start_attempt, discard=_discard_stream), remaining)
+            else:
+                opened = await asyncio.wait_for(start_attempt(), remaining)
+        except asyncio.TimeoutError:
+            ai_breaker.record_neutral()
+            retry_policy.deadline_exceeded += 1
+            err_to_owner_on_final_failure = f"超过单次调用的截止时间（{retry_policy.deadline_seconds:.0f} 秒），请求已取消。"
+            print(f"警告: {err_to_owner_on_final_failure}")
+            break
+        except _AttemptFailed as e:
+            # 对冲时落后或失败的另一份请求不计入熔断，这里按最终的错误只记录一次
+            _record_breaker_outcome(e.kind)
+            err_to_owner_on_final_failure = e.message
+            print(f"警告: {err_to_owner_on_final_failure}")
+            if e.kind is None or e.kind == FAIL_FAST:
+                break
+            continue
+        except BaseException:
+            # 等待 key 或第一个文本块时被取消：归还 allow() 占用的探测名额
+            ai_breaker.record_neutral()
+            raise
+
+        lease = opened.lease
+        try:
+            yield opened.first_text
+            async for chunk in opened.chunks:
+                text = _chunk_text(chunk)
+                if text:
+                    yield text
         except Exception as e:
-            print(f"警告: 获取文本嵌入失败 (尝试 {attempt + 1}/{max_retries}): {e}")
-            current_gemini_key_index = (current_gemini_key_index + 1) % len(GEMINI_API_KEYS)
-            await asyncio.sleep(1.5)
-    
+            message, kind = _release_failed_attempt(e, lease, attempt)
+            _record_breaker_outcome(kind)
+            print(f"警告: 流式回复中途中断，回复被截断: {message}")
+            yield AI_TRUNCATED_SIGNAL
+            return
+        except BaseException:
+            # 调用方提前结束迭代或任务被取消：释放 key，不计入熔断
+            lease.failed(key_fault=False)
+            ai_breaker.record_neutral()
+            raise
+        lease.succeeded(_response_tokens(opened.response))
+        ai_breaker.record_success()
+        return
     if _send_dm_to_owner_func:
-        await _send_dm_to_owner_func(f"【🚨 向量化功能故障】\n在多次尝试后，无法获取文本嵌入。")
-    return None
\ No newline at end of file
+        await _send_dm_to_owner_func(f"【🚨 AI故障 ({context_for_error_dm} - 调用失败)】\n{err_to_owner_on_final_failure}")
+    yield INTERNAL_AI_ERROR_SIGNAL
+
+# --- 文本向量化 ---
+EMBEDDING_MODEL = "models/embedding-001"
+# 单次批量请求最多包含的文本数（接口上限为 100）
+EMBEDDING_BATCH_SIZE = 100
+# 同时进行的批量请求数；实际并发还受每个 key 的 RPM 额度约束
+EMBEDDING_CONCURRENCY = int(os.getenv('EMBEDDING_CONCURRENCY', str(max(2, len(GEMINI_API_KEYS)))))
+EMBEDDING_MAX_RETRIES = 3
+
+async def _embed_batch(batch: list, task_type: str):
+    """向量化一批（已去重的）文本，失败时换 key 重试；返回与 batch 对齐的向量列表或 None"""
+    used_keys = set()
+    for attempt in range(EMBEDDING_MAX_RETRIES):
+        # 上一次失败的 key 在有其他 key 时不再使用
+        lease = await key_scheduler.acquire(sum(context_assembler.estimate_text_tokens(text) for text in batch), exclude=used_keys)
+        if lease is None:
+            print("警告: 所有 API key 都已达到速率限制，无法获取文本嵌入。")
+            return None
+        used_keys.add(lease.key)
+        try:
+            result = await client_pool.embed_content(lease.key, model=EMBEDDING_MODEL, content=batch, task_type=task_type)
+            vectors = result['embedding']
+            if len(vectors) != len(batch):
+                raise ValueError(f"返回了 {len(vectors)} 个向量，预期 {len(batch)} 个")
+            lease.succeeded()
+            return vectors
+        except ResourceExhausted as e:
+            lease.failed(rate_limited=True)
+            print(f"警告: 获取文本嵌入时 key {lease.label} 被限流 (尝试 {attempt + 1}/{EMBEDDING_MAX_RETRIES}): {e}")
+        except Exception as e:
+            lease.failed()
+            print(f"警告: 获取文本嵌入失败 (尝试 {attempt + 1}/{EMBEDDING_MAX_RETRIES}, {len(batch)} 条): {e}")
+            await asyncio.sleep(1.5 * (attempt + 1))
+    return None
+
+async def get_text_embeddings(texts: list, task_type: str = "retrieval_document"):
+    """
+    批量获取文本的向量嵌入，返回与 texts 一一对应的列表（失败或空文本的位置为 None）。
+    重复的文本只请求一次；去重后按每批 EMBEDDING_BATCH_SIZE 条切分，
+    最多 EMBEDDING_CONCURRENCY 个批次同时进行，由 key 调度器分配到不同的 key 上。
+    """
+    results = [None] * len(texts)
+    if not GEMINI_API_KEYS:
+        print("向量化失败：没有配置GEMINI_API_KEYS。")
+        return results
+
+    positions = {}
+    for index, text in enumerate(texts):
+        if isinstance(text, str) and text.strip():
+            positions.setdefault(text, []).append(index)
+    unique_texts = list(positions)
+    batches = [unique_texts[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(unique_texts), EMBEDDING_BATCH_SIZE)]
+    semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+    failed_batches = 0
+
+    async def run(batch):
+        nonlocal failed_batches
+        async with semaphore:
+            vectors = await _embed_batch(batch, task_type)
+        if vectors is None:
+            failed_batches += 1
+            return
+        for text, vector in zip(batch, vectors):
+            for index in positions[text]:
+                results[index] = vector
+
+    await asyncio.gather(*(run(batch) for batch in batches))
+    if failed_batches and _send_dm_to_owner_func:
+        await _send_dm_to_owner_func(f"【🚨 向量化功能故障】\n{len(batches)} 批文本中有 {failed_batches} 批在多次尝试后仍无法获取文本嵌入。")
+    return results
+
+async def get_text_embedding(text: str):
+    """获取单条文本的向量嵌入"""
+    return (await get_text_embeddings([text]))[0]
@@ -2,6 +2,7 @@
 from discord.ext import commands
 import discord
 import os
+from . import data_manager
 
 # 加载一次，避免重复读取
 try:
@@ -36,4 +37,14 @@ def is_owner_context():
             await ctx.send("抱歉，这个指令只有我的主人才能使用哦~（歪头）", ephemeral=True)
             return False
         return True
-    return commands.check(predicate)
\ No newline at end of file
+    return commands.check(predicate)
+
+
+def state_ready():
+    """数据还在启动加载时拒绝会修改数据的指令，避免修改被随后加载的云端数据覆盖"""
+    async def predicate(ctx: commands.Context) -> bool:
+        if not data_manager.is_ready():
+            await ctx.send("米尔可还在整理记忆（数据加载中），请稍后再试~", ephemeral=True)
+            return False
+        return True
+    return commands.check(predicate)
@@ -0,0 +1,117 @@
+# utils/circuit_breaker.py
+"""
+基于时间的熔断器：closed（正常）→ open（熔断，直接拒绝）→ half_open（冷却结束，放行少量探测请求）。
+
+- closed 状态下连续失败达到阈值时熔断；
+- open 状态持续 cooldown_seconds，期间 allow() 直接返回 False，调用方可以立即降级而不是排队重试；
+- 冷却结束后进入 half_open，最多同时放行 half_open_max_calls 个探测请求：
+  探测成功则恢复 closed，失败则重新 open；
+- 每次状态变化都会调用 on_transition(breaker, old_state, new_state)。
+
+调用方在 allow() 返回 True 之后，必须以 record_success()、record_failure() 或 record_neutral()
+（与后端健康无关的结果，例如内容被拦截、被限流）之一结束这次调用。
+"""
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+STATE_LABELS = {CLOSED: "🟢 正常", OPEN: "🔴 熔断", HALF_OPEN: "🟡 试探恢复"}
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 5, cooldown_seconds: float = 60.0, half_open_max_calls: int = 1, on_transition=None):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown_seconds = cooldown_seconds
+        self.half_open_max_calls = max(1, half_open_max_calls)
+        self.on_transition = on_transition
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._consecutive_failures = 0
+        self._probes_in_flight = 0
+        self.times_opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        """当前状态；open 状态的冷却时间结束后自动转为 half_open"""
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.cooldown_seconds:
+            self._transition(HALF_OPEN)
+        return self._state
+
+    def peek_state(self) -> str:
+        """与 state 相同，但不触发状态变化，可以在事件循环以外的线程中调用"""
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.cooldown_seconds:
+            return HALF_OPEN
+        return self._state
+
+    def retry_in(self) -> float:
+        """还要多久才会放行请求（closed 或 half_open 且有探测名额时为 0）；不触发状态变化"""
+        state = self.peek_state()
+        if state == OPEN:
+            return max(0.0, self.cooldown_seconds - (time.monotonic() - self._opened_at))
+        if state == HALF_OPEN and self._probes_in_flight >= self.half_open_max_calls:
+            # 探测请求还没有结果，按一个冷却周期估计
+            return self.cooldown_seconds
+        return 0.0
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and self._probes_in_flight < self.half_open_max_calls:
+            self._probes_in_flight += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        self._finish_probe()
+        self._consecutive_failures = 0
+        if self._state != CLOSED:
+            self._transition(CLOSED)
+
+    def record_failure(self):
+        self._finish_probe()
+        self._consecutive_failures += 1
+        if self._state == HALF_OPEN or (self._state == CLOSED and self._consecutive_failures >= self.failure_threshold):
+            self._open()
+
+    def record_neutral(self):
+        self._finish_probe()
+
+    def _finish_probe(self):
+        if self._probes_in_flight > 0:
+            self._probes_in_flight -= 1
+
+    def _open(self):
+        self._opened_at = time.monotonic()
+        self.times_opened += 1
+        self._transition(OPEN)
+
+    def _transition(self, new_state: str):
+        old_state = self._state
+        if old_state == new_state:
+            return
+        self._state = new_state
+        if new_state != HALF_OPEN:
+            self._probes_in_flight = 0
+        if self.on_transition:
+            try:
+                self.on_transition(self, old_state, new_state)
+            except Exception as e:
+                print(f"熔断器 {self.name} 状态通知失败: {e}")
+
+    def snapshot(self) -> dict:
+        """只读的状态快照，不触发状态变化（健康检查在 Flask 线程中调用）"""
+        state = self.peek_state()
+        return {
+            "name": self.name,
+            "state": state,
+            "consecutive_failures": self._consecutive_failures,
+            "retry_in_s": round(self.retry_in(), 1) if state != CLOSED else 0.0,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,115 @@
+# utils/context_assembler.py
+"""
+按 token 预算组装一次 AI 调用的上下文，取代按条数截断历史的做法。
+
+各部分按优先级依次占用预算：系统核心 → 人格 → 最近对话 → 历史总结 → 表情列表 → 全局记忆。
+- 系统核心和人格总是完整保留（超出预算时照常发送，统计中会体现超支）；
+- 最近对话从最新一条往前取，放不下时丢弃更早的消息，最新一条用户消息总是保留；
+- 历史总结放不下时按字符截断，表情和全局记忆只取放得下的条数。
+token 数按字符数估算（estimate_text_tokens），其他模块需要估算 token 数时也使用这里的函数。
+"""
+
+# 优先级顺序
+SECTIONS = ("core", "persona", "turns", "summary", "emojis", "memory")
+SECTION_LABELS = {
+    "core": "系统核心",
+    "persona": "人格",
+    "turns": "最近对话",
+    "summary": "历史总结",
+    "emojis": "表情",
+    "memory": "全局记忆",
+}
+# Gemini 对每张图片按固定 token 数计费
+IMAGE_TOKENS = 258
+
+
+def estimate_text_tokens(text: str) -> int:
+    """按字符数粗略估算 token 数（中文大约每 1~2 个字符一个 token）；空文本为 0"""
+    return len(text) // 2 + 1 if text else 0
+
+
+def estimate_parts_tokens(parts) -> int:
+    """Gemini 格式的 parts 列表：文本按字符数估算，图片按固定值计"""
+    return sum(estimate_text_tokens(part) if isinstance(part, str) else IMAGE_TOKENS for part in parts)
+
+
+def _fit_lines(header: str, lines, remaining: int):
+    """按顺序取出放得下的行；一行都放不下时连标题也不要"""
+    if not lines:
+        return [], 0
+    used = estimate_text_tokens(header)
+    selected = []
+    for line in lines:
+        tokens = estimate_text_tokens(line) + 1
+        if used + tokens > remaining:
+            break
+        selected.append(line)
+        used += tokens
+    return (selected, used) if selected else ([], 0)
+
+
+def assemble(budget: int, core: str, persona: str = "", turns=(), summary: str = "",
+             summary_header: str = "", emoji_header: str = "", emoji_lines=(), memory_header: str = "", memory_lines=()):
+    """
+    按优先级分配预算。turns 为 Gemini 格式的消息（{"role", "parts"}），按时间顺序排列；
+    emoji_lines 按偏好顺序排列（放不下时丢弃靠后的），memory_lines 按时间顺序排列（放不下时丢弃较早的）。
+    返回 dict：turns / summary / emoji_lines / memory_lines 为选中的内容，breakdown 为每部分的 token 数，
+    dropped 为每部分被丢弃的条数。
+    """
+    breakdown = dict.fromkeys(SECTIONS, 0)
+    dropped = {"turns": 0, "emojis": 0, "memory": 0, "summary_chars": 0}
+    breakdown["core"] = estimate_text_tokens(core)
+    breakdown["persona"] = estimate_text_tokens(persona)
+    remaining = budget - breakdown["core"] - breakdown["persona"]
+
+    # 最近对话：从最新往前取，最新一条总是保留
+    turns = list(turns)
+    kept = []
+    for index in range(len(turns) - 1, -1, -1):
+        tokens = estimate_parts_tokens(turns[index]["parts"])
+        if kept and breakdown["turns"] + tokens > remaining:
+            break
+        kept.append(turns[index])
+        breakdown["turns"] += tokens
+    kept.reverse()
+    # 上下文需要以用户消息开头
+    while len(kept) > 1 and kept[0]["role"] != "user":
+        breakdown["turns"] -= estimate_parts_tokens(kept.pop(0)["parts"])
+    dropped["turns"] = len(turns) - len(kept)
+    remaining -= breakdown["turns"]
+
+    if summary:
+        tokens = estimate_text_tokens(summary_header) + estimate_text_tokens(summary)
+        if tokens > remaining:
+            # 按估算比例截断，保留开头（estimate_text_tokens 对非空文本多算 1 个 token）
+            keep_chars = max(0, (remaining - estimate_text_tokens(summary_header) - 1) * 2)
+            dropped["summary_chars"] = len(summary) - keep_chars
+            summary = summary[:keep_chars]
+            tokens = estimate_text_tokens(summary_header) + estimate_text_tokens(summary) if summary else 0
+        breakdown["summary"] = tokens
+        remaining -= tokens
+
+    selected_emojis, breakdown["emojis"] = _fit_lines(emoji_header, emoji_lines, remaining)
+    dropped["emojis"] = len(emoji_lines) - len(selected_emojis)
+    remaining -= breakdown["emojis"]
+
+    # 全局记忆优先保留最新的
+    selected_memory, breakdown["memory"] = _fit_lines(memory_header, list(reversed(memory_lines)), remaining)
+    selected_memory.reverse()
+    dropped["memory"] = len(memory_lines) - len(selected_memory)
+
+    breakdown["total"] = sum(breakdown[name] for name in SECTIONS)
+    breakdown["budget"] = budget
+    return {
+        "turns": kept,
+        "summary": summary,
+        "emoji_lines": selected_emojis,
+        "memory_lines": selected_memory,
+        "breakdown": breakdown,
+        "dropped": dropped,
+    }
+
+
+def format_breakdown(breakdown: dict) -> str:
+    parts = " | ".join(f"{SECTION_LABELS[name]} {breakdown[name]}" for name in SECTIONS if breakdown.get(name))
+    return f"{breakdown['total']}/{breakdown['budget']} tokens（{parts}）"
@@ -0,0 +1,226 @@
+# utils/conversation_cache.py
+"""
+对话历史的分层缓存：热数据常驻内存（LRU），冷数据压缩后存放在本地磁盘。
+
+- 内存中最多保留 max_entries 个对话，且总大小不超过 max_bytes（按紧凑 JSON 编码后的字节数估算）；
+- 超出限制时最久未访问的对话被写入冷存储目录（每个 key 一个 snapshot_format 压缩文件），
+  下次访问时再读回内存；
+- 冷存储只是内存的延伸，真正的持久化仍由 data_manager 的快照和预写日志负责，
+  因此冷文件写入不做 fsync，启动时会被清空重建；
+- 按对话保存的附属数据（总结、活跃日期）使用跟随者缓存（leader 为对话历史的缓存）：不单独计预算，
+  只有对应的对话历史在内存中时才常驻，对话历史被淘汰时一起写入各自的冷存储。
+"""
+import os
+import json
+import base64
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+from . import snapshot_format
+
+COLD_SUFFIX = ".snap"
+
+
+def _estimate_size(value) -> int:
+    return len(json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+
+class ColdStore:
+    """每个对话一个压缩文件，文件名为 key 的 urlsafe base64 编码"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str):
+        name = base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii').rstrip("=")
+        return os.path.join(self.directory, name + COLD_SUFFIX)
+
+    def write(self, key: str, value):
+        path = self._path(key)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(snapshot_format.encode(value))
+        os.replace(tmp_path, path)
+
+    def read(self, key: str):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return snapshot_format.decode(f.read())
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(COLD_SUFFIX) or name.endswith(".tmp"):
+                os.remove(os.path.join(self.directory, name))
+
+
+class ConversationCache(MutableMapping):
+    """
+    可以直接替代 data["conversation_history"] 的字典。
+    遍历只产出 key，不会把冷数据读回内存；需要在不影响 LRU 顺序的情况下读取时使用 peek()。
+    指定 leader 时为跟随者缓存，max_entries / max_bytes 不起作用。
+    """
+
+    def __init__(self, cold_store: ColdStore, max_entries: int, max_bytes: int, leader: "ConversationCache" = None):
+        self._cold_store = cold_store
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._hot = OrderedDict()
+        self._sizes = {}
+        self._hot_bytes = 0
+        self._cold_keys = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._leader = leader
+        self._followers = []
+        if leader is not None:
+            leader._followers.append(self)
+
+    def load(self, items: dict):
+        """启动时批量放入数据，放不下的部分直接写入冷存储（跟随者在 leader 之后加载）"""
+        self._cold_store.clear()
+        for key, value in items.items():
+            self._put(key, value)
+        if self._leader is None:
+            self._evict()
+        else:
+            for key in [key for key in self._hot if not self._may_hold(key)]:
+                self._spill(key)
+        # 启动阶段的写出不计入淘汰次数
+        self.evictions = 0
+
+    # --- MutableMapping ---
+    def __getitem__(self, key):
+        if key in self._hot:
+            self._hot.move_to_end(key)
+            self.hits += 1
+        elif key in self._cold_keys:
+            self.misses += 1
+            value = self._cold_store.read(key)
+            if value is None:
+                self._cold_keys.discard(key)
+                raise KeyError(key)
+            if not self._may_hold(key):
+                # 对应的对话历史不在内存中：直接返回，不放回内存
+                return value
+            self._cold_keys.discard(key)
+            self._cold_store.delete(key)
+            self._put(key, value)
+            self._evict(keep=key)
+        else:
+            raise KeyError(key)
+        return self._hot[key]
+
+    def __setitem__(self, key, value):
+        if not self._may_hold(key):
+            if key in self._hot:
+                self._drop_hot(key)
+            self._cold_store.write(key, value)
+            self._cold_keys.add(key)
+            return
+        if key in self._cold_keys:
+            self._cold_keys.discard(key)
+            self._cold_store.delete(key)
+        self._put(key, value)
+        self._evict(keep=key)
+
+    def __delitem__(self, key):
+        for follower in self._followers:
+            follower._spill(key)
+        if key in self._hot:
+            self._drop_hot(key)
+        elif key in self._cold_keys:
+            self._cold_keys.discard(key)
+            self._cold_store.delete(key)
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._hot or key in self._cold_keys
+
+    def __iter__(self):
+        return iter(list(self._hot) + list(self._cold_keys))
+
+    def __len__(self):
+        return len(self._hot) + len(self._cold_keys)
+
+    def clear(self):
+        self._hot.clear()
+        self._sizes.clear()
+        self._hot_bytes = 0
+        self._cold_keys.clear()
+        self._cold_store.clear()
+
+    # --- 内部 ---
+    def _put(self, key, value):
+        if key in self._hot:
+            self._drop_hot(key)
+        size = _estimate_size(value)
+        self._hot[key] = value
+        self._sizes[key] = size
+        self._hot_bytes += size
+
+    def _drop_hot(self, key):
+        del self._hot[key]
+        self._hot_bytes -= self._sizes.pop(key)
+
+    def _may_hold(self, key) -> bool:
+        """跟随者只在对应的对话历史常驻内存时才保留该条目"""
+        return self._leader is None or key in self._leader._hot
+
+    def _spill(self, key):
+        """把一个常驻的条目写入冷存储（不在内存中时什么也不做），跟随者的同一条目一起写出"""
+        if key not in self._hot:
+            return
+        self._cold_store.write(key, self._hot[key])
+        self._drop_hot(key)
+        self._cold_keys.add(key)
+        self.evictions += 1
+        for follower in self._followers:
+            follower._spill(key)
+
+    def _evict(self, keep=None):
+        """把最久未访问的对话写入冷存储，直到满足数量和字节预算；keep 为刚刚访问的 key，不会被淘汰"""
+        if self._leader is not None:
+            return
+        while self._hot and (len(self._hot) > self.max_entries or self._hot_bytes > self.max_bytes):
+            key = next(iter(self._hot))
+            if key == keep:
+                if len(self._hot) == 1:
+                    break
+                self._hot.move_to_end(key)
+                continue
+            self._spill(key)
+
+    # --- 供 data_manager 使用 ---
+    def peek(self, key, default=None):
+        """读取但不改变 LRU 顺序，也不把冷数据放回内存（用于编码快照）"""
+        if key in self._hot:
+            return self._hot[key]
+        if key in self._cold_keys:
+            value = self._cold_store.read(key)
+            return default if value is None else value
+        return default
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hot_entries": len(self._hot),
+            "hot_bytes": self._hot_bytes,
+            "cold_entries": len(self._cold_keys),
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+        }
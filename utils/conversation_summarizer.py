@@ -0,0 +1,126 @@
+# utils/conversation_summarizer.py
+"""
+后台滚动总结：回复发送之后，把对话历史中较早的消息折叠进该对话的总结，回复路径不再等待总结。
+
+- 历史超过 AI_SUMMARY_TRIGGER_TURNS 条时调度一次总结，只保留最近 AI_SUMMARY_KEEP_TURNS 条原始消息；
+- 总结是增量的：已有总结 + 新折叠的消息 → 新总结，保存在 data_manager 的 conversation_summaries 中，与对话历史分开，
+  下一次调用时作为历史总结放进系统指令（见 context_assembler 的"历史总结"部分）；
+- AI 调用在锁外以后台优先级进行，写回时在对话锁内确认被折叠的消息仍在历史开头（期间被清除记忆或截断时放弃这次结果）；
+- 同一个对话同时最多只有一个总结任务，失败或繁忙时保留原历史，下次回复后再试。
+"""
+import os
+import asyncio
+
+from . import data_manager, ai_utils
+
+# 历史超过这个条数时在后台总结，总结后保留最近 AI_SUMMARY_KEEP_TURNS 条原始消息
+SUMMARY_TRIGGER_TURNS = int(os.getenv('AI_SUMMARY_TRIGGER_TURNS', '30'))
+SUMMARY_KEEP_TURNS = int(os.getenv('AI_SUMMARY_KEEP_TURNS', '10'))
+# 总结的长度上限（字符）
+SUMMARY_MAX_CHARS = int(os.getenv('AI_SUMMARY_MAX_CHARS', '1500'))
+# 总结一直失败时对话历史的硬上限，超出的最早消息直接丢弃
+HISTORY_MAX_TURNS = int(os.getenv('AI_HISTORY_MAX_TURNS', '60'))
+# 关机时最多等待正在进行的总结多少秒，超时的总结被取消（原历史保留）
+SUMMARY_DRAIN_TIMEOUT = float(os.getenv('AI_SUMMARY_DRAIN_TIMEOUT', '10'))
+
+
+def _format_turns(turns: list) -> str:
+    lines = []
+    for turn in turns:
+        content = turn.get("content")
+        if isinstance(content, list):
+            # 多模态消息只保留文本部分
+            content = " ".join(item for item in content if isinstance(item, str)) + " [图片]"
+        lines.append(f"{turn.get('role')}: {content}")
+    return "\n".join(lines)
+
+
+def build_prompt(previous_summary: str, turns: list) -> str:
+    prompt = f"请用简洁中文更新一段对话的总结，保留人物、事实、约定和情绪等关键信息，便于后续继续对话，总结不超过 {SUMMARY_MAX_CHARS} 字。\n"
+    if previous_summary:
+        prompt += f"\n[已有总结]：\n{previous_summary}\n"
+    prompt += f"\n[需要并入总结的新对话]：\n{_format_turns(turns)}\n\n请直接输出更新后的完整总结，不要说任何额外的话。"
+    return prompt
+
+
+class RollingSummarizer:
+    def __init__(self, trigger_turns: int = SUMMARY_TRIGGER_TURNS, keep_turns: int = SUMMARY_KEEP_TURNS):
+        self.trigger_turns = trigger_turns
+        self.keep_turns = max(1, min(keep_turns, trigger_turns))
+        self._running = {}
+        self.scheduled = 0
+        self.completed = 0
+        self.failed = 0
+        self.discarded = 0
+        self.folded_turns = 0
+
+    def needs_summary(self, history: list) -> bool:
+        return len(history) > self.trigger_turns
+
+    def schedule(self, key: str, context: str = "自动总结历史"):
+        """历史足够长且该对话没有正在进行的总结时，在后台启动一次总结"""
+        if key in self._running or not self.needs_summary(data_manager.get_conversation_history(key)):
+            return None
+        self.scheduled += 1
+        task = asyncio.create_task(self._summarize(key, context))
+        self._running[key] = task
+        task.add_done_callback(lambda _: self._running.pop(key, None))
+        return task
+
+    async def _summarize(self, key: str, context: str):
+        try:
+            async with data_manager.conversation_lock(key):
+                history = list(data_manager.get_conversation_history(key))
+                previous = data_manager.get_conversation_summary(key)
+            if not self.needs_summary(history):
+                return
+            # 保留的部分需要以用户消息开头，开头的模型回复一并折叠
+            cut = len(history) - self.keep_turns
+            while cut < len(history) - 1 and history[cut].get("role") != "user":
+                cut += 1
+            folded = history[:cut]
+            result = await ai_utils.call_ai([{"role": "user", "content": build_prompt(previous, folded)}],
+                                            temperature=0.3, context_for_error_dm=context, priority=ai_utils.PRIORITY_BACKGROUND)
+            # 失败（包括繁忙时被拒绝）时保留原历史，下次回复后再试
+            if result == ai_utils.INTERNAL_AI_ERROR_SIGNAL:
+                self.failed += 1
+                return
+            async with data_manager.conversation_lock(key):
+                current = data_manager.get_conversation_history(key)
+                if current[:len(folded)] != folded:
+                    # 总结期间历史被清除或截断，这次的总结已经不对应当前的历史
+                    self.discarded += 1
+                    return
+                async with data_manager.transaction():
+                    await data_manager.set_conversation_summary(key, result.strip()[:SUMMARY_MAX_CHARS], len(folded))
+                    await data_manager.update_conversation_history(key, current[len(folded):])
+            self.completed += 1
+            self.folded_turns += len(folded)
+            print(f"📝 已在后台把对话 {key} 的 {len(folded)} 条较早消息并入总结。")
+        except Exception as e:
+            self.failed += 1
+            print(f"⚠️ 后台总结对话 {key} 失败: {e}")
+
+    async def drain(self, timeout: float = None) -> bool:
+        """等待所有正在进行的总结完成（关闭前或测试时使用）；超时时取消剩下的总结并返回 False"""
+        if not self._running:
+            return True
+        _, pending = await asyncio.wait(list(self._running.values()), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        return not pending
+
+    def stats(self) -> dict:
+        return {
+            "running": len(self._running),
+            "scheduled": self.scheduled,
+            "completed": self.completed,
+            "failed": self.failed,
+            "discarded": self.discarded,
+            "folded_turns": self.folded_turns,
+        }
+
+
+summarizer = RollingSummarizer()
@@ -1,12 +1,21 @@
 # utils/data_manager.py
 import os
 os.environ["HF_HOME"] = "/tmp/hf_cache"
+import threading
 import json
-import tempfile
-from huggingface_hub import hf_hub_download, upload_file
+import copy
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from huggingface_hub.errors import HfHubHTTPError, RepositoryNotFoundError
 from datetime import datetime, timezone
+import time
 import asyncio
+import contextvars
+from contextlib import asynccontextmanager
+from . import local_store, sqlite_store, snapshot_format, storage_backends
+from .conversation_cache import ConversationCache, ColdStore
+from .persistence_worker import PersistenceWorker
+from .incremental_serializer import IncrementalSerializer
 
 # 全局数据字典
 data = {
@@ -14,6 +23,10 @@ data = {
     "autoreact_map": {},
     "private_chat_users": [],
     "conversation_history": {},
+    # 每个对话最近一次写入的日期（自 1970-01-01 起的天数），用于清理长期不活跃的对话
+    "conversation_last_active": {},
+    # 每个对话更早部分的滚动总结，与对话历史分开保存：{"text": 总结, "folded_turns": 已折叠进总结的消息数, "updated_at": 时间}
+    "conversation_summaries": {},
     "logging_config": {},
     "global_logging_config": {},
     "filtered_words": [],
@@ -29,78 +42,1010 @@ data = {
     "heat_mode": False,
     "global_memory_log": [],
 }
+# 启动时的空白状态，云端数据比本地快照新时用来重置
+_DEFAULT_DATA = copy.deepcopy(data)
 
 HF_TOKEN = os.getenv('HF_TOKEN')
 HF_DATA_REPO_ID = os.getenv('HF_DATA_REPO_ID')
+# 旧版单文件布局，仅用于迁移
 DATA_FILENAME = "milky_bot_data.json"
 
+# --- 分区存储布局 ---
+# 每个顶层字段单独一个文件，conversation_history 按 key 的哈希分片，由 manifest 描述整体结构
+DATA_DIR_IN_REPO = "milky_bot_data"
+MANIFEST_FILENAME = f"{DATA_DIR_IN_REPO}/manifest.json"
+# v1：纯 JSON 文件；v2：分区/分片文件使用 snapshot_format（版本头 + zlib 压缩），manifest 仍为 JSON
+LAYOUT_VERSION = 2
+CONVERSATION_SHARDS = max(1, int(os.getenv('DATA_CONVERSATION_SHARDS', '16')))
+LOAD_WORKERS = 8
+# 这些字段在内存中使用 int 作为 key，旧版 JSON 中只能存为字符串，快照格式中以键值对列表原生保存
+INT_KEY_SECTIONS = ("user_data", "autoreact_map")
+
+# --- 本地预写日志与快照 ---
+# 每次修改先追加到本地日志，保存时把日志折叠为本地快照（与云端相同的文件布局），再把快照上传到 Hub
+LOCAL_DATA_DIR = os.getenv('DATA_LOCAL_DIR', '/tmp/milky_bot_local')
+JOURNAL_FSYNC_INTERVAL = float(os.getenv('DATA_JOURNAL_FSYNC_INTERVAL', '0.2'))
+
+# --- 存储引擎 ---
+# json（默认）：预写日志 + 分区快照；sqlite：本地 SQLite 数据库（WAL），Hub 只作为数据库文件的定期备份
+DATA_STORE = os.getenv('DATA_STORE', 'json').lower()
+SQLITE_PATH = os.getenv('DATA_SQLITE_PATH', os.path.join(LOCAL_DATA_DIR, 'milky_bot.db'))
+SQLITE_FILENAME_IN_REPO = f"{DATA_DIR_IN_REPO}/milky_bot.db"
+SQLITE_BACKUP_INTERVAL_SECONDS = float(os.getenv('DATA_SQLITE_BACKUP_INTERVAL', '600'))
+# sqlite 模式下用户数据和对话记录各自在内存中最多保留的条目数（其余按需从数据库读取）
+SQLITE_RESIDENT_MAX_ENTRIES = int(os.getenv('DATA_SQLITE_RESIDENT_MAX_ENTRIES', str(sqlite_store.DEFAULT_RESIDENT_MAX_ENTRIES)))
+
+# --- 写回缓存 (write-behind) 配置 ---
+# 修改数据只会标记为"脏"，由后台任务按间隔或累计修改次数合并提交，避免每次修改都完整上传一次
+FLUSH_INTERVAL_SECONDS = float(os.getenv('DATA_FLUSH_INTERVAL', '30'))
+FLUSH_DIRTY_THRESHOLD = int(os.getenv('DATA_FLUSH_DIRTY_THRESHOLD', '20'))
+
+# --- 远端存储后端 ---
+# hub（默认）：Hugging Face Hub；local：本地目录（原子 rename 写入）；memory：进程内存储，用于离线压测
+DATA_BACKEND = os.getenv('DATA_BACKEND', 'hub').lower()
+DATA_BACKEND_DIR = os.getenv('DATA_BACKEND_DIR', os.path.join(LOCAL_DATA_DIR, 'remote'))
+
+# --- 对话历史缓存（仅 json 存储引擎；sqlite 模式下对话本身就按需从数据库读取）---
+# 内存中最多保留的对话数量和总字节数，超出部分压缩后写入本地冷存储，访问时再读回
+CONVERSATION_CACHE_MAX_ENTRIES = int(os.getenv('DATA_CONVERSATION_CACHE_ENTRIES', '2000'))
+CONVERSATION_CACHE_MAX_BYTES = int(float(os.getenv('DATA_CONVERSATION_CACHE_MB', '64')) * 1024 * 1024)
+# 按对话保存的附属分区：与对话历史一起在内存和冷存储之间移动（SQLite 模式下同样按需加载）
+CONVERSATION_FOLLOWER_SECTIONS = ("conversation_last_active", "conversation_summaries")
+# 超过该天数没有新消息的对话会被删除，0 表示不清理
+CONVERSATION_TTL_DAYS = int(os.getenv('DATA_CONVERSATION_TTL_DAYS', '0'))
+CONVERSATION_EXPIRY_CHECK_SECONDS = 3600
+EXPIRY_SCAN_BATCH = 1000
+
+# --- 上传工作线程 ---
+# 所有上传都在单独的线程中执行，失败时按指数退避重试
+HUB_MAX_PENDING = int(os.getenv('DATA_HUB_MAX_PENDING', '8'))
+HUB_MAX_ATTEMPTS = int(os.getenv('DATA_HUB_MAX_ATTEMPTS', '4'))
+HUB_RETRY_BASE_DELAY = float(os.getenv('DATA_HUB_RETRY_BASE_DELAY', '2'))
+
+_dirty_count = 0
+_dirty_sections = set()
+_dirty_shards = set()
+_flush_event = None
+_flush_lock = None
+_flusher_task = None
+_flush_failing = False
+_journal = None
+_generation = 0
+_sqlite = None
+_hub_worker = None
+_backend = None
+_conversation_cache = None
+# 缓存每个分区 / 分片上一次编码的结果，保存时只重新编码被修改过的条目
+_serializer = IncrementalSerializer()
+_last_expiry_check = 0.0
+# 影响系统指令的配置每次变化都会加一，ai_utils 据此判断缓存的系统指令是否需要重建
+INSTRUCTION_SECTIONS = ("system_prompt", "bot_mode", "active_persona", "personas", "short_reply_mode", "heat_mode")
+_config_version = 0
+# 启动分两阶段：先读本地快照（不联网），再在后台与远端核对；核对完成前数据视为未就绪
+_state_ready = False
+_ready_event = None
+# 后台核对线程（run_in_executor 的 future）；关机时设置 _load_cancelled，线程不再写入本地快照，结果也不会被应用
+_sync_future = None
+_load_cancelled = threading.Event()
+# 当前任务中打开的事务：按顺序记录被修改的 (section, key)，退出事务时统一持久化
+_current_transaction = contextvars.ContextVar("data_manager_transaction", default=None)
+# 按 (分区, key) 划分的异步锁：{(section, key): [asyncio.Lock, 等待/持有者数量]}，无人使用时自动移除
+_key_locks = {}
+
 _send_dm_to_owner_func = None
 
 def set_dm_sender(func):
     global _send_dm_to_owner_func
     _send_dm_to_owner_func = func
 
-def load_data_from_hf():
-    global data
-    print("\n--- 数据持久化状态 (加载) ---")
-    if not HF_TOKEN or not HF_DATA_REPO_ID or HF_DATA_REPO_ID == "SETUP_YOUR_HF_DATA_REPO_ID_ENV_VAR":
-        print("  ❌ 无法加载数据: HF_TOKEN 或 HF_DATA_REPO_ID 未正确配置。\n     机器人将以空数据启动，所有数据都将是临时的。")
+def _get_backend() -> storage_backends.StorageBackend:
+    global _backend
+    if _backend is None:
+        _backend = storage_backends.create_backend(DATA_BACKEND, token=HF_TOKEN, repo_id=HF_DATA_REPO_ID, local_dir=DATA_BACKEND_DIR)
+    return _backend
+
+def _remote_configured():
+    return _get_backend().is_configured()
+
+def _get_hub_worker():
+    global _hub_worker
+    if _hub_worker is None:
+        _hub_worker = PersistenceWorker(max_pending=HUB_MAX_PENDING, max_attempts=HUB_MAX_ATTEMPTS, base_delay=HUB_RETRY_BASE_DELAY)
+    return _hub_worker
+
+async def _commit_to_remote(files: dict, commit_message: str):
+    """在上传工作线程中把 {路径: 内容} 作为一次提交写入远端存储"""
+    backend = _get_backend()
+    await _get_hub_worker().run("commit", backend.commit, files, commit_message, should_retry=backend.is_retriable)
+
+def _get_journal():
+    global _journal
+    if _journal is None:
+        _journal = local_store.Journal(os.path.join(LOCAL_DATA_DIR, "journal"), fsync_interval=JOURNAL_FSYNC_INTERVAL)
+    return _journal
+
+# --- 分区编码 ---
+def _file_ext(layout_version: int):
+    # 布局 v1 为纯 JSON 文件，v2 起为带版本头的压缩快照
+    return "json" if layout_version < 2 else "snap"
+
+def _section_path(name: str, layout_version: int = LAYOUT_VERSION):
+    return f"{DATA_DIR_IN_REPO}/sections/{name}.{_file_ext(layout_version)}"
+
+def _shard_path(shard: int, layout_version: int = LAYOUT_VERSION):
+    return f"{DATA_DIR_IN_REPO}/conversations/{shard:03d}.{_file_ext(layout_version)}"
+
+def _conversation_shard(key: str):
+    """稳定的分片函数（不能用内置 hash，它在每次启动时都会变化）"""
+    return zlib.crc32(key.encode('utf-8')) % CONVERSATION_SHARDS
+
+def _encode_section(name: str) -> bytes:
+    value = data[name]
+    if isinstance(value, ConversationCache):
+        # 跟随对话历史的分区：冷存储中的条目直接读取，不放回内存
+        path = _section_path(name)
+        encoded = _serializer.encode_changes(path, value.__contains__, value.peek)
+        return encoded if encoded is not None else _serializer.encode_full(path, {key: value.peek(key) for key in value})
+    return _serializer.encode(_section_path(name), value, int_keys=name in INT_KEY_SECTIONS)
+
+def _decode_section(name: str, value):
+    """旧版 JSON 中整数 key 被存成了字符串，需要转换回来"""
+    if name in INT_KEY_SECTIONS:
+        return {int(k): v for k, v in value.items()}
+    return value
+
+def _encode_shards(shards) -> dict:
+    """
+    已有缓存的分片只编码被修改过的对话；其余分片一次遍历会话历史分组后完整编码
+    （冷存储中的对话直接读取，不放回内存）。
+    """
+    conversations = data["conversation_history"]
+    peek = getattr(conversations, "peek", conversations.get)
+    files = {}
+    grouped = {}
+    for shard in shards:
+        encoded = _serializer.encode_changes(_shard_path(shard), conversations.__contains__, peek)
+        if encoded is None:
+            grouped[shard] = {}
+        else:
+            files[_shard_path(shard)] = encoded
+    if grouped:
+        for key in conversations:
+            shard = _conversation_shard(key)
+            if shard in grouped:
+                grouped[shard][key] = peek(key)
+        for shard, content in grouped.items():
+            files[_shard_path(shard)] = _serializer.encode_full(_shard_path(shard), content)
+    return files
+
+def _build_manifest(journal_seq: int, unsynced=None, source: dict = None, generation: int = None) -> bytes:
+    """
+    journal_seq 之前的日志段都已折叠进快照。
+    unsynced 只出现在本地 manifest 中，记录已写入本地快照但尚未确认上传到 Hub 的分区/分片。
+    source / generation 默认为当前数据和代数，写入尚未应用的远端数据时显式传入。
+    """
+    manifest = {
+        "layout_version": LAYOUT_VERSION,
+        "generation": _generation if generation is None else generation,
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+        "sections": [name for name in (data if source is None else source) if name != "conversation_history"],
+        "conversation_shards": CONVERSATION_SHARDS,
+        "journal_seq": journal_seq,
+    }
+    if unsynced is not None:
+        sections, shards = unsynced
+        manifest["unsynced"] = {"sections": sorted(sections), "shards": sorted(shards)}
+    return json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8')
+
+def _track_dirty(section: str, key=None, count: bool = True):
+    global _dirty_count
+    if section == "conversation_history":
+        if key is None:
+            _dirty_shards.update(range(CONVERSATION_SHARDS))
+            for shard in range(CONVERSATION_SHARDS):
+                _serializer.invalidate(_shard_path(shard))
+        else:
+            shard = _conversation_shard(key)
+            _dirty_shards.add(shard)
+            _serializer.invalidate(_shard_path(shard), key)
+    else:
+        _dirty_sections.add(section)
+        _serializer.invalidate(_section_path(section), key)
+    if count:
+        _dirty_count += 1
+
+def _mark_everything_dirty():
+    global _dirty_count
+    # 数据被整体替换，之前缓存的编码结果全部作废
+    _serializer.reset()
+    _dirty_sections.update(name for name in data if name != "conversation_history")
+    _dirty_shards.update(range(CONVERSATION_SHARDS))
+    _dirty_count += 1
+
+# --- 加载 ---
+def _download_raw_optional(filename: str):
+    """从远端存储读取文件，不存在时返回 None（从未被修改过的分区不会被上传）"""
+    return _get_backend().read(filename)
+
+def _download_json_optional(filename: str):
+    raw = _download_raw_optional(filename)
+    return json.loads(raw.decode('utf-8')) if raw is not None else None
+
+def _read_local_raw(filename: str):
+    return local_store.read_file(LOCAL_DATA_DIR, filename)
+
+def _read_local_json(filename: str):
+    raw = _read_local_raw(filename)
+    return json.loads(raw) if raw is not None else None
+
+def _decode_file(name, raw: bytes):
+    """解码一个分区/分片文件；name 为 None 表示会话分片"""
+    value = snapshot_format.decode(raw)
+    if name is not None and not snapshot_format.is_snapshot(raw):
+        value = _decode_section(name, value)
+    return value
+
+def _apply_sectioned(manifest: dict, fetch, target: dict) -> bool:
+    """
+    并行读取 manifest 中列出的所有分区和分片（fetch 返回原始字节）写入 target。缺失的文件表示该分区保持默认值。
+    解码（解压 + JSON 解析）同样在线程池中完成。返回是否需要在下次保存时重写所有文件（布局或分片数变化）。
+    """
+    layout_version = manifest.get("layout_version", 1)
+    if layout_version > LAYOUT_VERSION:
+        raise snapshot_format.SnapshotFormatError(f"不支持的数据布局版本 {layout_version}（当前最高支持 {LAYOUT_VERSION}），请升级机器人。")
+    section_files = {_section_path(name, layout_version): name for name in manifest.get("sections", [])}
+    shard_count = manifest.get("conversation_shards", 0)
+    shard_files = [_shard_path(i, layout_version) for i in range(shard_count)]
+
+    def fetch_and_decode(item):
+        filename, name = item
+        raw = fetch(filename)
+        return _decode_file(name, raw) if raw is not None else None
+
+    with ThreadPoolExecutor(max_workers=LOAD_WORKERS) as pool:
+        section_results = dict(zip(section_files, pool.map(fetch_and_decode, section_files.items())))
+        shard_results = list(pool.map(fetch_and_decode, ((filename, None) for filename in shard_files)))
+
+    for filename, value in section_results.items():
+        if value is None:
+            continue
+        target[section_files[filename]] = value
+    conversations = {}
+    for shard_content in shard_results:
+        if shard_content:
+            conversations.update(shard_content)
+    target["conversation_history"] = conversations
+
+    rewrite = False
+    if layout_version < LAYOUT_VERSION:
+        print(f"  ℹ️ 数据布局版本为 v{layout_version}，将在下次保存时以 v{LAYOUT_VERSION} 快照格式重写所有文件。")
+        rewrite = True
+
+    if shard_count != CONVERSATION_SHARDS:
+        # 分片数量配置发生变化，下次刷新时按新的分片数重写所有会话
+        print(f"  ℹ️ 会话分片数从 {shard_count} 变为 {CONVERSATION_SHARDS}，将在下次保存时重新分片。")
+        rewrite = True
+    print(f"  ✔️ 已加载 {len(section_files)} 个数据分区和 {shard_count} 个会话分片。")
+    return rewrite
+
+def _load_legacy(target: dict) -> bool:
+    """读取旧版的单文件数据写入 target；读到时返回 True，表示需要全部重写以迁移到分区布局"""
+    print(f"  ⏳ 未找到分区数据，正在尝试读取旧版数据文件: '{DATA_FILENAME}'...")
+    loaded_data = _download_json_optional(DATA_FILENAME)
+    if loaded_data is None:
+        print(f"  ⚠️ 数据文件在{_get_backend().label}中未找到。将以空数据启动。")
+        return False
+    for name, value in loaded_data.items():
+        target[name] = _decode_section(name, value)
+    print(f"  ✔️ 已读取旧版数据，将在下次保存时迁移为分区布局。")
+    return True
+
+def _apply_journal_record(record: dict, target: dict = None):
+    """把一条日志记录重放到 target；不指定 target 时重放到当前的 data，并记为尚未上传"""
+    if "t" in record:
+        # 事务：一行日志中包含多条修改，要么全部重放，要么（写了一半时）整行被跳过
+        for sub_record in record["t"]:
+            _apply_journal_record(sub_record, target)
+        return
+    staged = target is not None
+    if not staged:
+        target = data
+    section, key = record["s"], record.get("k")
+    if key is None:
+        target[section] = _decode_section(section, record["v"])
+    else:
+        container = target.setdefault(section, {})
+        if section in INT_KEY_SECTIONS:
+            key = int(key)
+        if record.get("d"):
+            container.pop(key, None)
+        else:
+            container[key] = record["v"]
+    if not staged:
+        # 重放出来的修改还没有上传过
+        _track_dirty(section, key)
+
+def _load_from_local(manifest):
+    """读取本地快照并重放其后的日志段"""
+    global _generation, _dirty_count
+    journal = _get_journal()
+    start_seq = 0
+    if manifest is not None:
+        _serializer.reset()
+        if _apply_sectioned(manifest, _read_local_raw, data):
+            _mark_everything_dirty()
+        _generation = manifest.get("generation", 0)
+        start_seq = manifest.get("journal_seq", 0)
+        # 上次已写入本地快照、但还没来得及上传到 Hub 的内容
+        unsynced = manifest.get("unsynced") or {}
+        for name in unsynced.get("sections", []):
+            _track_dirty(name)
+        if unsynced.get("shards"):
+            _dirty_shards.update(unsynced["shards"])
+            _dirty_count += 1
+    replayed = 0
+    for record in journal.replay(start_seq):
+        _apply_journal_record(record)
+        replayed += 1
+    print(f"  ✔️ 已从本地快照恢复数据，并重放了 {replayed} 条日志记录。")
+
+def _load_remote_state(manifest=None) -> dict:
+    """
+    从远端完整加载一份数据，放在独立的字典中返回，不修改当前的 data（可以在线程中执行）。
+    返回 {"data", "generation", "rewrite", "serializer", "conversation_cache"}，由 _apply_remote_state() 在事件循环中应用。
+    """
+    if manifest is None:
+        print(f"  ⏳ 正在尝试从{_get_backend().label}下载数据清单: '{MANIFEST_FILENAME}'...")
+        manifest = _download_json_optional(MANIFEST_FILENAME)
+    target = copy.deepcopy(_DEFAULT_DATA)
+    if manifest is not None:
+        rewrite = _apply_sectioned(manifest, _download_raw_optional, target)
+        generation = manifest.get("generation", 0)
+    else:
+        rewrite = _load_legacy(target)
+        generation = 0
+    print(f"  ✔️ 数据已从云端更新。")
+    return {"data": target, "generation": generation, "rewrite": rewrite, "serializer": IncrementalSerializer(), "conversation_cache": None}
+
+def _apply_remote_state(state: dict):
+    """
+    用 _load_remote_state() 的结果整体替换当前数据。必须在事件循环线程中调用，并且中途没有 await，
+    其他协程因此不会读到只替换了一半的数据。
+    """
+    global _generation, _serializer, _conversation_cache, _dirty_count, _dirty_sections, _dirty_shards
+    new_data = state["data"]
+    for name in [name for name in data if name not in new_data]:
+        del data[name]
+    data.update(new_data)
+    _generation = state["generation"]
+    # 写本地快照时的编码结果正好对应新数据，直接接着用
+    _serializer = state["serializer"]
+    _conversation_cache = state["conversation_cache"]
+    _dirty_count = 0
+    _dirty_sections, _dirty_shards = set(), set()
+    if state["rewrite"]:
+        _mark_everything_dirty()
+    _bump_config_version()
+
+def _seed_local_snapshot(state: dict):
+    """把刚从云端加载的完整数据（state，尚未应用）写成本地快照，并丢弃旧的本地日志"""
+    try:
+        source, serializer = state["data"], state["serializer"]
+        journal = _get_journal()
+        journal_seq = journal.rotate()
+        journal.drop_segments_before(journal_seq)
+        files = {
+            _section_path(name): serializer.encode_full(_section_path(name), source[name], int_keys=name in INT_KEY_SECTIONS)
+            for name in source if name != "conversation_history"
+        }
+        grouped = {shard: {} for shard in range(CONVERSATION_SHARDS)}
+        for key, history in source["conversation_history"].items():
+            grouped[_conversation_shard(key)][key] = history
+        files.update({_shard_path(shard): serializer.encode_full(_shard_path(shard), content) for shard, content in grouped.items()})
+        # 需要重写时所有文件都还没有按新布局上传过
+        unsynced = ({name for name in source if name != "conversation_history"}, set(range(CONVERSATION_SHARDS))) if state["rewrite"] else (set(), set())
+        files[MANIFEST_FILENAME] = _build_manifest(journal_seq, unsynced=unsynced, source=source, generation=state["generation"])
+        local_store.write_files_atomic(LOCAL_DATA_DIR, files)
+    except Exception as e:
+        print(f"  ⚠️ 写入本地快照失败，本地持久化暂不可用: {e}")
+
+def _load_json_source() -> dict:
+    """
+    按 JSON 存储的加载顺序（本地快照 + 日志 / 更新的远端分区 / 旧版单文件）读出完整数据，
+    放在独立的字典中返回，不修改当前的 data（可以在线程中执行）。用于一次性导入 SQLite 数据库。
+    """
+    local_manifest = _read_local_json(MANIFEST_FILENAME)
+    journal = _get_journal()
+    if local_manifest is not None or journal.has_segments():
+        remote_manifest = _download_json_optional(MANIFEST_FILENAME) if _remote_configured() else None
+        local_generation = (local_manifest or {}).get("generation", 0)
+        if remote_manifest is not None and remote_manifest.get("generation", 0) > local_generation:
+            print("  ⚠️ 云端数据比本地快照更新，将丢弃本地数据并从云端加载。")
+            return _load_remote_state(remote_manifest)["data"]
+        target = copy.deepcopy(_DEFAULT_DATA)
+        start_seq = 0
+        if local_manifest is not None:
+            _apply_sectioned(local_manifest, _read_local_raw, target)
+            start_seq = local_manifest.get("journal_seq", 0)
+        for record in journal.replay(start_seq):
+            _apply_journal_record(record, target)
+        print("  ✔️ 已读取本地 JSON 快照。")
+        return target
+    if _remote_configured():
+        return _load_remote_state()["data"]
+    print(f"  ⚠️ 远端存储（{_get_backend().label}）未正确配置，且本地目录 '{LOCAL_DATA_DIR}' 中没有数据。\n     机器人将以空数据启动，数据只会保存在本地。")
+    return copy.deepcopy(_DEFAULT_DATA)
+
+def _restore_sqlite_backup():
+    """本地没有数据库时，尝试从远端存储下载最近一次的备份"""
+    print(f"  ⏳ 本地没有 SQLite 数据库，正在尝试从{_get_backend().label}下载备份: '{SQLITE_FILENAME_IN_REPO}'...")
+    if not _get_backend().read_to_file(SQLITE_FILENAME_IN_REPO, SQLITE_PATH):
+        print("  ℹ️ 云端没有数据库备份。")
         return
+    print("  ✔️ 已从云端恢复数据库备份。")
 
+def _open_sqlite_store():
+    """
+    打开 SQLite 数据库（本地没有时先下载备份，数据库为空时从 JSON 数据导入），不修改当前的 data（可以在线程中执行）。
+    返回 {"store", "sections", "imported"}，由 _install_sqlite_store() 在事件循环中安装；导入前加载已被取消时返回 None。
+    """
+    if not os.path.exists(SQLITE_PATH) and _remote_configured():
+        _restore_sqlite_backup()
+    store = sqlite_store.SQLiteStore(SQLITE_PATH, resident_max_entries=SQLITE_RESIDENT_MAX_ENTRIES)
+    imported = False
     try:
-        print(f"  ⏳ 正在尝试从 Hugging Face Hub 下载数据文件: '{DATA_FILENAME}'...")
-        local_path = hf_hub_download(repo_id=HF_DATA_REPO_ID, filename=DATA_FILENAME, repo_type="dataset", token=HF_TOKEN)
-        
-        with open(local_path, 'r', encoding='utf-8') as f:
-            loaded_data = json.load(f)
-
-        current_data_for_comparison = {key: data[key] for key in loaded_data.keys() if key in data}
-        if loaded_data == current_data_for_comparison:
-            print("  ✔️ 数据与云端一致，跳过同步。")
-            return
-
-        data.update(loaded_data)
-        data["user_data"] = {int(k): v for k, v in data.get("user_data", {}).items()}
-        data["autoreact_map"] = {int(k): v for k, v in data.get("autoreact_map", {}).items()}
-        print(f"  ✔️ 数据已从云端更新。")
-    except HfHubHTTPError as e:
-        if e.response.status_code == 404:
-            print(f"  ⚠️ 数据文件 '{DATA_FILENAME}' 在仓库中未找到。将以空数据启动。")
-        elif e.response.status_code == 401:
+        if store.is_empty():
+            # 一次性导入：沿用 JSON 存储的加载流程（本地快照 / Hub 分区 / 旧版单文件），再整体写入数据库
+            print("  ⏳ SQLite 数据库为空，正在从现有 JSON 数据导入...")
+            source = _load_json_source()
+            if _load_cancelled.is_set():
+                # 数据库保持为空，下次启动时重新导入
+                store.close()
+                return None
+            store.import_data(source)
+            imported = True
+            print("  ✔️ 已将现有数据导入 SQLite 数据库。")
+        sections = store.load_resident_sections()
+    except Exception:
+        store.close()
+        raise
+    print(f"  ✔️ 已打开 SQLite 数据库 '{SQLITE_PATH}'，用户与对话记录将按需加载。")
+    return {"store": store, "sections": sections, "imported": imported}
+
+def _install_sqlite_store(state: dict):
+    """在事件循环线程中安装 _open_sqlite_store() 的结果，中途没有 await"""
+    global _sqlite, _dirty_count, _dirty_sections, _dirty_shards
+    store = state["store"]
+    data.update(state["sections"])
+    for section in sqlite_store.LAZY_SECTIONS:
+        data[section] = store.table_map(section)
+    _dirty_sections, _dirty_shards = set(), set()
+    if state["imported"]:
+        # 新建的数据库需要尽快备份一次
+        _dirty_count += 1
+    _sqlite = store
+
+def _discard_loaded_state(state: dict):
+    """丢弃没有被应用的加载结果"""
+    if "store" in state:
+        state["store"].close()
+
+def _build_conversation_cache(target: dict) -> ConversationCache:
+    """
+    把 target 中的对话历史放入有界缓存，超出预算的部分写入本地冷存储；
+    CONVERSATION_FOLLOWER_SECTIONS 换成跟随对话历史一起淘汰的缓存。返回对话历史的缓存。
+    """
+    cache = ConversationCache(
+        ColdStore(os.path.join(LOCAL_DATA_DIR, "cold_conversations")),
+        max_entries=CONVERSATION_CACHE_MAX_ENTRIES, max_bytes=CONVERSATION_CACHE_MAX_BYTES
+    )
+    cache.load(target["conversation_history"])
+    target["conversation_history"] = cache
+    for section in CONVERSATION_FOLLOWER_SECTIONS:
+        follower = ConversationCache(ColdStore(os.path.join(LOCAL_DATA_DIR, f"cold_{section}")), cache.max_entries, cache.max_bytes, leader=cache)
+        follower.load(target.get(section) or {})
+        target[section] = follower
+    stats = cache.stats()
+    if stats["cold_entries"]:
+        print(f"  ℹ️ 共 {len(cache)} 个对话，其中 {stats['cold_entries']} 个不常用的对话已移入本地冷存储。")
+    return cache
+
+def _install_conversation_cache():
+    """把当前已加载的对话历史换成有界缓存"""
+    global _conversation_cache
+    _conversation_cache = _build_conversation_cache(data)
+
+def _seed_conversation_activity():
+    """旧数据中没有活跃日期的对话按今天计算，避免升级后被立即清理"""
+    last_active = data.setdefault("conversation_last_active", {})
+    # 一次取出全部 key 再比较：SQLite 模式下逐个判断 key 会逐条查询数据库并把条目读进内存
+    known = set(last_active)
+    missing = [key for key in data["conversation_history"] if key not in known]
+    if missing:
+        today = _today()
+        for key in missing:
+            last_active[key] = today
+            # 按条目记录：SQLite 模式下这个分区按需加载，不能整体写入
+            _mark_dirty("conversation_last_active", key)
+
+def _reset_state():
+    """丢弃已加载的本地数据，回到空白状态"""
+    global _dirty_count, _dirty_sections, _dirty_shards
+    data.clear()
+    data.update(copy.deepcopy(_DEFAULT_DATA))
+    _serializer.reset()
+    _dirty_count = 0
+    _dirty_sections, _dirty_shards = set(), set()
+
+def _report_load_error(e: Exception):
+    if isinstance(e, HfHubHTTPError):
+        if e.response is not None and e.response.status_code == 404:
+            print(f"  ⚠️ 数据文件在仓库中未找到。将以空数据启动。")
+        elif e.response is not None and e.response.status_code == 401:
             print(f"  ❌ 错误：Hugging Face Hub API令牌 (HF_TOKEN) 无效或没有足够权限访问仓库。")
         else:
             print(f"  ❌ 从 Hub 下载数据时发生 HTTP 错误: {e}")
+    else:
+        print(f"  ❌ 加载数据时发生未知错误: {e}")
+
+def load_local_snapshot() -> bool:
+    """
+    启动第一阶段：只读取本地快照 / 本地数据库，不访问网络，通常在毫秒级完成。
+    返回是否找到了本地数据；之后需要调用 sync_with_remote() 与远端核对。
+    """
+    print("\n--- 数据持久化状态 (本地快照) ---")
+    found = False
+    try:
+        if DATA_STORE == "sqlite":
+            if os.path.exists(SQLITE_PATH):
+                state = _open_sqlite_store()
+                if state is not None:
+                    _install_sqlite_store(state)
+                    found = True
+        else:
+            local_manifest = _read_local_json(MANIFEST_FILENAME)
+            if local_manifest is not None or _get_journal().has_segments():
+                _load_from_local(local_manifest)
+                found = True
+        if not found:
+            print("  ℹ️ 本地没有数据快照，将等待从远端加载。")
     except Exception as e:
-        print(f"  ❌ 从 Hub 加载数据时发生未知错误: {e}")
+        _report_load_error(e)
+        # 本地数据不完整时不能作为起点，交给远端重新加载
+        _reset_state()
+        found = False
+    _bump_config_version()
     print("---------------------------------")
+    return found
 
-async def save_data_to_hf():
-    if not HF_TOKEN or not HF_DATA_REPO_ID or HF_DATA_REPO_ID == "SETUP_YOUR_HF_DATA_REPO_ID_ENV_VAR":
+def sync_with_remote(local_found: bool):
+    """
+    启动第二阶段（阻塞，可以放在线程中执行）：本地有快照时只检查远端是否更新，否则从远端完整加载。
+    远端数据加载到独立的字典中（连同对话缓存一起准备好）并返回，SQLite 模式下本地没有数据库时在这里打开（必要时导入）数据库，
+    两种情况都不修改当前的 data；
+    没有需要替换的数据、或加载已被 cancel_loading() 取消时返回 None。结果由 _complete_loading() 在事件循环中应用。
+    """
+    print("\n--- 数据持久化状态 (远端核对) ---")
+    state = None
+    try:
+        if DATA_STORE == "sqlite":
+            # SQLite 模式下远端只是备份，本地数据库就是权威数据
+            if not local_found:
+                state = _open_sqlite_store()
+        elif local_found:
+            remote_manifest = _download_json_optional(MANIFEST_FILENAME) if _remote_configured() else None
+            if remote_manifest is not None and remote_manifest.get("generation", 0) > _generation:
+                print("  ⚠️ 云端数据比本地快照更新，将丢弃本地数据并从云端加载。")
+                state = _load_remote_state(remote_manifest)
+            else:
+                print(f"  ✔️ 本地快照已是最新（第 {_generation} 代）。")
+        elif _remote_configured():
+            state = _load_remote_state()
+        else:
+            print(f"  ⚠️ 远端存储（{_get_backend().label}）未正确配置，且本地目录 '{LOCAL_DATA_DIR}' 中没有数据。\n     机器人将以空数据启动，数据只会保存在本地。")
+        if state is not None and _load_cancelled.is_set():
+            # 已经开始关机：不再改写本地快照和日志，本地数据保持原样
+            print("  ⚠️ 加载已取消，放弃刚下载的云端数据。")
+            _discard_loaded_state(state)
+            state = None
+        if state is not None and "store" not in state:
+            _seed_local_snapshot(state)
+            # 加载期间还没有安装过对话缓存，冷存储目录可以安全地重建
+            state["conversation_cache"] = _build_conversation_cache(state["data"])
+    except Exception as e:
+        _report_load_error(e)
+        state = None
+    print("---------------------------------")
+    return state
+
+def _complete_loading(state):
+    """在事件循环线程中应用 sync_with_remote() 的结果，并建立对话缓存"""
+    try:
+        if state is None:
+            if _sqlite is None and _conversation_cache is None:
+                _install_conversation_cache()
+        elif "store" in state:
+            _install_sqlite_store(state)
+        else:
+            _apply_remote_state(state)
+        _seed_conversation_activity()
+    except Exception as e:
+        _report_load_error(e)
+    _bump_config_version()
+
+def _bump_config_version():
+    """数据被整体加载或替换后，所有缓存的系统指令都要作废"""
+    global _config_version
+    _config_version += 1
+
+def get_config_version() -> int:
+    """影响系统指令的配置的版本号，相关配置每次修改或重新加载时递增"""
+    return _config_version
+
+def load_data_from_hf():
+    """同步地完成全部加载（本地快照 + 远端核对），用于不需要并行启动的场景"""
+    global _state_ready
+    _complete_loading(sync_with_remote(load_local_snapshot()))
+    _state_ready = True
+
+async def finish_loading(local_found: bool):
+    """
+    在后台线程中完成远端核对，再回到事件循环一次性应用结果，然后打开就绪闸门并启动后台刷新任务。
+    线程不能被取消，任务被取消时线程仍在 _sync_future 中运行，由 stop_background_flusher() 等待它结束。
+    """
+    global _state_ready, _sync_future
+    _sync_future = asyncio.get_running_loop().run_in_executor(None, sync_with_remote, local_found)
+    state = await asyncio.shield(_sync_future)
+    if _load_cancelled.is_set():
+        if state is not None:
+            _discard_loaded_state(state)
         return
+    _complete_loading(state)
+    _state_ready = True
+    if _ready_event is not None:
+        _ready_event.set()
+    start_background_flusher()
 
-    temp_dir = tempfile.gettempdir()
-    temp_path = os.path.join(temp_dir, f"temp_upload_{DATA_FILENAME}")
-    
-    data_to_save = data.copy()
-    data_to_save["user_data"] = {str(k): v for k, v in data["user_data"].items()}
-    data_to_save["autoreact_map"] = {str(k): v for k, v in data["autoreact_map"].items()}
-    
+def cancel_loading():
+    """关机时调用：还在进行的远端核对不再写本地快照，结果也不会被应用"""
+    _load_cancelled.set()
+
+def is_ready() -> bool:
+    """数据是否已经与远端核对完毕，可以安全地读取和修改"""
+    return _state_ready
+
+async def wait_until_ready(timeout: float = None) -> bool:
+    """等待数据加载完成，超时返回 False"""
+    global _ready_event
+    if _state_ready:
+        return True
+    if _ready_event is None:
+        _ready_event = asyncio.Event()
     try:
-        with open(temp_path, 'w', encoding='utf-8') as f:
-            json.dump(data_to_save, f, indent=2, ensure_ascii=False)
-        
-        commit_msg = f"chore: Bot data auto-update at {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}"
-        upload_file(path_or_fileobj=temp_path, path_in_repo=DATA_FILENAME, repo_id=HF_DATA_REPO_ID, repo_type="dataset", token=HF_TOKEN, commit_message=commit_msg)
-        print(f"✔️ 数据已即时同步至 Hugging Face Hub。")
+        await asyncio.wait_for(_ready_event.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+# --- 保存 ---
+async def save_data_to_hf():
+    """
+    把脏分区和脏分片折叠进本地快照，然后把同一批文件（以及 manifest）作为一次提交交给上传工作线程。
+    成功（或未配置 Hub）时返回 True，上传失败时脏标记会被保留以便重试。
+    """
+    global _flush_failing, _dirty_sections, _dirty_shards, _generation
+    if _sqlite is not None:
+        return await _backup_sqlite_to_hub()
+    sections, shards = _dirty_sections, _dirty_shards
+    _dirty_sections, _dirty_shards = set(), set()
+
+    files = {_section_path(name): _encode_section(name) for name in sections if name in data}
+    files.update(_encode_shards(shards))
+    _generation += 1
+    journal = _get_journal()
+    journal_seq = journal.rotate()
+    remote_manifest = _build_manifest(journal_seq)
+
+    # 1. 折叠进本地快照：此后 journal_seq 之前的日志段就不再需要了
+    try:
+        local_files = dict(files)
+        local_files[MANIFEST_FILENAME] = _build_manifest(journal_seq, unsynced=(sections, shards) if _remote_configured() else None)
+        await asyncio.to_thread(local_store.write_files_atomic, LOCAL_DATA_DIR, local_files)
+        journal.drop_segments_before(journal_seq)
+    except Exception as e:
+        # 日志段仍然保留，重启时会被重放，数据不会丢失
+        print(f"⚠️ 写入本地快照失败: {e}")
+
+    if not _remote_configured():
+        return True
+
+    # 2. 上传快照到 Hub
+    try:
+        files[MANIFEST_FILENAME] = remote_manifest
+
+        commit_msg = f"chore: Bot data auto-update at {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')} ({len(sections)} sections, {len(shards)} shards)"
+        await _commit_to_remote(files, commit_msg)
+        print(f"✔️ 数据已同步至 {_get_backend().label}（{len(sections)} 个分区，{len(shards)} 个会话分片）。")
+        _flush_failing = False
+        try:
+            # 上传成功，本地 manifest 不再需要记录未同步的内容
+            await asyncio.to_thread(local_store.write_files_atomic, LOCAL_DATA_DIR, {MANIFEST_FILENAME: _build_manifest(journal_seq, unsynced=(_dirty_sections, _dirty_shards))})
+        except Exception as e:
+            print(f"⚠️ 更新本地快照清单失败: {e}")
+        return True
     except Exception as e:
-        err_msg = f"向 Hub 保存数据时发生严重错误: {e}"
-        print(f"❌ {err_msg}")
-        if _send_dm_to_owner_func:
-            asyncio.create_task(_send_dm_to_owner_func(f"【🚨 数据保存失败】\n{err_msg}"))
+        # 失败时把脏标记放回去，等待下次重试
+        _dirty_sections |= sections
+        _dirty_shards |= shards
+        _report_save_failure(e)
+        return False
+
+async def _backup_sqlite_to_hub():
+    """SQLite 模式下的保存：等待写线程提交完毕，然后把数据库的在线备份上传到 Hub"""
+    global _flush_failing, _dirty_sections, _dirty_shards
+    # 数据库本身就是持久化存储，分区级别的脏标记在此模式下没有意义
+    _dirty_sections, _dirty_shards = set(), set()
+    await _sqlite.drain()
+    if not _remote_configured():
+        return True
+
+    backup_path = f"{SQLITE_PATH}.backup"
+    try:
+        await _sqlite.backup(backup_path)
+        commit_msg = f"chore: Bot database backup at {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}"
+        await _commit_to_remote({SQLITE_FILENAME_IN_REPO: backup_path}, commit_msg)
+        print(f"✔️ 数据库备份已上传至 {_get_backend().label}。")
+        _flush_failing = False
+        return True
+    except Exception as e:
+        _report_save_failure(e)
+        return False
     finally:
-        if os.path.exists(temp_path):
-            try: os.remove(temp_path)
-            except Exception as e: print(f"无法移除临时文件: {e}")
+        if os.path.exists(backup_path):
+            try: os.remove(backup_path)
+            except Exception as e: print(f"无法移除临时备份文件: {e}")
+
+def _report_save_failure(e: Exception):
+    global _flush_failing
+    err_msg = f"向{_get_backend().label}保存数据时发生严重错误: {e}"
+    print(f"❌ {err_msg}")
+    # 后台会持续重试，只在连续失败的第一次通知主人，避免刷屏
+    if _send_dm_to_owner_func and not _flush_failing:
+        asyncio.create_task(_send_dm_to_owner_func(f"【🚨 数据保存失败】\n{err_msg}\n数据已保存在本地，后台将继续重试上传。"))
+    _flush_failing = True
+
+# --- 写回缓存：标记脏数据与后台刷新 ---
+def _build_record(section: str, key=None):
+    container = data.get(section)
+    if key is None:
+        return {"s": section, "v": {item_key: container.peek(item_key) for item_key in container} if isinstance(container, ConversationCache) else container}
+    if key in container:
+        value = container.peek(key) if isinstance(container, ConversationCache) else container[key]
+        return {"s": section, "k": key, "v": value}
+    return {"s": section, "k": key, "d": 1}
+
+def _wrap_lazy_section(section: str, key=None):
+    """
+    SQLite 模式下记录提交给写线程之后调用：整体替换了按需加载的分区时重新包装为 TableMap；
+    单条修改则告诉 TableMap 这条写入的序号，写线程处理完之后该条目才可以被淘汰。
+    """
+    container = data.get(section)
+    if key is None and section in sqlite_store.LAZY_SECTIONS and not isinstance(container, sqlite_store.TableMap):
+        data[section] = _sqlite.table_map(section, resident=container)
+    elif key is not None and isinstance(container, sqlite_store.TableMap):
+        container.submitted(key, _sqlite.submitted)
+
+def _mark_dirty(section: str, key=None):
+    """
+    记录一次修改：先追加到本地预写日志（只写缓冲区，fsync 批量进行），再标记对应的分区/分片为脏。
+    key 为字典类分区中被修改的条目，为 None 时表示整个分区被替换。
+    真正的上传由后台刷新任务合并完成，只会提交被标记的分区/分片。
+    处于 transaction() 中时只登记修改，退出事务时再统一写入。
+    """
+    global _config_version
+    if section in INSTRUCTION_SECTIONS:
+        _config_version += 1
+    pending = _current_transaction.get()
+    if pending is not None:
+        pending[(section, key)] = None
+        return
+    record = _build_record(section, key)
+    if _sqlite is not None:
+        # SQLite 模式：记录交给写线程提交，本身即为持久化，无需预写日志
+        _sqlite.apply(record)
+        _wrap_lazy_section(section, key)
+    else:
+        try:
+            _get_journal().append(record)
+        except Exception as e:
+            print(f"⚠️ 写入本地日志失败: {e}")
+    _track_dirty(section, key)
+    _after_change()
+
+def _after_change():
+    start_background_flusher()
+    # SQLite 模式下写入已在本地落盘，上传备份只按固定间隔进行
+    if _sqlite is None and _dirty_count >= FLUSH_DIRTY_THRESHOLD and _flush_event:
+        _flush_event.set()
+
+def _commit_transaction(changes):
+    """把事务中登记的修改作为一条记录写入（日志中的一行 / SQLite 中的一个事务），并只计为一次修改"""
+    global _dirty_count
+    records = [_build_record(section, key) for section, key in changes]
+    if _sqlite is not None:
+        _sqlite.apply_many(records)
+        for section, key in changes:
+            _wrap_lazy_section(section, key)
+    else:
+        try:
+            _get_journal().append({"t": records})
+        except Exception as e:
+            print(f"⚠️ 写入本地日志失败: {e}")
+    for section, key in changes:
+        _track_dirty(section, key, count=False)
+    _dirty_count += 1
+    _after_change()
+
+@asynccontextmanager
+async def transaction(flush_on_exit: bool = False):
+    """
+    把一组修改合并为一次持久化：
+
+        async with data_manager.transaction():
+            await data_manager.set_bot_mode(...)
+            await data_manager.set_system_prompt(...)
+
+    事务内的修改照常立即作用于内存中的数据，但只在退出时写入一次（同一条目被多次修改只记录最终值）。
+    flush_on_exit=True 时退出后立即提交到 Hub，否则交给后台刷新任务合并提交。
+    即使事务内抛出异常，已经发生的修改也会被持久化，保证内存与存储一致。嵌套的事务会并入最外层。
+    """
+    if _current_transaction.get() is not None:
+        yield
+        return
+    changes = {}
+    token = _current_transaction.set(changes)
+    try:
+        yield
+    finally:
+        _current_transaction.reset(token)
+        if changes:
+            _commit_transaction(changes)
+    if changes and flush_on_exit:
+        await flush()
+
+@asynccontextmanager
+async def lock(section: str, key):
+    """
+    针对单个条目的异步锁，用于“读取 → 等待（例如调用 AI）→ 写回”这类流程：
+
+        async with data_manager.lock("conversation_history", key):
+            history = data_manager.get_conversation_history(key)
+            ...
+            await data_manager.update_conversation_history(key, new_history)
+
+    不同 key 之间互不影响，可以完全并发。锁不可重入，持有期间不要再次获取同一个 key 的锁。
+    """
+    lock_key = (section, key)
+    entry = _key_locks.get(lock_key)
+    if entry is None:
+        entry = _key_locks[lock_key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _key_locks[lock_key]
+
+def user_lock(user_id: int):
+    return lock("user_data", user_id)
+
+def conversation_lock(key: str):
+    return lock("conversation_history", key)
+
+def has_pending_changes():
+    """是否存在尚未提交到 Hub 的修改"""
+    return _dirty_count > 0
+
+def start_background_flusher():
+    """在当前事件循环中启动后台刷新任务（重复调用是安全的）"""
+    global _flush_event, _flush_lock, _flusher_task
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # 没有运行中的事件循环（例如在同步上下文中被调用），等下次修改时再启动
+        return
+    if _flusher_task and not _flusher_task.done():
+        return
+    _flush_event = asyncio.Event()
+    _flush_lock = asyncio.Lock()
+    _flusher_task = loop.create_task(_flush_loop())
+
+async def _flush_loop():
+    global _last_expiry_check
+    while True:
+        interval = SQLITE_BACKUP_INTERVAL_SECONDS if _sqlite is not None else FLUSH_INTERVAL_SECONDS
+        # 不用 wait_for：事件恰好在取消时被设置的话，wait_for 会吞掉取消，关机时就一直等不到这个任务结束
+        waiter = asyncio.ensure_future(_flush_event.wait())
+        try:
+            await asyncio.wait([waiter], timeout=interval)
+        finally:
+            waiter.cancel()
+        _flush_event.clear()
+        if not _state_ready:
+            # 还没有与远端核对过：启动加载期间的修改只写本地日志，就绪后再上传
+            continue
+        if CONVERSATION_TTL_DAYS > 0 and time.monotonic() - _last_expiry_check >= CONVERSATION_EXPIRY_CHECK_SECONDS:
+            _last_expiry_check = time.monotonic()
+            try:
+                await expire_idle_conversations()
+            except Exception as e:
+                print(f"❌ 清理不活跃对话时出错: {e}")
+        if _dirty_count:
+            try:
+                await flush()
+            except Exception as e:
+                print(f"❌ 后台数据刷新任务出错: {e}")
+
+async def flush(force: bool = False):
+    """
+    立即将内存中的修改提交到 Hub。用于关机、主人指令等需要确保落盘的场景。
+    force=True 时即使没有修改也会提交一次（仅包含 manifest）。返回是否成功。
+    数据还没有与远端核对完毕时不上传（可能覆盖云端更新的数据），直接返回 False。
+    """
+    global _dirty_count
+    if not _state_ready:
+        return False
+    if _flush_lock is None:
+        start_background_flusher()
+    if _flush_lock is None:
+        return await save_data_to_hf()
+    async with _flush_lock:
+        if not _dirty_count and not force:
+            return True
+        pending = _dirty_count
+        ok = await save_data_to_hf()
+        if ok:
+            # 上传过程中产生的新修改保留到下一次刷新
+            _dirty_count = max(0, _dirty_count - pending)
+        return ok
+
+async def stop_background_flusher():
+    """停止后台刷新任务，并把剩余修改提交一次"""
+    global _flusher_task, _hub_worker
+    if _flusher_task and not _flusher_task.done():
+        _flusher_task.cancel()
+        try:
+            await _flusher_task
+        except asyncio.CancelledError:
+            pass
+    _flusher_task = None
+    if _sync_future is not None and not _sync_future.done():
+        # 后台核对线程无法中断，等它结束后再关闭本地日志和数据库
+        cancel_loading()
+        print("⏳ 正在等待数据加载线程结束...")
+        await asyncio.wait([_sync_future])
+    if not _state_ready:
+        # 还没有与远端核对过，不能用本地数据覆盖云端；未上传的修改仍保存在本地日志中
+        print("⚠️ 数据尚未加载完成，跳过关机前的上传。")
+    elif _dirty_count:
+        await flush()
+    if _hub_worker is not None:
+        await asyncio.to_thread(_hub_worker.shutdown)
+        _hub_worker = None
+    if _journal is not None:
+        _journal.close()
+    if _sqlite is not None:
+        _sqlite.close()
+
+def get_persistence_stats():
+    """返回 Hub 上传工作线程的排队与耗时统计"""
+    stats = _get_hub_worker().stats()
+    stats["dirty_changes"] = _dirty_count
+    stats["failing"] = _flush_failing
+    stats["serializer"] = _serializer.stats()
+    return stats
 
 # --- 提供对数据的访问接口 ---
 def get_user_data(user_id: int):
@@ -108,17 +1053,127 @@ def get_user_data(user_id: int):
 
 async def update_user_data(user_id: int, new_data: dict):
     data["user_data"][user_id] = new_data
-    await save_data_to_hf()
+    _mark_dirty("user_data", user_id)
+
+async def modify_user_data(user_id: int, mutator, default: dict = None):
+    """
+    原子地修改用户数据：在该用户的锁内读取一份副本（不存在时使用 default），交给 mutator 就地修改后写回。
+    mutator 返回 False 表示放弃修改（不写回）。返回修改后的数据（放弃时为修改前的数据）。
+    """
+    async with user_lock(user_id):
+        current = data["user_data"].get(user_id)
+        user_data = copy.deepcopy(current if current is not None else (default or {}))
+        if mutator(user_data) is False:
+            return current if current is not None else user_data
+        await update_user_data(user_id, user_data)
+        return user_data
     
 def get_private_chat_users():
     return data["private_chat_users"]
 
+async def add_private_chat_user(user_id: int):
+    if user_id not in data["private_chat_users"]:
+        data["private_chat_users"].append(user_id)
+        _mark_dirty("private_chat_users")
+
+async def remove_private_chat_user(user_id: int):
+    if user_id in data["private_chat_users"]:
+        data["private_chat_users"].remove(user_id)
+        _mark_dirty("private_chat_users")
+
+def _peek(container, key, default=None):
+    """读取一个条目但不改变缓存状态（冷存储或数据库中的条目不放回内存）"""
+    peek = getattr(container, "peek", None)
+    return peek(key, default) if peek is not None else container.get(key, default)
+
 def get_conversation_history(key: str):
     return data["conversation_history"].get(key, [])
 
+def _today():
+    return int(time.time() // 86400)
+
 async def update_conversation_history(key: str, history: list):
     data["conversation_history"][key] = history
-    await save_data_to_hf()
+    _mark_dirty("conversation_history", key)
+    # 活跃日期按天记录，同一天内的多次写入不会重复标记
+    last_active = data.setdefault("conversation_last_active", {})
+    today = _today()
+    if last_active.get(key) != today:
+        last_active[key] = today
+        _mark_dirty("conversation_last_active", key)
+
+def get_conversation_summary(key: str) -> str:
+    entry = data.get("conversation_summaries", {}).get(key)
+    return entry["text"] if entry else ""
+
+async def set_conversation_summary(key: str, text: str, newly_folded: int):
+    """保存对话的新总结；newly_folded 为这次并入总结的消息数，累计到 folded_turns"""
+    summaries = data.setdefault("conversation_summaries", {})
+    previous = summaries.get(key) or {}
+    summaries[key] = {
+        "text": text,
+        "folded_turns": previous.get("folded_turns", 0) + newly_folded,
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+    }
+    _mark_dirty("conversation_summaries", key)
+
+async def clear_conversation_summary(key: str):
+    summaries = data.setdefault("conversation_summaries", {})
+    if key in summaries:
+        del summaries[key]
+        _mark_dirty("conversation_summaries", key)
+
+async def modify_conversation_history(key: str, mutator):
+    """在该对话的锁内读取历史副本，交给 mutator 返回新的历史并写回；返回写入的历史"""
+    async with conversation_lock(key):
+        history = mutator(list(get_conversation_history(key)))
+        await update_conversation_history(key, history)
+        return history
+
+async def clear_all_conversation_history():
+    async with transaction():
+        for section in ("conversation_history",) + CONVERSATION_FOLLOWER_SECTIONS:
+            if isinstance(data[section], ConversationCache):
+                data[section].clear()
+            else:
+                data[section] = {}
+            _mark_dirty(section)
+
+async def expire_idle_conversations() -> int:
+    """删除超过 CONVERSATION_TTL_DAYS 天没有新消息的对话，返回删除的数量"""
+    if CONVERSATION_TTL_DAYS <= 0:
+        return 0
+    cutoff = _today() - CONVERSATION_TTL_DAYS
+    last_active = data.setdefault("conversation_last_active", {})
+    expired = []
+    for index, key in enumerate(list(last_active)):
+        if _peek(last_active, key, cutoff) < cutoff:
+            expired.append(key)
+        if index % EXPIRY_SCAN_BATCH == EXPIRY_SCAN_BATCH - 1:
+            # 冷存储 / 数据库中的条目要逐个读取，分批让出事件循环
+            await asyncio.sleep(0)
+    if not expired:
+        return 0
+    conversations = data["conversation_history"]
+    async with transaction():
+        # 扫描期间有新消息的对话不再删除
+        expired = [key for key in expired if _peek(last_active, key, cutoff) < cutoff]
+        for key in expired:
+            if key in conversations:
+                del conversations[key]
+                _mark_dirty("conversation_history", key)
+            await clear_conversation_summary(key)
+            del last_active[key]
+            _mark_dirty("conversation_last_active", key)
+    if expired:
+        print(f"🧹 已清理 {len(expired)} 个超过 {CONVERSATION_TTL_DAYS} 天不活跃的对话。")
+    return len(expired)
+
+def get_conversation_cache_stats():
+    """对话缓存的命中/未命中/淘汰统计；sqlite 模式下没有缓存，返回 None"""
+    if _conversation_cache is None or data["conversation_history"] is not _conversation_cache:
+        return None
+    return _conversation_cache.stats()
 
 def get_logging_config(server_id: int):
     return data["logging_config"].get(str(server_id))
@@ -128,12 +1183,12 @@ async def set_logging_config(server_id: int, channel_id: int, log_types: list):
     for log_type in log_types:
         config[log_type] = channel_id
     data["logging_config"][str(server_id)] = config
-    await save_data_to_hf()
+    _mark_dirty("logging_config", str(server_id))
 
 async def remove_logging_config(server_id: int):
     if str(server_id) in data["logging_config"]:
         del data["logging_config"][str(server_id)]
-        await save_data_to_hf()
+        _mark_dirty("logging_config", str(server_id))
 
 def get_all_logging_configs():
     return data["logging_config"]
@@ -143,7 +1198,7 @@ def get_global_logging_config():
 
 async def set_global_logging_config(log_types: dict):
     data["global_logging_config"] = log_types
-    await save_data_to_hf()
+    _mark_dirty("global_logging_config")
 
 def get_filtered_words():
     return data["filtered_words"]
@@ -151,80 +1206,80 @@ def get_filtered_words():
 async def add_filtered_word(word: str):
     if word not in data["filtered_words"]:
         data["filtered_words"].append(word)
-        await save_data_to_hf()
+        _mark_dirty("filtered_words")
 
 async def remove_filtered_word(word: str):
     if word in data["filtered_words"]:
         data["filtered_words"].remove(word)
-        await save_data_to_hf()
+        _mark_dirty("filtered_words")
 
 def get_short_reply_mode():
     return data.get("short_reply_mode", False)
 
 async def set_short_reply_mode(state: bool):
     data["short_reply_mode"] = state
-    await save_data_to_hf()
+    _mark_dirty("short_reply_mode")
 
 def get_personas():
     return data["personas"]
 
 async def set_persona(name: str, content: str):
     data["personas"][name] = content
-    await save_data_to_hf()
+    _mark_dirty("personas", name)
 
 async def remove_persona(name: str):
     if name in data["personas"]:
         del data["personas"][name]
-        await save_data_to_hf()
+        _mark_dirty("personas", name)
 
 def get_bot_mode():
     return data.get("bot_mode", "chat")
 
 async def set_bot_mode(mode: str):
     data["bot_mode"] = mode
-    await save_data_to_hf()
+    _mark_dirty("bot_mode")
 
 def get_system_prompt():
     return data.get("system_prompt", "")
 
 async def set_system_prompt(prompt: str):
     data["system_prompt"] = prompt
-    await save_data_to_hf()
+    _mark_dirty("system_prompt")
 
 def get_start_prompt():
     return data.get("start_prompt", "")
 
 async def set_start_prompt(prompt: str):
     data["start_prompt"] = prompt
-    await save_data_to_hf()
+    _mark_dirty("start_prompt")
 
 def get_end_prompt():
     return data.get("end_prompt", "")
 
 async def set_end_prompt(prompt: str):
     data["end_prompt"] = prompt
-    await save_data_to_hf()
+    _mark_dirty("end_prompt")
 
 def get_active_persona():
     return data.get("active_persona", "")
 
 async def set_active_persona(persona_name: str):
     data["active_persona"] = persona_name
-    await save_data_to_hf()
+    _mark_dirty("active_persona")
 
 def get_word_count_request():
     return data.get("word_count_request", "")
 
 async def set_word_count_request(request: str):
     data["word_count_request"] = request
-    await save_data_to_hf()
+    _mark_dirty("word_count_request")
 
 def get_heat_mode():
     return data.get("heat_mode", False)
 
 async def set_heat_mode(state: bool):
     data["heat_mode"] = state
-    await save_data_to_hf()
+    _mark_dirty("heat_mode")
 
 def get_global_memory_log():
     """获取全局记忆日志"""
@@ -250,6 +1305,4 @@ async def add_to_global_memory(user_id: int, user_name: str, message: str, bot_r
     else:
         data["global_memory_log"] = memory_log
         
-    await save_data_to_hf()
-
-os.environ["HF_HOME"] = "/tmp/hf_cache"
+    _mark_dirty("global_memory_log")
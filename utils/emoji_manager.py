@@ -4,7 +4,6 @@ import os
 from typing import Dict, Any, List
 import aiohttp
 import asyncio
-import google.generativeai as genai
 
 # --- 常量 ---
 DATA_DIR = 'data'
@@ -12,6 +11,8 @@ EMOJIS_FILE = os.path.join(DATA_DIR, 'emojis.json')
 
 # --- 内部变量 ---
 _emojis_cache: Dict[str, Dict[str, Any]] = {}
+# 表情数据每次变化（加载、更新、写入描述）都会加一，供系统指令缓存判断是否需要重建
+_emojis_version = 0
 _send_dm_to_owner_func = None
 
 # --- 辅助函数 ---
@@ -27,7 +28,7 @@ def _ensure_data_dir():
 
 def load_emojis():
     """从 JSON 文件加载表情数据到缓存。"""
-    global _emojis_cache
+    global _emojis_cache, _emojis_version
     _ensure_data_dir()
     try:
         if os.path.exists(EMOJIS_FILE):
@@ -40,9 +41,12 @@ def load_emojis():
     except (json.JSONDecodeError, IOError) as e:
         print(f"错误：加载表情文件 {EMOJIS_FILE} 失败: {e}")
         _emojis_cache = {}
+    _emojis_version += 1
 
 def save_emojis():
-    """将缓存中的表情数据保存到 JSON 文件。"""
+    """将缓存中的表情数据保存到 JSON 文件。所有修改表情数据的地方最后都会调用这里。"""
+    global _emojis_version
+    _emojis_version += 1
     _ensure_data_dir()
     try:
         with open(EMOJIS_FILE, 'w', encoding='utf-8') as f:
@@ -89,6 +93,10 @@ async def update_all_emojis(bot):
         await _send_dm_to_owner_func(f"【系统通知】\n{update_message}")
 
 
+def get_version() -> int:
+    """表情数据的版本号，数据变化时递增。"""
+    return _emojis_version
+
 def get_all_emojis() -> Dict[str, Dict[str, Any]]:
     """获取所有表情的数据。"""
     return _emojis_cache
@@ -172,33 +180,12 @@ async def generate_descriptions_for_guild(guild_id: int, on_progress, on_complet
 
 
 async def _describe_image_with_gemini(image_bytes: bytes) -> str | None:
-    """使用Gemini Pro Vision模型描述图片内容。"""
+    """使用支持视觉的 Gemini 模型描述图片内容（后台优先级，聊天繁忙时让路）。"""
     from . import ai_utils # 局部导入，解决循环依赖
-    try:
-        # 复用 ai_utils 中的 key 管理和模型名称
-        api_key = ai_utils.GEMINI_API_KEYS[ai_utils.current_gemini_key_index]
-        genai.configure(api_key=api_key)
-        
-        model = genai.GenerativeModel(model_name='gemini-1.5-pro-latest') # 使用支持视觉的模型
-        
-        prompt = "你是一个表情符号分析专家。请用非常简洁的、不超过15个字的中文短语来描述这个表情图片。请聚焦于表情传达的核心情绪、动作或物品，例如：'开心地跳跃'、'尴尬地微笑'、'愤怒地挥拳'、'一个美味的汉堡'。你的描述将用于指导AI在对话中正确使用这个表情。请直接给出描述，不要说任何额外的话。"
-        
-        image_part = {"mime_type": "image/png", "data": image_bytes}
-        
-        response = await model.generate_content_async([prompt, image_part])
-        
-        # 轮换key
-        ai_utils.current_gemini_key_index = (ai_utils.current_gemini_key_index + 1) % len(ai_utils.GEMINI_API_KEYS)
-        
-        if response.candidates and response.text:
-            return response.text.strip()
+    prompt = "你是一个表情符号分析专家。请用非常简洁的、不超过15个字的中文短语来描述这个表情图片。请聚焦于表情传达的核心情绪、动作或物品，例如：'开心地跳跃'、'尴尬地微笑'、'愤怒地挥拳'、'一个美味的汉堡'。你的描述将用于指导AI在对话中正确使用这个表情。请直接给出描述，不要说任何额外的话。"
+    image_part = {"mime_type": "image/png", "data": image_bytes}
+    # 经过 ai_utils 的准入队列、熔断器、重试和 key 调度；失败由 generate_descriptions_for_guild 通过 on_error 汇报，不逐次私信主人
+    description = await ai_utils.call_vision([prompt, image_part], context_for_error_dm="表情识图", notify_owner=False)
+    if description == ai_utils.INTERNAL_AI_ERROR_SIGNAL:
         return None
-    except Exception as e:
-        print(f"Gemini Vision API 调用失败: {e}")
-        # 发生错误时也轮换key
-        ai_utils.current_gemini_key_index = (ai_utils.current_gemini_key_index + 1) % len(ai_utils.GEMINI_API_KEYS)
-        return None
-
-
-# --- 初始化 ---
-load_emojis()
\ No newline at end of file
+    return description
@@ -0,0 +1,287 @@
+# utils/fake_gemini.py
+"""
+离线的 Gemini 模拟后端（AI_PROVIDER=fake）：不联网、不消耗配额，用来测量重试、key 轮换、对冲和准入队列在各种故障下的表现。
+
+FakeGeminiPool 与 GeminiClientPool 的接口相同（model / embed_content / client / stats），模型对象模拟
+generate_content_async（包括 stream=True）的返回结构，ai_utils 的调用路径不需要任何改动。
+- 首个 token 的延迟按 FAKE_GEMINI_LATENCY 给出的分布抽样，之后按 FAKE_GEMINI_TOKENS_PER_SECOND 逐块生成，
+  输入部分按 FAKE_GEMINI_PREFILL_TOKENS_PER_SECOND 额外计时，延迟与 token 数成正比；
+- FAKE_GEMINI_ERROR_RATES 按比例注入 429（带"Please retry in Xs"提示）、500、503 和提示词被拦截；
+  FAKE_GEMINI_KEY_RPM 大于 0 时每个 key 超过每分钟请求数也会返回 429，用来观察 key 轮换；
+- 向量由文本的哈希决定，同一段文本总是得到同一个（归一化的）向量。
+"""
+import math
+import time
+import random
+import asyncio
+import hashlib
+from collections import deque
+
+from google.api_core import exceptions as api_exceptions
+
+from .context_assembler import estimate_text_tokens, IMAGE_TOKENS
+
+DEFAULT_LATENCY = "lognormal:0.8,0.5"
+DEFAULT_EMBEDDING_DIM = 768
+# 模拟回复的文字，按 estimate_text_tokens 的规则每 2 个字符约 1 个 token
+_FILLER = "米尔可认真想了想然后开心地回答你今天也要好好休息哦我们一起去看星星吧"
+# 系统指令要求短篇幅分段时，回复中插入的分段标签
+_SEGMENT_TAG = "<\\n>"
+
+
+def parse_latency(spec: str):
+    """
+    解析延迟分布，返回一个接受 random.Random 并返回秒数的函数：
+    fixed:秒 / uniform:最小,最大 / lognormal:中位数,sigma / exponential:均值
+    """
+    name, _, raw = spec.partition(":")
+    values = [float(value) for value in raw.split(",") if value.strip()]
+    name = name.strip().lower()
+    if name == "fixed" and len(values) == 1:
+        return lambda rng: values[0]
+    if name == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if name == "lognormal" and len(values) == 2:
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    if name == "exponential" and len(values) == 1:
+        return lambda rng: rng.expovariate(1 / values[0])
+    raise ValueError(f"无法解析的延迟分布: {spec!r}（可选 fixed:秒 / uniform:a,b / lognormal:中位数,sigma / exponential:均值）")
+
+
+def parse_error_rates(spec: str) -> dict:
+    """解析 "429:0.05,500:0.02,503:0.01,blocked:0.01" 形式的错误比例"""
+    rates = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, _, rate = item.partition(":")
+        name = name.strip().lower()
+        if name not in ("429", "500", "503", "blocked"):
+            raise ValueError(f"未知的模拟错误类型: {name!r}（可选 429 / 500 / 503 / blocked）")
+        rates[name] = float(rate)
+    if sum(rates.values()) > 1:
+        raise ValueError(f"模拟错误比例之和超过 1: {spec!r}")
+    return rates
+
+
+def fake_embedding(text: str, dim: int = DEFAULT_EMBEDDING_DIM) -> list:
+    """由文本哈希决定的归一化向量"""
+    rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    vector = [rng.gauss(0.0, 1.0) for _ in range(dim)]
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+def _prompt_tokens(system_instruction, contents) -> int:
+    tokens = estimate_text_tokens(system_instruction or "")
+    if isinstance(contents, (str, dict)):
+        contents = [contents]
+    for item in contents or ():
+        parts = item.get("parts", [item]) if isinstance(item, dict) and "role" in item else [item]
+        for part in parts:
+            # 图片等非文本内容按固定值计
+            tokens += estimate_text_tokens(part) if isinstance(part, str) else IMAGE_TOKENS
+    return tokens
+
+
+# --- 模拟的响应结构（只包含 ai_utils 用到的字段） ---
+
+class _Named:
+    def __init__(self, name):
+        self.name = name
+
+
+class _Part:
+    def __init__(self, text):
+        self.text = text
+
+
+class _Content:
+    def __init__(self, text):
+        self.parts = [_Part(text)] if text else []
+
+
+class _Candidate:
+    def __init__(self, text, finish_reason="STOP"):
+        self.content = _Content(text)
+        self.finish_reason = _Named(finish_reason)
+
+
+class _PromptFeedback:
+    def __init__(self, block_reason):
+        self.block_reason = _Named(block_reason)
+
+
+class _Usage:
+    def __init__(self, prompt_tokens, output_tokens):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.total_token_count = prompt_tokens + output_tokens
+
+
+class FakeResponse:
+    def __init__(self, text="", finish_reason="STOP", block_reason=None, usage=None):
+        self.candidates = [] if block_reason else [_Candidate(text, finish_reason)]
+        self.prompt_feedback = _PromptFeedback(block_reason) if block_reason else None
+        self.usage_metadata = usage
+
+    @property
+    def text(self):
+        if not self.candidates or not self.candidates[0].content.parts:
+            raise ValueError("响应中不含文本。")
+        return self.candidates[0].content.parts[0].text
+
+
+class FakeStreamResponse:
+    """stream=True 时返回的响应：异步迭代得到各个文本块，迭代结束后 usage_metadata 才可用"""
+
+    def __init__(self, first_chunk, chunks):
+        self._first_chunk = first_chunk
+        self._chunks = chunks
+        self.usage_metadata = None
+
+    async def __aiter__(self):
+        last = self._first_chunk
+        yield last
+        async for last in self._chunks:
+            yield last
+        self.usage_metadata = last.usage_metadata
+
+
+async def _no_chunks():
+    return
+    yield
+
+
+class FakeModel:
+    def __init__(self, pool, api_key: str, model_name: str, system_instruction: str = None):
+        self.pool = pool
+        self.api_key = api_key
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+
+    def _reply_text(self, rng, max_tokens) -> str:
+        tokens = max(1, round(rng.uniform(0.5, 1.5) * self.pool.reply_tokens))
+        if max_tokens:
+            tokens = min(tokens, max_tokens)
+        start = rng.randrange(len(_FILLER))
+        text = "".join(_FILLER[(start + i) % len(_FILLER)] for i in range(tokens * 2))
+        if self.system_instruction and _SEGMENT_TAG in self.system_instruction:
+            # 短篇幅模式：大约每 20 个字分一段
+            text = _SEGMENT_TAG.join(text[i:i + 20] for i in range(0, len(text), 20))
+        return text
+
+    async def generate_content_async(self, contents=None, generation_config=None, stream=False, **kwargs):
+        pool = self.pool
+        rng = pool.rng
+        prompt_tokens = _prompt_tokens(self.system_instruction, contents)
+        first_token = pool.latency(rng) + prompt_tokens / pool.prefill_tokens_per_second
+        outcome = pool.draw_outcome(self.api_key)
+        pool.calls += 1
+        await asyncio.sleep(first_token)
+        if outcome == "blocked":
+            blocked = FakeResponse(block_reason="SAFETY", usage=_Usage(prompt_tokens, 0))
+            return FakeStreamResponse(blocked, _no_chunks()) if stream else blocked
+        if outcome is not None:
+            raise pool.make_error(outcome)
+
+        text = self._reply_text(rng, getattr(generation_config, "max_output_tokens", None))
+        output_tokens = estimate_text_tokens(text)
+        if not stream:
+            await asyncio.sleep(output_tokens / pool.tokens_per_second)
+            pool.output_tokens += output_tokens
+            return FakeResponse(text, usage=_Usage(prompt_tokens, output_tokens))
+
+        # 流式：首块在首个 token 延迟后返回，之后按生成速度每块 stream_chunk_chars 个字符
+        size = pool.stream_chunk_chars
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        pool.output_tokens += output_tokens
+
+        async def rest():
+            for index, piece in enumerate(pieces[1:], start=1):
+                await asyncio.sleep(estimate_text_tokens(piece) / pool.tokens_per_second)
+                last = index == len(pieces) - 1
+                yield FakeResponse(piece, usage=_Usage(prompt_tokens, output_tokens) if last else None)
+
+        first = FakeResponse(pieces[0], usage=_Usage(prompt_tokens, output_tokens) if len(pieces) == 1 else None)
+        return FakeStreamResponse(first, rest())
+
+
+class FakeGeminiPool:
+    def __init__(self, latency: str = DEFAULT_LATENCY, tokens_per_second: float = 60.0, prefill_tokens_per_second: float = 20000.0,
+                 reply_tokens: int = 60, error_rates: str = "", key_rpm: float = 0, retry_after: float = 5.0,
+                 embedding_dim: int = DEFAULT_EMBEDDING_DIM, stream_chunk_chars: int = 16, seed=None):
+        self.latency = parse_latency(latency)
+        self.latency_spec = latency
+        self.tokens_per_second = tokens_per_second
+        self.prefill_tokens_per_second = prefill_tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.error_rates = parse_error_rates(error_rates)
+        self.key_rpm = key_rpm
+        self.retry_after = retry_after
+        self.embedding_dim = embedding_dim
+        self.stream_chunk_chars = max(1, stream_chunk_chars)
+        self.rng = random.Random(seed)
+        # 每个 key 最近一分钟内的请求时间，用于模拟 RPM 限流
+        self._key_calls = {}
+        self.calls = 0
+        self.embed_calls = 0
+        self.output_tokens = 0
+        self.injected = {"429": 0, "500": 0, "503": 0, "blocked": 0, "quota": 0}
+
+    def draw_outcome(self, api_key: str):
+        """决定这次请求的结果：None 表示成功，否则为错误类型"""
+        if self.key_rpm > 0:
+            now = time.monotonic()
+            calls = self._key_calls.setdefault(api_key, deque())
+            while calls and now - calls[0] >= 60:
+                calls.popleft()
+            if len(calls) >= self.key_rpm:
+                self.injected["quota"] += 1
+                return "quota"
+            calls.append(now)
+        roll = self.rng.random()
+        for name, rate in self.error_rates.items():
+            if roll < rate:
+                self.injected[name] += 1
+                return name
+            roll -= rate
+        return None
+
+    def make_error(self, outcome: str) -> Exception:
+        if outcome in ("429", "quota"):
+            return api_exceptions.ResourceExhausted(f"429 Resource has been exhausted (e.g. check quota). Please retry in {self.retry_after:g}s.")
+        if outcome == "503":
+            return api_exceptions.ServiceUnavailable("503 The model is overloaded. Please try again later.")
+        return api_exceptions.InternalServerError("500 An internal error has occurred.")
+
+    def client(self, api_key: str):
+        return self
+
+    def model(self, api_key: str, model_name: str, system_instruction: str = None, safety_settings=None) -> FakeModel:
+        return FakeModel(self, api_key, model_name, system_instruction)
+
+    async def embed_content(self, api_key: str, model: str = None, content=None, task_type: str = None, **kwargs):
+        """模拟 genai.embed_content_async：content 为列表时返回向量列表"""
+        texts = content if isinstance(content, list) else [content]
+        self.embed_calls += 1
+        outcome = self.draw_outcome(api_key)
+        await asyncio.sleep(self.latency(self.rng) / 4 + sum(estimate_text_tokens(text) for text in texts) / self.prefill_tokens_per_second)
+        if outcome not in (None, "blocked"):
+            raise self.make_error(outcome)
+        vectors = [fake_embedding(text, self.embedding_dim) for text in texts]
+        return {"embedding": vectors if isinstance(content, list) else vectors[0]}
+
+    def stats(self) -> dict:
+        return {
+            "provider": "fake",
+            "latency": self.latency_spec,
+            "calls": self.calls,
+            "embed_calls": self.embed_calls,
+            "output_tokens": self.output_tokens,
+            "injected": dict(self.injected),
+        }
+
+
+def fake_keys(count: int) -> list:
+    return [f"fake-key-{index + 1}" for index in range(max(1, count))]
@@ -0,0 +1,64 @@
+# utils/gemini_pool.py
+"""
+按 API key 划分的 Gemini 客户端池。
+
+genai.configure() 修改的是进程级的全局配置，多个协程同时用不同的 key 调用时会互相覆盖。
+这里为每个 key 创建一个独立的异步客户端（只创建一次，连接随之复用），每次请求构造的模型对象直接绑定
+对应 key 的客户端，不再依赖全局配置。
+
+模型对象本身不缓存：系统指令包含人设、检索到的记忆和对话总结，几乎每次调用都不同，按指令缓存命中率接近零；
+GenerativeModel 的构造只是保存参数，开销可以忽略，真正昂贵的是客户端和连接。
+
+GenerativeModel 没有公开的传入客户端的参数，绑定客户端依赖它的内部属性 _async_client
+（google-generativeai 0.8.x，requirements.txt 中固定了版本范围）。升级后属性不存在时 bind_client() 直接报错，
+而不是悄悄退回到全局配置、让所有 key 共用同一个客户端。
+"""
+import google.generativeai as genai
+from google.ai import generativelanguage as glm
+
+
+def bind_client(model: genai.GenerativeModel, client: glm.GenerativeServiceAsyncClient) -> genai.GenerativeModel:
+    """让模型使用指定的异步客户端；google-generativeai 的内部结构变化时抛出 RuntimeError"""
+    if "_async_client" not in vars(model):
+        raise RuntimeError(
+            f"google-generativeai {getattr(genai, '__version__', '?')} 的 GenerativeModel 没有 _async_client 属性，"
+            "无法为每个 key 绑定独立的客户端。请安装 requirements.txt 中固定的版本（0.8.x）。"
+        )
+    model._async_client = client
+    return model
+
+
+class GeminiClientPool:
+    def __init__(self):
+        self._clients = {}
+        self.models_built = 0
+        # 启动时就确认能绑定客户端，版本不兼容时在这里失败，而不是等到第一次 AI 调用
+        bind_client(genai.GenerativeModel(model_name="models/gemini-pro"), None)
+
+    def client(self, api_key: str) -> glm.GenerativeServiceAsyncClient:
+        """返回绑定该 key 的异步客户端（需要在事件循环中调用）"""
+        client = self._clients.get(api_key)
+        if client is None:
+            client = glm.GenerativeServiceAsyncClient(client_options={"api_key": api_key})
+            self._clients[api_key] = client
+        return client
+
+    def model(self, api_key: str, model_name: str, system_instruction: str = None, safety_settings=None) -> genai.GenerativeModel:
+        """构造一个使用该 key 专属客户端的模型对象"""
+        self.models_built += 1
+        model = genai.GenerativeModel(
+            model_name=model_name,
+            safety_settings=safety_settings,
+            system_instruction=system_instruction,
+        )
+        return bind_client(model, self.client(api_key))
+
+    async def embed_content(self, api_key: str, **kwargs):
+        """genai.embed_content_async，使用该 key 专属的客户端"""
+        return await genai.embed_content_async(client=self.client(api_key), **kwargs)
+
+    def stats(self) -> dict:
+        return {
+            "clients": len(self._clients),
+            "models_built": self.models_built,
+        }
@@ -0,0 +1,133 @@
+# utils/hedging.py
+"""
+对冲请求：第一次尝试超过最近延迟的某个分位数（例如 p90）仍未返回时，换一个 key 再发一份相同的请求，
+先成功的结果胜出，另一份被取消。长尾延迟因此被截断在分位数附近，代价是少量额外的请求。
+
+- LatencyTracker 记录最近成功请求的延迟，计算分位数；样本不足时不对冲；
+- HedgePolicy 限制最近一段时间内被对冲的调用所占的比例，避免在整体变慢时把配额翻倍消耗掉；
+- run_hedged() 负责启动、等待和取消；结果需要清理（例如流式请求的首个文本块）时由 discard 回调处理落选的结果。
+"""
+import asyncio
+from collections import deque
+
+DEFAULT_WINDOW = 200
+
+
+class LatencyTracker:
+    def __init__(self, window: int = DEFAULT_WINDOW):
+        self._samples = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, fraction: float):
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class HedgePolicy:
+    def __init__(self, percentile: float = 0.9, max_ratio: float = 0.1, min_samples: int = 20, window: int = DEFAULT_WINDOW):
+        self.percentile = percentile
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self.latency = LatencyTracker(window)
+        # 最近结束的调用是否被对冲（调用结束时登记，并发调用之间不会互相覆盖）
+        self._recent = deque(maxlen=window)
+        # 已经发出对冲、还没有结束的调用数，同样计入对冲比例
+        self._hedging = 0
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+        self.capped = 0
+
+    def delay(self):
+        """第一次尝试等待多久后对冲；样本不足时返回 None（不对冲）"""
+        if len(self.latency) < self.min_samples:
+            return None
+        return self.latency.percentile(self.percentile)
+
+    def start_call(self):
+        self.calls += 1
+
+    def try_hedge(self) -> bool:
+        """当前调用想要对冲：对冲比例未超过上限时登记并返回 True，之后必须以 finish_call(True) 结束"""
+        if self._recent and sum(self._recent) + self._hedging >= self.max_ratio * len(self._recent):
+            self.capped += 1
+            return False
+        self.hedged += 1
+        self._hedging += 1
+        return True
+
+    def finish_call(self, hedged: bool):
+        """调用结束（成功、失败或被取消）时登记它是否被对冲过"""
+        if hedged:
+            self._hedging -= 1
+        self._recent.append(hedged)
+
+    def stats(self) -> dict:
+        delay = self.delay()
+        return {
+            "calls": self.calls,
+            "hedged": self.hedged,
+            "hedge_rate": round(self.hedged / self.calls, 3) if self.calls else 0.0,
+            "hedge_wins": self.hedge_wins,
+            "primary_wins": self.primary_wins,
+            "capped": self.capped,
+            "delay_ms": round(delay * 1000) if delay is not None else None,
+        }
+
+
+def _drop(task, discard):
+    """放弃一次尝试：还在进行的取消掉，已经成功但没有被采用的结果交给 discard 清理"""
+    if not task.done():
+        task.cancel()
+    elif discard is not None and not task.cancelled() and task.exception() is None:
+        discard(task.result())
+
+
+async def run_hedged(policy: HedgePolicy, start_attempt, discard=None):
+    """
+    start_attempt() 返回一次尝试的协程。第一次尝试在 policy.delay() 内没有完成时再启动一次，
+    返回先成功的结果；两次都失败时抛出第一次尝试的异常。
+    另一份已经成功但没有被采用的结果会交给 discard(result)（例如释放它占用的 key）。
+    """
+    policy.start_call()
+    hedged = False
+    primary = asyncio.ensure_future(start_attempt())
+    pending = {primary}
+    try:
+        delay = policy.delay()
+        if delay is not None:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+        if delay is None or done or not policy.try_hedge():
+            result = await primary
+            pending = set()
+            return result
+        hedged = True
+        hedge = asyncio.ensure_future(start_attempt())
+        pending = {primary, hedge}
+        errors = {}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((task for task in done if task.exception() is None), None)
+            if winner is not None:
+                if winner is hedge:
+                    policy.hedge_wins += 1
+                else:
+                    policy.primary_wins += 1
+                # 两份同时成功时，没有被采用的一份和 pending 一样需要清理
+                pending |= done - {winner}
+                return winner.result()
+            for task in done:
+                errors[task] = task.exception()
+        raise errors.get(primary) or errors[hedge]
+    finally:
+        for task in pending:
+            _drop(task, discard)
+        policy.finish_call(hedged)
@@ -0,0 +1,123 @@
+# utils/incremental_serializer.py
+"""
+分区 / 分片文件的增量编码器：缓存每个文件上一次编码好的字节，保存时只编码被修改过的条目。
+
+- 非字典分区（列表、字符串等）整体缓存，被修改后整体重新编码；
+- 字典分区和会话分片缓存一个完整的基础快照，之后被修改的 key 各自编码为一个 JSON 片段并缓存，
+  保存时用 snapshot_format.splice() 把原样复用的基础快照和由片段拼成的增量快照拼接在一起，
+  编码和压缩的开销只与修改量有关，而不是与数据总量有关；
+- 增量部分超过基础快照一定比例时重新完整编码一次（合并），文件大小和解码开销因此保持有界。
+
+调用方负责在修改数据时调用 invalidate()，data_manager 在标记脏分区时完成这一步。
+"""
+from . import snapshot_format
+
+# 增量快照超过基础快照这个比例时重新完整编码
+DEFAULT_COMPACT_RATIO = 0.25
+
+
+class _FileState:
+    __slots__ = ("base", "keyed", "int_keys", "keys", "pending", "fragments", "deleted", "output")
+
+    def __init__(self, base: bytes, keyed: bool, int_keys: bool, keys):
+        self.base = base
+        self.keyed = keyed
+        self.int_keys = int_keys
+        # 当前输出中包含的 key；用来发现没有经过 invalidate() 的增删
+        self.keys = keys
+        # 自上次编码以来被修改、尚未重新编码的 key
+        self.pending = set()
+        # 自基础快照以来被修改过的 key 的 [key, value] 片段
+        self.fragments = {}
+        self.deleted = set()
+        self.output = base
+
+
+class IncrementalSerializer:
+    def __init__(self, compact_ratio: float = DEFAULT_COMPACT_RATIO):
+        self.compact_ratio = compact_ratio
+        self._files = {}
+        self.full_encodes = 0
+        self.delta_encodes = 0
+        self.reused = 0
+        self.fragments_encoded = 0
+
+    def reset(self):
+        """丢弃全部缓存（数据被整体替换后调用）"""
+        self._files.clear()
+
+    def invalidate(self, file_id, key=None):
+        """file_id 中的 key 被修改；key 为 None 表示整个文件都需要重新编码"""
+        state = self._files.get(file_id)
+        if state is None:
+            return
+        if key is None or not state.keyed:
+            del self._files[file_id]
+            return
+        state.pending.add(key)
+        state.output = None
+
+    def encode(self, file_id, value, int_keys: bool = False) -> bytes:
+        """编码一个完整的分区值"""
+        state = self._files.get(file_id)
+        if state is not None and state.keyed and isinstance(value, dict):
+            output = self._encode_changes(state, value.__contains__, value.__getitem__)
+            # key 数量对不上说明有没经过 invalidate() 的增删，缓存不可信
+            if output is not None and len(state.keys) == len(value):
+                return output
+        elif state is not None and state.output is not None:
+            self.reused += 1
+            return state.output
+        return self.encode_full(file_id, value, int_keys)
+
+    def encode_changes(self, file_id, contains, lookup):
+        """
+        只根据被修改过的 key 更新文件（用于会话分片：分片本身不是一个现成的字典）。
+        contains(key) / lookup(key) 从完整数据中查询条目；没有缓存或需要合并时返回 None，
+        由调用方收集完整内容后调用 encode_full()。
+        """
+        state = self._files.get(file_id)
+        if state is None or not state.keyed:
+            return None
+        return self._encode_changes(state, contains, lookup)
+
+    def encode_full(self, file_id, value, int_keys: bool = False) -> bytes:
+        base = snapshot_format.encode(value, int_keys=int_keys)
+        keyed = isinstance(value, dict)
+        self._files[file_id] = _FileState(base, keyed, int_keys, set(value) if keyed else None)
+        self.full_encodes += 1
+        return base
+
+    def _encode_changes(self, state: _FileState, contains, lookup):
+        if state.output is not None:
+            self.reused += 1
+            return state.output
+        for key in state.pending:
+            if contains(key):
+                state.fragments[key] = snapshot_format.dumps([key, lookup(key)])
+                state.deleted.discard(key)
+                state.keys.add(key)
+                self.fragments_encoded += 1
+            else:
+                state.fragments.pop(key, None)
+                state.deleted.add(key)
+                state.keys.discard(key)
+        state.pending.clear()
+        if not state.fragments and not state.deleted:
+            state.output = state.base
+            return state.output
+        delta = snapshot_format.wrap_payload(snapshot_format.encode_delta_payload(state.fragments.values(), state.deleted))
+        if len(delta) > len(state.base) * self.compact_ratio:
+            return None
+        state.output = snapshot_format.splice(state.base, delta)
+        self.delta_encodes += 1
+        return state.output
+
+    def stats(self) -> dict:
+        return {
+            "files": len(self._files),
+            "full_encodes": self.full_encodes,
+            "delta_encodes": self.delta_encodes,
+            "reused": self.reused,
+            "fragments_encoded": self.fragments_encoded,
+        }
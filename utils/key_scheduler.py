@@ -0,0 +1,259 @@
+# utils/key_scheduler.py
+"""
+Gemini API key 调度器：取代简单的轮询，让每个请求都落在当前最健康、仍有额度的 key 上。
+
+- 每个 key 各有一个 RPM（每分钟请求数）和 TPM（每分钟 token 数）令牌桶，按时间连续回填；
+- 返回 429（ResourceExhausted）的 key 进入冷却期，连续限流时冷却时间翻倍，服务端给出的
+  重试时间优先；冷却期内不会被选中；
+- 记录最近若干次请求的延迟与成败，选择 key 时优先连续失败少、错误率低、并发少、延迟低的 key；
+- 可以为每个 key 配一个熔断器（circuit_breaker），熔断中的 key 不会被选中，冷却结束后只放行少量探测请求；
+- 所有 key 都没有额度时，调用方按先来后到排队等待最早恢复的 key，超过最长等待时间才放弃，
+  而不是立刻把重试次数耗在注定失败的请求上。
+"""
+import time
+import asyncio
+from collections import deque
+
+# 滚动统计保留的最近请求数
+STATS_WINDOW = 50
+MAX_COOLDOWN_SECONDS = 600
+
+
+class TokenBucket:
+    """容量为每分钟额度、按秒连续回填的令牌桶；额度为 0 表示不限制"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.capacity <= 0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """还需要等待多少秒才能取出 amount 个令牌（超过容量的请求只要求桶是满的）"""
+        if self.unlimited:
+            return 0.0
+        self._refill(now)
+        needed = min(amount, self.capacity) - self.tokens
+        return max(0.0, needed / self.rate)
+
+    def take(self, amount: float, now: float):
+        """取出令牌，允许透支（实际用量可能超过预估）"""
+        if not self.unlimited:
+            self._refill(now)
+            self.tokens -= amount
+
+    def drain(self, now: float):
+        if not self.unlimited:
+            self._refill(now)
+            self.tokens = min(self.tokens, 0.0)
+
+
+class _KeyState:
+    def __init__(self, index: int, key: str, rpm: float, tpm: float, breaker=None):
+        self.index = index
+        self.key = key
+        self.breaker = breaker
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.cooldown_until = 0.0
+        self.rate_limit_streak = 0
+        self.consecutive_errors = 0
+        self.in_flight = 0
+        self.total_requests = 0
+        self.total_errors = 0
+        self.total_rate_limited = 0
+        # 最近的请求：(延迟秒数, 是否成功)
+        self.recent = deque(maxlen=STATS_WINDOW)
+
+    @property
+    def label(self) -> str:
+        return f"#{self.index + 1} (…{self.key[-4:]})"
+
+    def error_rate(self) -> float:
+        if not self.recent:
+            return 0.0
+        return sum(1 for _, ok in self.recent if not ok) / len(self.recent)
+
+    def avg_latency(self) -> float:
+        latencies = [latency for latency, ok in self.recent if ok]
+        return sum(latencies) / len(latencies) if latencies else 0.0
+
+    def wait_time(self, estimated_tokens: float, now: float) -> float:
+        return max(
+            self.cooldown_until - now,
+            self.requests.wait_time(1, now),
+            self.tokens.wait_time(estimated_tokens, now),
+            self.breaker.retry_in() if self.breaker else 0.0,
+        )
+
+    def health(self):
+        """越小越健康"""
+        return (self.consecutive_errors, round(self.error_rate(), 1), self.in_flight, self.avg_latency())
+
+
+class KeyLease:
+    """一次请求占用的 key；请求结束后必须调用 succeeded() 或 failed() 之一"""
+
+    def __init__(self, scheduler, state: _KeyState, estimated_tokens: float):
+        self._scheduler = scheduler
+        self._state = state
+        self._estimated_tokens = estimated_tokens
+        self._started = time.monotonic()
+        self._done = False
+        self.key = state.key
+        self.label = state.label
+
+    @property
+    def rate_limit_streak(self) -> int:
+        """该 key 目前连续被限流的次数"""
+        return self._state.rate_limit_streak
+
+    def succeeded(self, tokens_used: float = None):
+        if not self._done:
+            self._done = True
+            self._scheduler._finish(self, ok=True, tokens_used=tokens_used)
+
+    def failed(self, rate_limited: bool = False, retry_after: float = None, key_fault: bool = True):
+        """key_fault=False 表示失败与 key 本身无关（例如内容被拦截），不计入该 key 的健康度和熔断"""
+        if not self._done:
+            self._done = True
+            self._scheduler._finish(self, ok=False, rate_limited=rate_limited, retry_after=retry_after, key_fault=key_fault)
+
+
+class KeyScheduler:
+    def __init__(self, keys, rpm: float = 0, tpm: float = 0, cooldown_seconds: float = 60.0, max_wait_seconds: float = 30.0, breaker_factory=None):
+        """breaker_factory(label) 为每个 key 创建一个熔断器，为 None 时不熔断"""
+        self._states = []
+        for i, key in enumerate(keys):
+            state = _KeyState(i, key, rpm, tpm)
+            if breaker_factory is not None:
+                state.breaker = breaker_factory(state.label)
+            self._states.append(state)
+        self.cooldown_seconds = cooldown_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self._queue_lock = None
+        self.queued = 0
+        self.total_wait_seconds = 0.0
+        self.gave_up = 0
+
+    def __len__(self):
+        return len(self._states)
+
+    def _get_queue_lock(self):
+        # 锁需要在事件循环中创建；asyncio.Lock 按先来后到唤醒，等待中的请求因此按顺序拿到 key
+        if self._queue_lock is None:
+            self._queue_lock = asyncio.Lock()
+        return self._queue_lock
+
+    def _pick(self, estimated_tokens: float, exclude, now: float):
+        """返回 (可立即使用的最健康的 key 或 None, 最早可用还需等待的秒数)"""
+        candidates = [state for state in self._states if state.key not in exclude] or self._states
+        ready, soonest = [], None
+        for state in candidates:
+            wait = state.wait_time(estimated_tokens, now)
+            if wait <= 0:
+                ready.append(state)
+            elif soonest is None or wait < soonest:
+                soonest = wait
+        if ready:
+            return min(ready, key=_KeyState.health), 0.0
+        return None, soonest
+
+    async def acquire(self, estimated_tokens: float = 0, exclude=(), max_wait: float = None):
+        """
+        选出一个 key 并预扣额度。所有 key 都没有额度时排队等待；
+        等待超过 max_wait（默认 max_wait_seconds）时返回 None。exclude 中的 key 仅在还有其他 key 时被跳过。
+        """
+        if not self._states:
+            return None
+        max_wait = self.max_wait_seconds if max_wait is None else max_wait
+        started = time.monotonic()
+        state, wait = self._pick(estimated_tokens, exclude, started)
+        if state is None:
+            self.queued += 1
+            async with self._get_queue_lock():
+                while True:
+                    now = time.monotonic()
+                    state, wait = self._pick(estimated_tokens, exclude, now)
+                    if state is not None:
+                        break
+                    remaining = max_wait - (now - started)
+                    if remaining <= 0:
+                        self.gave_up += 1
+                        return None
+                    await asyncio.sleep(min(wait, remaining))
+            self.total_wait_seconds += time.monotonic() - started
+        now = time.monotonic()
+        if state.breaker is not None:
+            # 半开状态下占用一个探测名额（_pick 已确认有名额）
+            state.breaker.allow()
+        state.requests.take(1, now)
+        state.tokens.take(estimated_tokens, now)
+        state.in_flight += 1
+        state.total_requests += 1
+        return KeyLease(self, state, estimated_tokens)
+
+    def _finish(self, lease: KeyLease, ok: bool, tokens_used: float = None, rate_limited: bool = False, retry_after: float = None, key_fault: bool = True):
+        state = lease._state
+        now = time.monotonic()
+        state.in_flight -= 1
+        state.recent.append((now - lease._started, ok))
+        if tokens_used is not None:
+            # 用实际用量修正预扣的额度
+            state.tokens.take(tokens_used - lease._estimated_tokens, now)
+        if state.breaker is not None:
+            # 限流由冷却期处理，与 key 无关的失败也不影响熔断
+            if ok:
+                state.breaker.record_success()
+            elif rate_limited or not key_fault:
+                state.breaker.record_neutral()
+            else:
+                state.breaker.record_failure()
+        if ok:
+            state.consecutive_errors = 0
+            state.rate_limit_streak = 0
+            return
+        state.total_errors += 1
+        if key_fault:
+            state.consecutive_errors += 1
+        if rate_limited:
+            state.total_rate_limited += 1
+            state.rate_limit_streak += 1
+            cooldown = retry_after if retry_after else self.cooldown_seconds * (2 ** (state.rate_limit_streak - 1))
+            state.cooldown_until = max(state.cooldown_until, now + min(cooldown, MAX_COOLDOWN_SECONDS))
+            state.requests.drain(now)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        for state in self._states:
+            state.requests.wait_time(0, now)
+            state.tokens.wait_time(0, now)
+        return {
+            "queued": self.queued,
+            "gave_up": self.gave_up,
+            "avg_queue_wait_s": round(self.total_wait_seconds / self.queued, 2) if self.queued else 0.0,
+            "keys": [
+                {
+                    "label": state.label,
+                    "requests": state.total_requests,
+                    "errors": state.total_errors,
+                    "rate_limited": state.total_rate_limited,
+                    "in_flight": state.in_flight,
+                    "error_rate": round(state.error_rate(), 3),
+                    "avg_latency_ms": round(state.avg_latency() * 1000),
+                    "cooldown_s": round(max(0.0, state.cooldown_until - now), 1),
+                    "rpm_left": None if state.requests.unlimited else int(state.requests.tokens),
+                    "tpm_left": None if state.tokens.unlimited else int(state.tokens.tokens),
+                    "breaker": state.breaker.peek_state() if state.breaker else None,
+                }
+                for state in self._states
+            ],
+        }
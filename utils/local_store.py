@@ -0,0 +1,153 @@
+# utils/local_store.py
+"""
+本地持久化：预写日志（journal）+ 快照文件。
+
+每次修改都会以一行 JSON 追加到本地日志段中，fsync 按时间窗口批量执行，
+因此追加本身只需要微秒级的开销。日志会被定期折叠进快照（与云端相同的分区文件布局），
+启动时先读取快照，再按顺序重放尚未折叠的日志段。
+"""
+import os
+import json
+import asyncio
+
+SEGMENT_PREFIX = "journal."
+SEGMENT_SUFFIX = ".log"
+
+
+def write_files_atomic(root: str, files: dict):
+    """
+    把 {相对路径: bytes} 写入 root 目录。每个文件先写临时文件再 rename，保证不会出现半个文件。
+    文件按字典顺序依次写入，调用方应把 manifest 放在最后。
+    """
+    for rel_path, content in files.items():
+        path = os.path.join(root, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+
+def read_file(root: str, rel_path: str):
+    """读取快照中的文件，不存在时返回 None"""
+    path = os.path.join(root, rel_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class Journal:
+    """
+    按段轮转的追加日志。
+
+    - append() 只写入操作系统缓冲区，随后在 fsync_interval 秒内由后台线程统一 fsync；
+    - rotate() 开启新的日志段并返回其序号，之前的段可在快照落盘后通过 drop_segments_before() 删除；
+    - 启动后第一次写入总是开启新段，避免接在上次崩溃时可能被截断的行后面。
+    """
+
+    def __init__(self, directory: str, fsync_interval: float = 0.2):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+        existing = self.segments()
+        self.seq = (existing[-1][0] + 1) if existing else 1
+        self._file = None
+        self._sync_handle = None
+
+    def _segment_path(self, seq: int):
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{seq:08d}{SEGMENT_SUFFIX}")
+
+    def segments(self):
+        """返回按序号排序的 [(seq, path), ...]"""
+        result = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                try:
+                    seq = int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+                except ValueError:
+                    continue
+                result.append((seq, os.path.join(self.directory, name)))
+        return sorted(result)
+
+    def has_segments(self):
+        return bool(self.segments())
+
+    def append(self, record: dict):
+        if self._file is None:
+            self._file = open(self._segment_path(self.seq), 'a', encoding='utf-8')
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n")
+        self._file.flush()
+        self._schedule_sync()
+
+    def _schedule_sync(self):
+        if self._sync_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 没有事件循环时直接同步落盘
+            self.sync()
+            return
+        self._sync_handle = loop.call_later(self.fsync_interval, self._sync_in_background, loop)
+
+    def _sync_in_background(self, loop):
+        self._sync_handle = None
+        if self._file is None:
+            return
+        # dup 一个文件描述符交给线程池，即使期间发生 rotate/close 也不会 fsync 到错误的文件
+        fd = os.dup(self._file.fileno())
+        loop.run_in_executor(None, self._fsync_and_close, fd)
+
+    @staticmethod
+    def _fsync_and_close(fd: int):
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def sync(self):
+        """立即把当前日志段刷到磁盘"""
+        if self._sync_handle is not None:
+            self._sync_handle.cancel()
+            self._sync_handle = None
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def rotate(self) -> int:
+        """关闭当前段并切换到新段，返回新段的序号。新序号之前的段都可以被快照折叠。"""
+        self.close()
+        self.seq += 1
+        return self.seq
+
+    def drop_segments_before(self, seq: int):
+        for segment_seq, path in self.segments():
+            if segment_seq < seq:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    print(f"无法删除已折叠的日志段 {path}: {e}")
+
+    def replay(self, start_seq: int = 0):
+        """按顺序产出 start_seq 及之后各段中的记录，跳过崩溃时写了一半的行"""
+        for segment_seq, path in self.segments():
+            if segment_seq < start_seq:
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        print(f"  ⚠️ 日志段 {os.path.basename(path)} 中存在损坏的记录，已跳过。")
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
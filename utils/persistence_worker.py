@@ -0,0 +1,122 @@
+# utils/persistence_worker.py
+"""
+持久化后台工作线程：所有与 Hugging Face Hub 之间的阻塞式网络请求都交给一个单线程执行器完成，
+事件循环只负责等待返回的 future，因此上传期间 Discord 网关的心跳和消息处理不会被卡住。
+
+- submit() 返回 asyncio.Future，排队中的任务数量有上限，满了之后 submit() 会等待空位（背压）；
+- 单线程保证对 Hub 的提交严格按提交顺序执行，不会互相打架；
+- 失败的任务按指数退避（带随机抖动）自动重试，可以通过 should_retry 排除不值得重试的错误；
+- stats() 返回每类任务的耗时与成败统计，供 /状态 等指令展示。
+"""
+import time
+import random
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class _TaskStats:
+    __slots__ = ("count", "succeeded", "failed", "retries", "total_seconds", "last_seconds", "max_seconds", "total_wait_seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.retries = 0
+        self.total_seconds = 0.0
+        self.last_seconds = 0.0
+        self.max_seconds = 0.0
+        self.total_wait_seconds = 0.0
+
+    def as_dict(self):
+        attempts = self.succeeded + self.failed + self.retries
+        return {
+            "count": self.count,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "retries": self.retries,
+            "last_ms": round(self.last_seconds * 1000, 1),
+            "avg_ms": round(self.total_seconds / attempts * 1000, 1) if attempts else 0.0,
+            "max_ms": round(self.max_seconds * 1000, 1),
+            "avg_wait_ms": round(self.total_wait_seconds / self.count * 1000, 1) if self.count else 0.0,
+        }
+
+
+class PersistenceWorker:
+    def __init__(self, max_pending: int = 8, max_attempts: int = 4, base_delay: float = 2.0, max_delay: float = 60.0, name: str = "hub-io"):
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self._slots = None
+        self._pending = 0
+        self._stats = {}
+
+    def _get_slots(self):
+        # 信号量需要在事件循环中创建
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        return self._slots
+
+    async def submit(self, label: str, func, *args, should_retry=None) -> asyncio.Future:
+        """
+        把阻塞函数 func(*args) 放入队列，返回一个 future。
+        队列已满时会等待空位；label 用于区分统计信息（例如 "commit"、"download"）。
+        """
+        slots = self._get_slots()
+        enqueued_at = time.perf_counter()
+        await slots.acquire()
+        self._pending += 1
+        stats = self._stats.setdefault(label, _TaskStats())
+        stats.count += 1
+        stats.total_wait_seconds += time.perf_counter() - enqueued_at
+        return asyncio.ensure_future(self._run(stats, func, args, should_retry))
+
+    async def run(self, label: str, func, *args, should_retry=None):
+        """submit() 并等待结果"""
+        return await (await self.submit(label, func, *args, should_retry=should_retry))
+
+    async def _run(self, stats: _TaskStats, func, args, should_retry):
+        loop = asyncio.get_running_loop()
+        try:
+            for attempt in range(1, self.max_attempts + 1):
+                started = time.perf_counter()
+                try:
+                    result = await loop.run_in_executor(self._executor, func, *args)
+                    self._record(stats, started)
+                    stats.succeeded += 1
+                    return result
+                except Exception as e:
+                    self._record(stats, started)
+                    if attempt >= self.max_attempts or (should_retry is not None and not should_retry(e)):
+                        stats.failed += 1
+                        raise
+                    stats.retries += 1
+                    delay = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+                    delay *= random.uniform(0.8, 1.2)
+                    print(f"⚠️ 后台持久化任务失败（第 {attempt}/{self.max_attempts} 次），{delay:.1f} 秒后重试: {e}")
+                    await asyncio.sleep(delay)
+        finally:
+            self._pending -= 1
+            self._slots.release()
+
+    @staticmethod
+    def _record(stats: _TaskStats, started: float):
+        elapsed = time.perf_counter() - started
+        stats.last_seconds = elapsed
+        stats.total_seconds += elapsed
+        stats.max_seconds = max(stats.max_seconds, elapsed)
+
+    def pending(self) -> int:
+        return self._pending
+
+    def stats(self) -> dict:
+        return {
+            "pending": self._pending,
+            "max_pending": self.max_pending,
+            "tasks": {label: s.as_dict() for label, s in self._stats.items()},
+        }
+
+    def shutdown(self):
+        """等待正在执行的任务完成后关闭线程"""
+        self._executor.shutdown(wait=True)
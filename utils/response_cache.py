@@ -0,0 +1,109 @@
+# utils/response_cache.py
+"""
+固定提示词 AI 调用的回复缓存（摸头、抱抱等每次发送相同内容的指令；健康检查不使用缓存）。
+
+- 缓存 key 是规范化后的消息列表、系统指令版本、温度和输出长度上限的哈希，配置或人格一变，旧的回复自然失效；
+- 每条回复有 TTL，总条目数超过上限时按 LRU 淘汰；
+- 温度较高的调用本来就希望每次回复不同，这类 key 保存一个小的变体池：池子没装满之前照常调用 AI 并把回复加入池中，
+  装满之后轮流返回池中的回复，不会每次都是同一句；
+- 只有显式传入 cache=True 的调用点才会使用缓存。
+"""
+import json
+import time
+import hashlib
+from collections import OrderedDict
+
+DEFAULT_TTL_SECONDS = 600
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_VARIANTS = 3
+# 温度不低于这个值时使用变体池
+DEFAULT_VARIANT_TEMPERATURE = 0.7
+
+
+def _normalize_content(content):
+    if isinstance(content, str):
+        return " ".join(content.split())
+    if isinstance(content, list):
+        return [_normalize_content(item) for item in content]
+    if isinstance(content, dict) and isinstance(content.get("data"), bytes):
+        # 图片等二进制内容只取摘要
+        return {"mime_type": content.get("mime_type"), "sha1": hashlib.sha1(content["data"]).hexdigest()}
+    return content
+
+
+def make_key(messages: list, instruction_version, temperature: float, max_tokens=None) -> str:
+    normalized = [[msg.get("role"), _normalize_content(msg.get("content"))] for msg in messages]
+    raw = json.dumps([normalized, repr(instruction_version), round(float(temperature), 3), max_tokens], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class _Entry:
+    __slots__ = ("variants", "capacity", "next_index")
+
+    def __init__(self, capacity: int):
+        # [(写入时间, 回复)]
+        self.variants = []
+        self.capacity = capacity
+        self.next_index = 0
+
+
+class ResponseCache:
+    def __init__(self, ttl_seconds: float = DEFAULT_TTL_SECONDS, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 max_variants: int = DEFAULT_MAX_VARIANTS, variant_temperature: float = DEFAULT_VARIANT_TEMPERATURE):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_variants = max(1, max_variants)
+        self.variant_temperature = variant_temperature
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _capacity(self, temperature: float) -> int:
+        return self.max_variants if temperature >= self.variant_temperature else 1
+
+    def get(self, key: str, ttl_seconds: float = None):
+        """返回缓存的回复；没有缓存、已过期或变体池还没装满时返回 None（调用方随后应调用 put）"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+            now = time.monotonic()
+            alive = [variant for variant in entry.variants if now - variant[0] < ttl]
+            self.expirations += len(entry.variants) - len(alive)
+            entry.variants = alive
+            if len(alive) >= entry.capacity:
+                self._entries.move_to_end(key)
+                reply = alive[entry.next_index % len(alive)][1]
+                entry.next_index += 1
+                self.hits += 1
+                return reply
+        self.misses += 1
+        return None
+
+    def put(self, key: str, temperature: float, reply: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _Entry(self._capacity(temperature))
+        self._entries.move_to_end(key)
+        entry.variants.append((time.monotonic(), reply))
+        del entry.variants[:-entry.capacity]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "variants": sum(len(entry.variants) for entry in self._entries.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,97 @@
+# utils/retry_policy.py
+"""
+按错误类型决定 AI 调用失败后怎么重试，取代对所有异常一律随机等待 1.5~3 秒再重试的做法。
+
+- FAIL_FAST：重试也不会成功的错误（内容被拦截、回复为空、请求本身不合法），立即放弃；
+- ROTATE：与某个 key 或某次连接有关的错误（网络、服务端 5xx、key 无效），不等待，立即换一个 key 重试；
+- THROTTLED：被限流（429），按指数退避加随机抖动让该 key 冷却，服务端给出了重试时间时以服务端为准；
+  其他 key 有额度时下一次尝试会立即换过去，否则由 key 调度器排队等待最早恢复的 key。
+每次调用还有一个总的截止时间，到期后不再发起新的尝试。
+"""
+import re
+import time
+import random
+
+import google.generativeai as genai
+from google.api_core import exceptions as api_exceptions
+
+FAIL_FAST = "fail_fast"
+ROTATE = "rotate"
+THROTTLED = "throttled"
+KIND_LABELS = {FAIL_FAST: "不可重试", ROTATE: "换 key 重试", THROTTLED: "限流退避"}
+
+_NON_RETRIABLE = (
+    ValueError,
+    genai.types.BlockedPromptException,
+    genai.types.StopCandidateException,
+    api_exceptions.InvalidArgument,
+    api_exceptions.FailedPrecondition,
+    api_exceptions.NotFound,
+)
+_THROTTLED = (api_exceptions.ResourceExhausted, api_exceptions.TooManyRequests)
+# 服务端在错误信息中给出的重试时间，例如 "Please retry in 17.5s" 或 "retry_delay { seconds: 17 }"
+_RETRY_HINT_PATTERNS = (
+    re.compile(r"retry in ([\d.]+)\s*s", re.IGNORECASE),
+    re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)"),
+    re.compile(r"retryDelay['\"]?\s*[:=]\s*['\"]?([\d.]+)s"),
+)
+
+
+def retry_after_hint(error):
+    """从异常中取出服务端建议的重试等待秒数，没有时返回 None"""
+    for detail in getattr(error, "details", None) or ():
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None:
+            seconds = getattr(delay, "seconds", 0) + getattr(delay, "nanos", 0) / 1e9
+            if seconds > 0:
+                return seconds
+    message = str(error)
+    for pattern in _RETRY_HINT_PATTERNS:
+        match = pattern.search(message)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts: int = 5, deadline_seconds: float = 45.0, backoff_base: float = 2.0, backoff_max: float = 60.0):
+        self.max_attempts = max(1, max_attempts)
+        self.deadline_seconds = deadline_seconds
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.counts = dict.fromkeys(KIND_LABELS, 0)
+        self.deadline_exceeded = 0
+        self.server_hints = 0
+
+    def classify(self, error) -> str:
+        if isinstance(error, _THROTTLED):
+            kind = THROTTLED
+        elif isinstance(error, _NON_RETRIABLE) and "api key" not in str(error).lower():
+            # key 无效时服务端也返回 InvalidArgument，这种情况换 key 即可
+            kind = FAIL_FAST
+        else:
+            kind = ROTATE
+        self.counts[kind] += 1
+        return kind
+
+    def backoff(self, throttled_count: int, error=None) -> float:
+        """第 throttled_count 次（从 1 开始）被限流后的冷却时间：服务端给出的时间优先，否则指数退避并加抖动"""
+        hint = retry_after_hint(error) if error is not None else None
+        if hint is not None:
+            self.server_hints += 1
+            return hint
+        ceiling = min(self.backoff_max, self.backoff_base * (2 ** (throttled_count - 1)))
+        return random.uniform(ceiling / 2, ceiling)
+
+    def deadline(self) -> float:
+        """本次调用的截止时间（time.monotonic() 时钟）"""
+        return time.monotonic() + self.deadline_seconds
+
+    def stats(self) -> dict:
+        return {
+            "fail_fast": self.counts[FAIL_FAST],
+            "rotate": self.counts[ROTATE],
+            "throttled": self.counts[THROTTLED],
+            "server_hints": self.server_hints,
+            "deadline_exceeded": self.deadline_exceeded,
+        }
@@ -0,0 +1,106 @@
+# utils/snapshot_format.py
+"""
+持久化数据的快照编码格式。
+
+    MAGIC (4 字节) | 版本号 (1 字节) | 标志位 (1 字节) | 负载
+
+- 负载为紧凑 JSON（无缩进），设置了 FLAG_ZLIB 时经过 zlib 压缩；
+- 设置了 FLAG_INT_PAIRS 时，负载是 [[int_key, value], ...] 形式的键值对列表，
+  解码时直接构造 dict，key 本身就是整数，不需要再逐个 int() 转换；
+- 设置了 FLAG_DELTA 时（版本 2），负载为 "基础快照长度 (4 字节) | 基础快照 | 增量快照"，
+  两部分本身都是完整的快照字节串。增量快照的内容为 {"u": [[key, value], ...], "d": [key, ...]}，
+  解码时先解出基础快照，再覆盖 u 中的条目、删除 d 中的 key。这样保存时可以原样复用上一次编码好的
+  基础快照，只编码被修改过的条目；
+- 不以 MAGIC 开头的内容视为旧版的纯 JSON 文件，由调用方自行处理 key 类型。
+"""
+import json
+import zlib
+import struct
+
+MAGIC = b"MKSN"
+# 能读取的最高版本；不含增量的文件仍写为版本 1，旧版本的机器人也能读取
+SCHEMA_VERSION = 2
+BASE_VERSION = 1
+DELTA_VERSION = 2
+FLAG_ZLIB = 0x01
+FLAG_INT_PAIRS = 0x02
+FLAG_DELTA = 0x04
+HEADER = struct.Struct(">4sBB")
+DELTA_LENGTH = struct.Struct(">I")
+COMPRESSION_LEVEL = 6
+
+
+class SnapshotFormatError(ValueError):
+    pass
+
+
+def encode(value, int_keys: bool = False, compress: bool = True) -> bytes:
+    """把一个分区的值编码为快照字节串。int_keys=True 时 value 必须是以 int 为 key 的字典。"""
+    flags = 0
+    if int_keys:
+        value = list(value.items())
+        flags |= FLAG_INT_PAIRS
+    return wrap_payload(dumps(value), flags, compress)
+
+
+def dumps(value) -> bytes:
+    """快照中使用的紧凑 JSON 编码"""
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def wrap_payload(payload: bytes, flags: int = 0, compress: bool = True) -> bytes:
+    """给已经编码好的 JSON 负载加上文件头（可选压缩）"""
+    if compress:
+        payload = zlib.compress(payload, COMPRESSION_LEVEL)
+        flags |= FLAG_ZLIB
+    return HEADER.pack(MAGIC, BASE_VERSION, flags) + payload
+
+
+def encode_delta_payload(fragments, deleted) -> bytes:
+    """fragments 为各条目已编码好的 [key, value] JSON 片段，deleted 为被删除的 key"""
+    return b'{"u":[' + b",".join(fragments) + b'],"d":' + dumps(list(deleted)) + b'}'
+
+
+def splice(base: bytes, delta: bytes) -> bytes:
+    """把完整的基础快照和增量快照拼接为一个文件，两部分都不需要重新编码"""
+    return HEADER.pack(MAGIC, DELTA_VERSION, FLAG_DELTA) + DELTA_LENGTH.pack(len(base)) + base + delta
+
+
+def is_snapshot(raw: bytes) -> bool:
+    return raw[:len(MAGIC)] == MAGIC
+
+
+def decode(raw: bytes):
+    """解码快照字节串；旧版纯 JSON 文件会被原样解析后返回"""
+    if not is_snapshot(raw):
+        return json.loads(raw.decode('utf-8'))
+    if len(raw) < HEADER.size:
+        raise SnapshotFormatError("快照文件头不完整")
+    _, version, flags = HEADER.unpack_from(raw)
+    if version > SCHEMA_VERSION:
+        raise SnapshotFormatError(f"不支持的快照版本 {version}（当前最高支持 {SCHEMA_VERSION}），请升级机器人。")
+    payload = raw[HEADER.size:]
+    if flags & FLAG_DELTA:
+        return _decode_delta(payload)
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+    value = json.loads(payload.decode('utf-8'))
+    if flags & FLAG_INT_PAIRS:
+        value = dict(value)
+    return value
+
+
+def _decode_delta(payload: bytes):
+    if len(payload) < DELTA_LENGTH.size:
+        raise SnapshotFormatError("增量快照不完整")
+    (base_length,) = DELTA_LENGTH.unpack_from(payload)
+    base_end = DELTA_LENGTH.size + base_length
+    if len(payload) < base_end:
+        raise SnapshotFormatError("增量快照中的基础快照不完整")
+    value = decode(payload[DELTA_LENGTH.size:base_end])
+    patch = decode(payload[base_end:])
+    for key, item in patch["u"]:
+        value[key] = item
+    for key in patch["d"]:
+        value.pop(key, None)
+    return value
@@ -0,0 +1,419 @@
+# utils/sqlite_store.py
+"""
+可选的 SQLite 存储后端（DATA_STORE=sqlite）。
+
+- 数据库使用 WAL 模式，所有写入都在一个专用的写线程中按批次提交，不占用事件循环；
+- 写入内容与本地预写日志使用相同的记录格式（{"s": 分区, "k": key, "v": 值, "d": 删除}），
+  因此 data_manager 的每个修改接口无需改动；
+- user_data 与 conversation_history 不再整体常驻内存，而是通过 TableMap 按需读取，
+  内存中最多保留 resident_max_entries 条最近访问的条目（还没有提交到数据库的修改不会被淘汰）；
+- 可通过 `python -m utils.sqlite_store <milky_bot_data.json> <数据库路径>` 一次性导入旧版数据文件。
+"""
+import os
+import json
+import queue
+import sqlite3
+import asyncio
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import Future
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS conversation_turns (
+    conv_key TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (conv_key, seq)
+);
+CREATE TABLE IF NOT EXISTS personas (
+    name TEXT PRIMARY KEY,
+    content TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS logging_config (
+    guild_id TEXT PRIMARY KEY,
+    config TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS global_memory (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT,
+    user_id INTEGER,
+    user_name TEXT,
+    message TEXT,
+    bot_reply TEXT
+);
+CREATE TABLE IF NOT EXISTS conversation_activity (
+    conv_key TEXT PRIMARY KEY,
+    last_active TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS conversation_summaries (
+    conv_key TEXT PRIMARY KEY,
+    summary TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS kv (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# 按需加载、不整体常驻内存的分区（对话的活跃日期和总结与对话历史一样随对话数量增长）
+LAZY_SECTIONS = ("user_data", "conversation_history", "conversation_last_active", "conversation_summaries")
+# 每个按需加载的分区在内存中最多保留的条目数
+DEFAULT_RESIDENT_MAX_ENTRIES = 2000
+# 有专用表的字典类分区：分区名 -> (表名, key 列, value 列)
+KEYED_TABLES = {
+    "personas": ("personas", "name", "content"),
+    "logging_config": ("logging_config", "guild_id", "config"),
+    "conversation_last_active": ("conversation_activity", "conv_key", "last_active"),
+    "conversation_summaries": ("conversation_summaries", "conv_key", "summary"),
+}
+MEMORY_COLUMNS = ("timestamp", "user_id", "user_name", "message", "bot_reply")
+INT_KEY_SECTIONS = ("user_data", "autoreact_map")
+
+_STOP = object()
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+class SQLiteStore:
+    def __init__(self, path: str, resident_max_entries: int = DEFAULT_RESIDENT_MAX_ENTRIES):
+        self.path = path
+        self.resident_max_entries = resident_max_entries
+        # 已提交给写线程 / 写线程已处理完的写入条数（apply 或 apply_many 各计一条），
+        # 写线程按顺序处理，committed >= n 表示第 n 条写入已经落盘
+        self.submitted = 0
+        self.committed = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._queue = queue.Queue()
+        self._ready = threading.Event()
+        self._writer = threading.Thread(target=self._writer_loop, name="sqlite-writer", daemon=True)
+        self._writer.start()
+        self._ready.wait()
+        # 读连接只在事件循环线程中使用；WAL 模式下读写互不阻塞
+        self._read_conn = sqlite3.connect(path, check_same_thread=False)
+
+    # --- 写线程 ---
+    def _writer_loop(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        conn.commit()
+        self._ready.set()
+        while True:
+            item = self._queue.get()
+            batch = [item]
+            # 把队列中已经积压的写入合并到同一个事务里
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = _STOP in batch
+            # 每个分组是一条记录，或 apply_many() 提交的一组必须一起生效的记录
+            groups = []
+            for entry in batch:
+                if isinstance(entry, str):
+                    loaded = json.loads(entry)
+                    groups.append(loaded if isinstance(loaded, list) else [loaded])
+            try:
+                with conn:
+                    for group in groups:
+                        for record in group:
+                            self._apply_record(conn, record)
+            except Exception as e:
+                # 批量事务失败时逐组重试，避免一条坏记录拖累整批
+                print(f"⚠️ SQLite 批量写入失败，改为逐条写入: {e}")
+                for group in groups:
+                    try:
+                        with conn:
+                            for record in group:
+                                self._apply_record(conn, record)
+                    except Exception as record_error:
+                        print(f"❌ SQLite 写入记录失败 (分区 {', '.join(sorted({r.get('s') for r in group}))}): {record_error}")
+            self.committed += len(groups)
+            # 事务提交后再执行回调类任务（drain / backup / import），保证它们看到的是已提交的数据
+            for entry in batch:
+                if isinstance(entry, tuple):
+                    func, future = entry
+                    try:
+                        future.set_result(func(conn))
+                    except Exception as e:
+                        future.set_exception(e)
+            if stop:
+                conn.close()
+                return
+
+    def _apply_record(self, conn, record: dict):
+        section, key, value = record["s"], record.get("k"), record.get("v")
+        deleted = bool(record.get("d"))
+        if section == "user_data":
+            if key is None:
+                conn.execute("DELETE FROM users")
+                for user_id, user_data in (value or {}).items():
+                    conn.execute("INSERT INTO users (user_id, data) VALUES (?, ?)", (int(user_id), _dumps(user_data)))
+            elif deleted:
+                conn.execute("DELETE FROM users WHERE user_id = ?", (int(key),))
+            else:
+                conn.execute("INSERT OR REPLACE INTO users (user_id, data) VALUES (?, ?)", (int(key), _dumps(value)))
+        elif section == "conversation_history":
+            if key is None:
+                conn.execute("DELETE FROM conversation_turns")
+                for conv_key, history in (value or {}).items():
+                    self._insert_turns(conn, conv_key, history)
+            else:
+                conn.execute("DELETE FROM conversation_turns WHERE conv_key = ?", (key,))
+                if not deleted:
+                    self._insert_turns(conn, key, value)
+        elif section in KEYED_TABLES:
+            table, key_col, value_col = KEYED_TABLES[section]
+            if key is None:
+                conn.execute(f"DELETE FROM {table}")
+                for item_key, item_value in (value or {}).items():
+                    conn.execute(f"INSERT INTO {table} ({key_col}, {value_col}) VALUES (?, ?)", (item_key, _dumps(item_value)))
+            elif deleted:
+                conn.execute(f"DELETE FROM {table} WHERE {key_col} = ?", (key,))
+            else:
+                conn.execute(f"INSERT OR REPLACE INTO {table} ({key_col}, {value_col}) VALUES (?, ?)", (key, _dumps(value)))
+        elif section == "global_memory_log":
+            conn.execute("DELETE FROM global_memory")
+            conn.executemany(
+                "INSERT INTO global_memory (timestamp, user_id, user_name, message, bot_reply) VALUES (?, ?, ?, ?, ?)",
+                [tuple(entry.get(col) for col in MEMORY_COLUMNS) for entry in (value or [])]
+            )
+        else:
+            # 其他设置项（提示词、模式开关、屏蔽词等）存为键值对
+            conn.execute("INSERT OR REPLACE INTO kv (name, value) VALUES (?, ?)", (section, _dumps(value)))
+
+    @staticmethod
+    def _insert_turns(conn, conv_key: str, history: list):
+        conn.executemany(
+            "INSERT INTO conversation_turns (conv_key, seq, role, content) VALUES (?, ?, ?, ?)",
+            [(conv_key, seq, turn.get("role", ""), _dumps(turn.get("content"))) for seq, turn in enumerate(history or [])]
+        )
+
+    # --- 写入接口（事件循环线程调用） ---
+    def apply(self, record: dict):
+        """提交一条修改记录。记录在调用线程中序列化，之后对原对象的修改不会影响写入内容。"""
+        self.submitted += 1
+        self._queue.put(_dumps(record))
+
+    def apply_many(self, records: list):
+        """一次提交多条修改记录，保证它们落在同一个数据库事务中"""
+        self.submitted += 1
+        self._queue.put(_dumps(records))
+
+    def _call(self, func) -> Future:
+        future = Future()
+        self._queue.put((func, future))
+        return future
+
+    async def drain(self):
+        """等待此前提交的所有写入完成提交"""
+        await asyncio.wrap_future(self._call(lambda conn: None))
+
+    async def backup(self, target_path: str):
+        """在写线程中把数据库完整备份到 target_path（使用 SQLite 在线备份 API）"""
+        def _backup(conn):
+            target = sqlite3.connect(target_path)
+            try:
+                conn.backup(target)
+            finally:
+                target.close()
+        await asyncio.wrap_future(self._call(_backup))
+
+    def import_data(self, snapshot: dict):
+        """把完整的数据字典一次性导入数据库（覆盖已有内容），阻塞直到完成"""
+        for section, value in snapshot.items():
+            if section in LAZY_SECTIONS and isinstance(value, TableMap):
+                continue
+            self.apply({"s": section, "v": value})
+        self._call(lambda conn: None).result()
+
+    def import_legacy_json(self, json_path: str):
+        """导入旧版 milky_bot_data.json"""
+        with open(json_path, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+        self.import_data(snapshot)
+        return snapshot
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._writer.join()
+        self._read_conn.close()
+
+    # --- 读取接口 ---
+    def is_empty(self) -> bool:
+        for table in ("kv", "users", "conversation_turns", "personas"):
+            if self._read_conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+                return False
+        return True
+
+    def load_resident_sections(self) -> dict:
+        """读取除 LAZY_SECTIONS 以外的所有分区，这些分区数据量很小，直接常驻内存"""
+        result = {}
+        for name, value in self._read_conn.execute("SELECT name, value FROM kv"):
+            value = json.loads(value)
+            if name in INT_KEY_SECTIONS and isinstance(value, dict):
+                value = {int(k): v for k, v in value.items()}
+            result[name] = value
+        for section, (table, key_col, value_col) in KEYED_TABLES.items():
+            if section in LAZY_SECTIONS:
+                continue
+            result[section] = {
+                k: json.loads(v) for k, v in self._read_conn.execute(f"SELECT {key_col}, {value_col} FROM {table}")
+            }
+        rows = self._read_conn.execute(f"SELECT {', '.join(MEMORY_COLUMNS)} FROM global_memory ORDER BY id")
+        result["global_memory_log"] = [dict(zip(MEMORY_COLUMNS, row)) for row in rows]
+        return result
+
+    def read(self, section: str, key):
+        if section in KEYED_TABLES:
+            table, key_col, value_col = KEYED_TABLES[section]
+            row = self._read_conn.execute(f"SELECT {value_col} FROM {table} WHERE {key_col} = ?", (key,)).fetchone()
+            return json.loads(row[0]) if row else None
+        if section == "user_data":
+            row = self._read_conn.execute("SELECT data FROM users WHERE user_id = ?", (int(key),)).fetchone()
+            return json.loads(row[0]) if row else None
+        rows = self._read_conn.execute(
+            "SELECT role, content FROM conversation_turns WHERE conv_key = ? ORDER BY seq", (key,)
+        ).fetchall()
+        if not rows:
+            return None
+        return [{"role": role, "content": json.loads(content)} for role, content in rows]
+
+    def keys(self, section: str):
+        if section in KEYED_TABLES:
+            table, key_col, _ = KEYED_TABLES[section]
+            return [row[0] for row in self._read_conn.execute(f"SELECT {key_col} FROM {table}")]
+        if section == "user_data":
+            return [row[0] for row in self._read_conn.execute("SELECT user_id FROM users")]
+        return [row[0] for row in self._read_conn.execute("SELECT DISTINCT conv_key FROM conversation_turns")]
+
+    def table_map(self, section: str, resident: dict = None):
+        view = TableMap(self, section, self.resident_max_entries)
+        if resident is not None:
+            # 整个分区被替换：在写线程完成替换之前，数据库中的旧内容不可见
+            view.reset(resident, self._call(lambda conn: None))
+        return view
+
+
+class TableMap(MutableMapping):
+    """
+    按需从 SQLite 读取的字典视图。只有最近被访问或修改过的条目会留在内存中（LRU，最多 max_entries 条）；
+    写入由 data_manager 通过 SQLiteStore.apply 提交，这里只维护内存中的最新值和删除标记，
+    保证写线程提交之前也能读到自己刚写入的内容。
+
+    被修改的条目在写线程提交它之前不能淘汰，否则再次读取会从数据库读到旧值：修改时先固定（_pinned 中值为 None），
+    data_manager 提交记录后调用 submitted() 登记对应的写入序号，写线程处理到该序号后才允许淘汰。
+    """
+
+    def __init__(self, store: SQLiteStore, section: str, max_entries: int = DEFAULT_RESIDENT_MAX_ENTRIES):
+        self._store = store
+        self._section = section
+        self.max_entries = max_entries
+        self._resident = OrderedDict()
+        self._pinned = {}
+        self._deleted = set()
+        self._barrier = None
+
+    def reset(self, items: dict, barrier: Future):
+        self._resident = OrderedDict(items)
+        self._pinned = {}
+        self._deleted = set()
+        self._barrier = barrier
+
+    def _db_visible(self):
+        return self._barrier is None or self._barrier.done()
+
+    def submitted(self, key, seq: int):
+        """key 的修改已作为第 seq 条写入提交给写线程"""
+        if key in self._pinned:
+            self._pinned[key] = seq
+
+    def _evict(self):
+        over = len(self._resident) - self.max_entries
+        # 整体替换还没有落盘时，内存中的条目是唯一的副本
+        if over <= 0 or not self._db_visible():
+            return
+        committed = self._store.committed
+        victims = []
+        for key in self._resident:
+            if len(victims) >= over:
+                break
+            if key in self._pinned:
+                seq = self._pinned[key]
+                if seq is None or seq > committed:
+                    continue
+            victims.append(key)
+        for key in victims:
+            del self._resident[key]
+            self._pinned.pop(key, None)
+
+    def __getitem__(self, key):
+        if key in self._resident:
+            self._resident.move_to_end(key)
+            value = self._resident[key]
+            # 被固定的条目提交后，在之后的访问中补上淘汰
+            self._evict()
+            return value
+        if key in self._deleted or not self._db_visible():
+            raise KeyError(key)
+        value = self._store.read(self._section, key)
+        if value is None:
+            raise KeyError(key)
+        self._resident[key] = value
+        self._evict()
+        return value
+
+    def peek(self, key, default=None):
+        """读取但不放入内存，也不改变 LRU 顺序（用于扫描全部条目）"""
+        if key in self._resident:
+            return self._resident[key]
+        if key in self._deleted or not self._db_visible():
+            return default
+        value = self._store.read(self._section, key)
+        return default if value is None else value
+
+    def __setitem__(self, key, value):
+        self._deleted.discard(key)
+        self._resident[key] = value
+        self._resident.move_to_end(key)
+        self._pinned[key] = None
+        self._evict()
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._resident.pop(key, None)
+        self._pinned.pop(key, None)
+        self._deleted.add(key)
+
+    def __iter__(self):
+        keys = dict.fromkeys(self._resident)
+        if self._db_visible():
+            for key in self._store.keys(self._section):
+                if key not in self._deleted:
+                    keys.setdefault(key)
+        return iter(list(keys))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) != 3:
+        print("用法: python -m utils.sqlite_store <milky_bot_data.json> <数据库路径>")
+        sys.exit(1)
+    store = SQLiteStore(sys.argv[2])
+    snapshot = store.import_legacy_json(sys.argv[1])
+    store.close()
+    print(f"✔️ 已将 {sys.argv[1]} 中的 {len(snapshot)} 个分区导入到 {sys.argv[2]}。")
@@ -0,0 +1,147 @@
+# utils/storage_backends.py
+"""
+远端存储后端：data_manager 的快照上传与下载都通过这里进行，具体实现由环境变量 DATA_BACKEND 选择。
+
+- hub（默认）：Hugging Face Hub 数据集仓库，每次保存是一次 commit；
+- local：本地目录（例如挂载的持久卷），每个文件先写临时文件再原子 rename；
+- memory：进程内字典，不落盘，用于离线压测和基准测试。
+
+所有方法都是阻塞式的，data_manager 会在持久化工作线程中调用它们。
+"""
+import os
+import shutil
+import threading
+from huggingface_hub import hf_hub_download, HfApi, CommitOperationAdd
+from huggingface_hub.errors import HfHubHTTPError
+
+from . import local_store
+
+
+class StorageBackend:
+    """所有后端的公共接口。files 为 {仓库内路径: bytes 或本地文件路径}"""
+    name = "base"
+    label = "远端存储"
+
+    def is_configured(self) -> bool:
+        return True
+
+    def read(self, path: str):
+        """读取文件内容，不存在时返回 None"""
+        raise NotImplementedError
+
+    def read_to_file(self, path: str, target_path: str) -> bool:
+        """把文件保存到本地 target_path，不存在时返回 False"""
+        content = self.read(path)
+        if content is None:
+            return False
+        local_store.write_files_atomic(os.path.dirname(os.path.abspath(target_path)), {os.path.basename(target_path): content})
+        return True
+
+    def commit(self, files: dict, message: str):
+        raise NotImplementedError
+
+    def is_retriable(self, e: Exception) -> bool:
+        return True
+
+    @staticmethod
+    def _as_bytes(content) -> bytes:
+        if isinstance(content, (bytes, bytearray)):
+            return bytes(content)
+        with open(content, 'rb') as f:
+            return f.read()
+
+
+class HubBackend(StorageBackend):
+    name = "hub"
+    label = "Hugging Face Hub"
+
+    def __init__(self, token: str, repo_id: str):
+        self.token = token
+        self.repo_id = repo_id
+
+    def is_configured(self) -> bool:
+        return bool(self.token and self.repo_id and self.repo_id != "SETUP_YOUR_HF_DATA_REPO_ID_ENV_VAR")
+
+    def _download(self, path: str):
+        try:
+            return hf_hub_download(repo_id=self.repo_id, filename=path, repo_type="dataset", token=self.token)
+        except HfHubHTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise
+
+    def read(self, path: str):
+        local_path = self._download(path)
+        if local_path is None:
+            return None
+        with open(local_path, 'rb') as f:
+            return f.read()
+
+    def read_to_file(self, path: str, target_path: str) -> bool:
+        local_path = self._download(path)
+        if local_path is None:
+            return False
+        os.makedirs(os.path.dirname(os.path.abspath(target_path)), exist_ok=True)
+        shutil.copyfile(local_path, target_path)
+        return True
+
+    def commit(self, files: dict, message: str):
+        operations = [CommitOperationAdd(path_in_repo=path, path_or_fileobj=content) for path, content in files.items()]
+        HfApi(token=self.token).create_commit(repo_id=self.repo_id, repo_type="dataset", operations=operations, commit_message=message)
+
+    def is_retriable(self, e: Exception) -> bool:
+        """令牌无效、仓库不存在之类的错误重试也没有用"""
+        if isinstance(e, HfHubHTTPError) and e.response is not None:
+            status = e.response.status_code
+            return status == 429 or status >= 500
+        return True
+
+
+class LocalDirBackend(StorageBackend):
+    name = "local"
+
+    def __init__(self, root: str):
+        self.root = root
+        self.label = f"本地目录 '{root}'"
+
+    def read(self, path: str):
+        return local_store.read_file(self.root, path)
+
+    def commit(self, files: dict, message: str):
+        # 按给定顺序逐个原子替换，manifest 放在最后写入
+        local_store.write_files_atomic(self.root, {path: self._as_bytes(content) for path, content in files.items()})
+
+
+class MemoryBackend(StorageBackend):
+    name = "memory"
+    label = "内存存储"
+
+    def __init__(self):
+        self.files = {}
+        self.commits = 0
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+
+    def read(self, path: str):
+        with self._lock:
+            return self.files.get(path)
+
+    def commit(self, files: dict, message: str):
+        contents = {path: self._as_bytes(content) for path, content in files.items()}
+        with self._lock:
+            self.files.update(contents)
+            self.commits += 1
+            self.bytes_written += sum(len(content) for content in contents.values())
+
+
+def create_backend(name: str, token: str = None, repo_id: str = None, local_dir: str = None) -> StorageBackend:
+    name = (name or "hub").lower()
+    if name == "hub":
+        return HubBackend(token, repo_id)
+    if name == "local":
+        if not local_dir:
+            raise ValueError("DATA_BACKEND=local 需要同时设置 DATA_BACKEND_DIR。")
+        return LocalDirBackend(local_dir)
+    if name == "memory":
+        return MemoryBackend()
+    raise ValueError(f"未知的存储后端 '{name}'，可选值为 hub、local、memory。")